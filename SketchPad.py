@@ -1,259 +1,189 @@
 import tkinter as tk
 from tkinter import ttk, colorchooser, filedialog
-import copy as cp
-import json, math
-
-
-class Shape:
-    def __init__(self, color):
-        self.color = color
+import math, time, heapq, threading
+from itertools import islice
+from types import SimpleNamespace
+from spatial import GridIndex, PointIndex
+from shapes import (Shape, IrRegularShape, RegularShape, Polygon, Freehand, Line, Rectangle, Ellipse, Square,
+                    Circle, Group, SHAPE_CLASSES, HIT_MARGIN, bounding_box)
+from render import TkRenderer, ViewRenderer
+from viewport import Viewport
+from recording import Recorder
+from profiling import Profiler, point_count
+from tiles import TileLayer
+from fileformats import RecordReader, BinaryReader, is_binary, save_shapes
+from history import History, AddShapes, RemoveShapes, MoveShapes, GroupShapes, UngroupShapes
+from journal import Journal, RECOVERY_DIR
+
+
+class HeadlessRoot:
+    """Stands in for the Tk root when DrawingApp runs without a display.
+
+    after() callbacks are queued on a virtual clock instead of an event loop;
+    run() calls the ones that fall due.
+    """
+
+    def __init__(self):
+        self.time = 0  # virtual milliseconds
+        self.queue = []  # heap of (due, sequence, job, callback, args)
+        self.cancelled = set()
+        self.sequence = 0
+
+    def after(self, ms, callback, *args):
+        self.sequence += 1
+        job = f"after#{self.sequence}"
+        heapq.heappush(self.queue, (self.time + ms, self.sequence, job, callback, args))
+        return job
+
+    def after_idle(self, callback, *args):
+        return self.after(0, callback, *args)
+
+    def after_cancel(self, job):
+        self.cancelled.add(job)
+
+    def run(self, ms=0):
+        """Advance the clock by `ms`, calling every callback that falls due, in order."""
+        end = self.time + ms
+        while self.queue and self.queue[0][0] <= end:
+            self.time, _, job, callback, args = heapq.heappop(self.queue)
+            if job in self.cancelled:
+                self.cancelled.discard(job)
+            else:
+                callback(*args)
+        self.time = end
 
-    def draw(self, canvas):
-        pass
-
-    def contains_point(self, x, y):
-        return False
-
-    def move(self, dx, dy):
-        pass
-
-    def to_dict(self):
-        return {
-            'type': self.__class__.__name__,
-            'color': self.color
-        }
-
-    @classmethod
-    def from_dict(cls, data):
-        shape_class = globals()[data['type']]
-        return shape_class.from_dict(data)
-
-
-class IrRegularShape(Shape):
-    def __init__(self, color):
-        super().__init__(color)
-        self.points = []
-
-    def move(self, dx, dy):
-        self.points = [(x + dx, y + dy) for x, y in self.points]
-
-    def to_dict(self):
-        data = super().to_dict()
-        data['points'] = self.points
-        return data
-
-    @classmethod
-    def from_dict(cls, data):
-        shape = cls(data['color'])
-        shape.points = data['points']
-        return shape
-
-
-class RegularShape(Shape):
-    def __init__(self, start_point, end_point, color):
-        super().__init__(color)
-        self.start_point = start_point
-        self.end_point = end_point
-
-    def move(self, dx, dy):
-        self.start_point = (self.start_point[0] + dx, self.start_point[1] + dy)
-        self.end_point = (self.end_point[0] + dx, self.end_point[1] + dy)
-
-    def to_dict(self):
-        data = super().to_dict()
-        data['start_point'] = self.start_point
-        data['end_point'] = self.end_point
-        return data
-
-    @classmethod
-    def from_dict(cls, data):
-        return cls(data['start_point'], data['end_point'], data['color'])
-
-
-class Polygon(IrRegularShape):    
-    def add_point(self, x, y):
-        self.points.append((x, y))
-
-    def draw(self, canvas):
-        if len(self.points) > 1:
-            canvas.delete("preview")  # Clear any preview
-            #polygons are just a few lines, so we can draw it directly
-            canvas.create_line(self.points, fill="black", tags="polygon", width=2)
-
-    def preview(self, canvas, x, y):
-        if len(self.points) > 0:
-            canvas.delete("preview")  # Clear any previous preview
-            preview_points = self.points + [(x, y)]
-            canvas.create_line(preview_points, fill="gray", dash=(4, 2), tags="preview")
-    #may or may not be used
-    def flatten_points(self, points=None):
-        """Flatten the list of points for drawing."""
-        if points is None:
-            points = self.points
-        return [coord for point in points for coord in point]
-    
-    def contains_point(self, x, y):
-        """Check if the point (x, y) is inside or on the boundary of the polygon."""
-        # Check if the point is on any of the polygon's edges (lines)
-        for i in range(len(self.points) - 1):
-            x1, y1 = self.points[i]
-            x2, y2 = self.points[i + 1]
-            if Line((x1, y1), (x2, y2), self.color).contains_point(x, y):
-                return True  # Point is on an edge
-
-        # Check if the point is inside the polygon using ray-casting
-        inside = False
-        n = len(self.points)
-        x1, y1 = self.points[0]
-        for i in range(n + 1):
-            x2, y2 = self.points[i % n]
-            if y > min(y1, y2):
-                if y <= max(y1, y2):
-                    if x <= max(x1, x2):
-                        if y1 != y2:
-                            xinters = (y - y1) * (x2 - x1) / (y2 - y1) + x1
-                        if x1 == x2 or x <= xinters:
-                            inside = not inside
-            x1, y1 = x2, y2
-
-        return inside
-class Freehand(IrRegularShape):
-    def draw(self, canvas):
-        if len(self.points) > 1:
-            self.canvas_id = canvas.create_line(*self.flatten_points(), fill=self.color)
-
-    def contains_point(self, x, y):
-        return any(abs(x - px) < 10 and abs(y - py) < 10 for px, py in self.points)
-
-    def flatten_points(self):
-        return [coord for point in self.points for coord in point]
-
-
-class Line(RegularShape):
-    def draw(self, canvas):
-        self.canvas_id = canvas.create_line(self.start_point[0], self.start_point[1], self.end_point[0],
-                                            self.end_point[1], fill=self.color)
-
-    def contains_point(self, x, y):
-        x1, y1, x2, y2 = self.start_point + self.end_point
-        if min(x1, x2) <= x <= max(x1, x2) and min(y1, y2) <= y <= max(y1, y2):
-            dist = abs((y2 - y1) * x - (x2 - x1) * y + x2 * y1 - y2 * x1) / ((y2 - y1) ** 2 + (x2 - x1) ** 2) ** 0.5
-            return dist < 5
-        return False
-
-
-class Rectangle(RegularShape):
-    def draw(self, canvas):
-        self.canvas_id = canvas.create_rectangle(self.start_point[0], self.start_point[1],
-                                                 self.end_point[0], self.end_point[1], outline=self.color)
-
-    def contains_point(self, x, y):
-        (x1, y1), (x2, y2) = self.start_point , self.end_point
-        return min(x1, x2) <= x <= max(x1, x2) and min(y1, y2) <= y <= max(y1, y2)
-
-
-class Ellipse(RegularShape):
-    def draw(self, canvas):
-        self.canvas_id = canvas.create_oval(self.start_point[0], self.start_point[1],
-                                            self.end_point[0], self.end_point[1], outline=self.color)
-
-    def contains_point(self, x, y):
-        rx = abs(self.end_point[0] - self.start_point[0]) / 2
-        ry = abs(self.end_point[1] - self.start_point[1]) / 2
-        cx = self.start_point[0] + rx
-        cy = self.start_point[1] + ry
-        if rx > 0 and ry > 0:
-            return ((x - cx) ** 2) / (rx ** 2) + ((y - cy) ** 2) / (ry ** 2) <= 1
-        return False
-
-
-class Square(Rectangle):
-    def draw(self, canvas):
-        side_length = min(abs(self.end_point[0] - self.start_point[0]), abs(self.end_point[1] - self.start_point[1]))
-        self.end_point = (self.start_point[0] + side_length, self.start_point[1] + side_length)
-        super().draw(canvas)
-
-
-class Circle(Ellipse):
-    def draw(self, canvas):
-        radius = min(abs(self.end_point[0] - self.start_point[0]), abs(self.end_point[1] - self.start_point[1])) // 2
-        self.end_point = (self.start_point[0] + 2 * radius, self.start_point[1] + 2 * radius)
-        super().draw(canvas)
-
-class Group(Shape):
-    def __init__(self, shapes):
-        super().__init__(color=None)  # Groups don't have a single color
-        self.shapes = shapes  # List of shapes in the group
-    
-    def draw(self, canvas):
-        for shape in self.shapes:
-            shape.draw(canvas)
-    
-    def contains_point(self, x, y):
-        return any(shape.contains_point(x, y) for shape in self.shapes)
-    
-    def move(self, dx, dy):
-        for shape in self.shapes:
-            shape.move(dx, dy)
-    
-    def to_dict(self):
-        data = super().to_dict()
-        data['shapes'] = [shape.to_dict() for shape in self.shapes]
-        return data
-    
-    @classmethod
-    def from_dict(cls, data):
-        shapes = [Shape.from_dict(shape_data) for shape_data in data['shapes']]
-        return cls(shapes)
+    def destroy(self):
+        self.queue.clear()
 
 
 class DrawingApp:
-    def __init__(self, root):
+    def __init__(self, root, renderer=None, recovery_dir=RECOVERY_DIR):
+        """Given a renderer, e.g. a RecordingRenderer, the app runs headless: it creates
+        no widgets, and root can be a HeadlessRoot."""
         self.root = root
-        self.root.title("Drawing Pad")
-
-        self.toolbar = ttk.Frame(root)
-        self.toolbar.pack(side=tk.TOP, fill=tk.X)
-
-        self.canvas = tk.Canvas(root, bg="white")
-        self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.headless = renderer is not None
+        if self.headless:
+            self.canvas = None
+            self.view = Viewport()
+            self.renderer = ViewRenderer(renderer, self.view)
+        else:
+            self.root.title("Drawing Pad")
+
+            self.toolbar = ttk.Frame(root)
+            self.toolbar.pack(side=tk.TOP, fill=tk.X)
+
+            self.canvas = tk.Canvas(root, bg="white")
+            self.canvas.pack(fill=tk.BOTH, expand=True)
+            # the real size arrives with the first <Configure> event
+            self.view = Viewport(self.canvas.winfo_reqwidth(), self.canvas.winfo_reqheight())
+            self.renderer = ViewRenderer(TkRenderer(self.canvas), self.view)  # All drawing goes through this
 
         #config
-        self.tolerance = 10  # Tolerance for snapping to the starting point
-        self.THRESHOLD = 5  # Minimum movement in pixels to detect a drag
+        self.tolerance = 10  # Screen pixels from the starting point within which a click closes a polygon
+        self.snap_radius = 8  # Screen pixels within which drawing and dragging snap to the points of shapes
+        self.THRESHOLD = 5  # Minimum movement in screen pixels to detect a drag
+        self.hit_margin = HIT_MARGIN  # Screen pixels from its bounding box that contains_point can report a hit
+        self.zoom_step = 1.2  # Zoom factor per mouse wheel notch
+        self.frame_ms = 16  # Shortest time between two frames of mouse motion; 0 draws as soon as Tk is idle
+        self.cull_margin = 4  # Screen pixels around the view where shapes still get drawn, for outline widths
+        # Farthest a finished freehand stroke may stray from the mouse path: half of it is spent
+        # dropping samples while drawing, half on simplifying the stroke when the mouse is released
+        self.stroke_tolerance = 2.0
+        self.load_slice_ms = 30  # Time spent adding loaded shapes before letting Tk handle events again
+        self.journal_interval_ms = 500  # How often journaled edits are written out and fsynced
+        # Estimated bytes of undo steps kept as they are; older steps are compressed, and
+        # past history_packed_budget bytes of those, moved to a temporary file
+        self.history_budget = 64 << 20
+        self.history_packed_budget = 16 << 20
+        self.recovery_dir = recovery_dir  # Journal of the untitled document, and which journal to recover
+        self.overlay_ms = 1000  # How often the performance overlay is brought up to date
+        self.tile_size = 256  # Side of a raster tile, in screen pixels, when tiles are on (set_tiles)
+        self.tile_limit = 256  # Raster tiles kept, on screen or not
+        self.tile_thread = True  # Rasterize tiles on a worker thread rather than between frames
+        self.save_poll_ms = 50  # How often a background save is checked on
         
         #state
         self.color = "black"
         self.selected_shape_class = None  # Stores the shape class (e.g., Line, Rectangle), if not None, we are in drawing mode
         self.current_drawing_shape = None  # Stores the current shape instance being drawn
         self.shapes = []  # Store all shapes here for persistence
+        self.index = GridIndex()  # Bounding boxes of self.shapes, for hit-testing
+        self.snaps = PointIndex()  # Snap points of self.shapes
+        self.snapping = True  # Whether drawing and dragging snap to the points of shapes
+        self.snap_marker = None  # Canvas item marking the point snapped to
+        self.snap_var = None
+        self.items = {}  # Canvas item ids of each shape in self.shapes
+        self.highlights = {}  # Canvas item ids of each selected shape's outline
+        self.preview_items = []  # Canvas item ids of the paste preview
         self.drag_start = None
+        self.drag_origin = None  # Where the current drag started, to record the total move
+        self.drag_handle = None  # Snap point of the dragged shape nearest drag_origin, as it was then
+        self.marquee = None  # Where a rubber-band selection started, while one is dragged
+        self.marquee_item = None  # Canvas item of the rubber band, and whether it is a crossing one
+        self.marquee_crossing = False
         self.active_shapes = []  # List of selected shapes (can include multiple shapes)
         self.groups = []  # List of persistent groups
-        self.undo_stack = []
-        self.redo_stack = []
+        self.history = History(self.history_budget, self.history_packed_budget)  # Undo/redo commands
+        self.journal = Journal(SHAPE_CLASSES, self.recovery_dir)  # Edits since the last save, for crash recovery
+        self.journal_job = None
 
         self.is_dragging = False  # Tracks whether the user is dragging shapes
+        self.pan_start = None  # Last screen position of a middle-button pan
+        self.stroke_samples = 0  # Mouse samples seen for the freehand stroke being drawn
+        self.stroke_buffer = []  # Freehand samples waiting for the next frame
+        self.pending = {}  # Work motion events left for the next frame: callback -> arguments
+        self.frame_job = None
+        self.last_frame = 0.0
+        self.loading = None  # (reader, shapes, file_path) while a file streams in
+        self.load_job = None
+        self.saving = None  # (thread, file_path, journal ids, outcome, start time) of the save in the background
+        self.save_job = None
+        self.save_queued = None  # File to save to once the running save, or the load, is done
         self.clicked_shape = None
-
-        self.create_menus()
-        self.create_toolbar_buttons()
-
-        self.canvas.bind("<Button-1>", self.start_action)
-        self.canvas.bind("<Motion>", self.mouse_move)    # Mouse movement for preview
-        self.canvas.bind("<B1-Motion>", self.perform_action)
-        self.canvas.bind("<ButtonRelease-1>", self.end_action)
-        self.canvas.bind("<Button-3>", self.finish_polygon)
-        self.root.bind("<Delete>", self.delete_shapes)  # Bind the "Delete" key to delete shapes
-        self.root.bind("<Control-c>", self.copy_shapes)
-        self.root.bind("<Control-v>", self.paste_shapes)
-        self.root.bind("<Control-x>", self.cut_shapes)
-        self.root.bind("<Control-z>", self.undo)  # Ctrl+Z for Undo
-        self.root.bind("<Control-y>", self.redo)  # Ctrl+Y for Redo
-         # Create the status bar below the canvas
-        self.status_bar = ttk.Label(root, text="Welcome! Choose a tool to start.", relief=tk.SUNKEN, anchor="w")
-        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)  # Place the status bar at the bottom
-        
+        self.bindings = {}  # Event sequence -> handler, called through dispatch
+        self.recorder = None  # Recorder (recording.py) writing out the events handled, if any
+        self.pointer = None  # Document position of the mouse, as of the last canvas event
+        self.profiler = Profiler()  # Times the hot paths while profiling is on
+        self.overlay = None  # Text of the performance overlay while it is shown, in place of the status
+        self.overlay_job = None
+        self.overlay_frames = (0, 0.0)  # Frames run and their total time, as of the last overlay update
+        self.overlay_var = None
+        self.tiles = None  # TileLayer showing the shapes not being edited, if raster tiles are on
+        self.tiles_job = None
+        self.tiles_var = None
+        self.status = "Welcome! Choose a tool to start."  # Last status message, kept headless too
+        self.status_bar = None
+
+        if not self.headless:
+            self.create_menus()
+            self.create_toolbar_buttons()
+            self.root.protocol("WM_DELETE_WINDOW", self.quit)
+             # Create the status bar below the canvas
+            self.status_bar = ttk.Label(root, text=self.status, relief=tk.SUNKEN, anchor="w")
+            self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)  # Place the status bar at the bottom
+
+        # the drawing handlers get events in document coordinates, see bind_canvas
+        self.bind_canvas("<Button-1>", self.start_action)
+        self.bind_canvas("<Motion>", self.coalesced(self.mouse_move))    # Mouse movement for preview
+        self.bind_canvas("<B1-Motion>", self.drag_motion)
+        self.bind_canvas("<ButtonRelease-1>", self.end_action)
+        self.bind_canvas("<Button-3>", self.finish_polygon)
+        # the view handlers work in screen pixels
+        self.bind_event("<Button-2>", self.start_pan, self.canvas)
+        self.bind_event("<B2-Motion>", self.pan, self.canvas)
+        self.bind_event("<MouseWheel>", self.wheel_zoom, self.canvas)  # Windows and macOS
+        self.bind_event("<Button-4>", self.wheel_zoom, self.canvas)  # X11 scrolls with buttons 4 and 5
+        self.bind_event("<Button-5>", self.wheel_zoom, self.canvas)
+        self.bind_event("<Configure>", self.canvas_resized, self.canvas)
+        keys = None if self.headless else self.root
+        self.bind_event("<Control-0>", self.reset_view, keys)
+        self.bind_event("<Delete>", self.delete_shapes, keys)  # Bind the "Delete" key to delete shapes
+        self.bind_event("<Control-c>", self.copy_shapes, keys)
+        self.bind_event("<Control-v>", self.paste_shapes, keys)
+        self.bind_event("<Control-x>", self.cut_shapes, keys)
+        self.bind_event("<Control-z>", self.undo, keys)  # Ctrl+Z for Undo
+        self.bind_event("<Control-y>", self.redo, keys)  # Ctrl+Y for Redo
+        self.open_journal()
 
     def create_menus(self):
         menu_bar = tk.Menu(self.root)
@@ -264,6 +194,33 @@ class DrawingApp:
 
         file_menu.add_command(label="Save", command=self.save)
         file_menu.add_command(label="Load", command=self.load)
+        file_menu.add_separator()
+        file_menu.add_command(label="Record Session...", command=self.record_session)
+        file_menu.add_command(label="Stop Recording", command=self.stop_recording)
+
+        edit_menu = tk.Menu(menu_bar, tearoff=0)
+        menu_bar.add_cascade(label="Edit", menu=edit_menu)
+
+        edit_menu.add_command(label="Undo", command=lambda: self.invoke("undo"))
+        edit_menu.add_command(label="Redo", command=lambda: self.invoke("redo"))
+        edit_menu.add_separator()
+        edit_menu.add_command(label="History Memory", command=self.show_history_stats)
+
+        view_menu = tk.Menu(menu_bar, tearoff=0)
+        menu_bar.add_cascade(label="View", menu=view_menu)
+
+        self.overlay_var = tk.BooleanVar(value=False)
+        view_menu.add_checkbutton(label="Performance Overlay", variable=self.overlay_var,
+                                  command=lambda: self.set_overlay(self.overlay_var.get()))
+        view_menu.add_command(label="Export Trace...", command=self.export_trace)
+        view_menu.add_separator()
+        self.tiles_var = tk.BooleanVar(value=False)
+        view_menu.add_checkbutton(label="Raster Tiles", variable=self.tiles_var,
+                                  command=lambda: self.set_tiles(self.tiles_var.get()))
+        view_menu.add_separator()
+        self.snap_var = tk.BooleanVar(value=self.snapping)
+        view_menu.add_checkbutton(label="Snap to Points", variable=self.snap_var,
+                                  command=lambda: self.invoke("set_snapping", self.snap_var.get()))
 
     def create_toolbar_buttons(self):
         color_button = ttk.Button(self.toolbar, text="Color", command=self.choose_color)
@@ -276,64 +233,64 @@ class DrawingApp:
         ]
 
         for symbol, shape_class, description in shapes:
-            button = ttk.Button(self.toolbar, text=symbol, command=lambda cls=shape_class, msg=description: self.set_shape(cls, msg))
+            button = ttk.Button(self.toolbar, text=symbol, command=lambda cls=shape_class, msg=description: self.invoke("set_shape", cls, msg))
             button.pack(side=tk.LEFT)
-        select_button = ttk.Button(self.toolbar, text="Select/Move", command=lambda:self.set_select_mode("Select/Move Mode"))
+        select_button = ttk.Button(self.toolbar, text="Select/Move", command=lambda:self.invoke("set_select_mode", "Select/Move Mode"))
         select_button.pack(side=tk.LEFT)
-        group_button = ttk.Button(self.toolbar, text="Group", command=lambda:self.group_shapes("Group selected shapes"))
+        group_button = ttk.Button(self.toolbar, text="Group", command=lambda:self.invoke("group_shapes", "Group selected shapes"))
         group_button.pack(side=tk.LEFT)
 
-        ungroup_button = ttk.Button(self.toolbar, text="Ungroup", command=lambda:self.ungroup_shapes("Ungroup selected shapes"))
+        ungroup_button = ttk.Button(self.toolbar, text="Ungroup", command=lambda:self.invoke("ungroup_shapes", "Ungroup selected shapes"))
         ungroup_button.pack(side=tk.LEFT)
-        copy_button = ttk.Button(self.toolbar, text="Copy", command=lambda:self.copy_shapes("Copy selected shapes"))
+        copy_button = ttk.Button(self.toolbar, text="Copy", command=lambda:self.invoke("copy_shapes", "Copy selected shapes"))
         copy_button.pack(side=tk.LEFT)
-        cut_button = ttk.Button(self.toolbar, text="Cut", command=lambda:self.cut_shapes("Cut selected shapes"))
+        cut_button = ttk.Button(self.toolbar, text="Cut", command=lambda:self.invoke("cut_shapes", "Cut selected shapes"))
         cut_button.pack(side=tk.LEFT)  
-        paste_button = ttk.Button(self.toolbar, text="Paste", command=lambda:self.start_paste_mode("Paste copied shapes"))
+        paste_button = ttk.Button(self.toolbar, text="Paste", command=lambda:self.invoke("start_paste_mode", "Paste copied shapes"))
         paste_button.pack(side=tk.LEFT)
-        delete_button = ttk.Button(self.toolbar, text="Delete", command=lambda:self.delete_shapes("Delete selected shapes"))
+        delete_button = ttk.Button(self.toolbar, text="Delete", command=lambda:self.invoke("delete_shapes", "Delete selected shapes"))
         delete_button.pack(side=tk.LEFT)
 
-        undo_button = ttk.Button(self.toolbar, text="Undo", command=lambda:self.undo("Undo last action"))
+        undo_button = ttk.Button(self.toolbar, text="Undo", command=lambda:self.invoke("undo", "Undo last action"))
         undo_button.pack(side=tk.LEFT)
-        redo_button = ttk.Button(self.toolbar, text="Redo", command=lambda:self.redo("Redo last action"))
+        redo_button = ttk.Button(self.toolbar, text="Redo", command=lambda:self.invoke("redo", "Redo last action"))
         redo_button.pack(side=tk.LEFT)
 
     # is clicked other buttons while drawing polygon, stop it.
     def stop_drawing_polygon(self):
         self.selected_shape_class = None
-        if self.current_drawing_shape and len(self.current_drawing_shape.points) > 1:
-            self.current_drawing_shape.draw(self.canvas)
+        if self.current_drawing_shape and self.current_drawing_shape.point_count() > 1:
+            self.refresh_shape(self.current_drawing_shape)
         self.current_drawing_shape = None
+        self.mark_snap(None)
 
     def update_status_bar(self, message):
         """Update the status bar with a given message."""
-        self.status_bar.config(text=message)
+        self.status = message
+        if self.status_bar is not None:
+            self.status_bar.config(text=message)
     def delete_shapes(self, event=None):
-        self.save_state()
         """Delete the selected shapes or groups."""
         self.stop_drawing_polygon()
         if self.active_shapes:
-            for shape in self.active_shapes:
-                if isinstance(shape, Group):  # If it's a group, remove all shapes in it
-                    self.groups.remove(shape)
-                    self.shapes.remove(shape)
-                else:
-                    self.shapes.remove(shape)
+            self.history.execute(RemoveShapes(self.active_shapes), self)
             self.active_shapes.clear()  # Clear the active selection after deletion
-        self.redraw_all()
+        self.update_highlights()
             
     def set_select_mode(self,status_message):
         self.stop_drawing_polygon()
         self.selected_shape_class = None  # Disable drawing mode
         self.current_drawing_shape = None  # Clear current drawing shape
         self.update_status_bar(status_message)
-        self.redraw_all()
+        self.update_highlights()
 
     def choose_color(self):
         color = colorchooser.askcolor()[1]
         if color:
-            self.color = color
+            self.invoke("set_color", color)
+
+    def set_color(self, color):
+        self.color = color
 
     def set_shape(self, shape_class, status_message):
         self.selected_shape_class = shape_class
@@ -342,29 +299,172 @@ class DrawingApp:
         self.current_drawing_shape = None  # Exit Drawing Mode if new shape is selected
         self.active_shapes = []  # Clear active shapes when switching to drawing mode
         self.update_status_bar(status_message)
+        self.update_highlights()
+    # Mice report motion faster than a big drawing can be redrawn, and Tk would queue
+    # the events up, so the drawing lags behind the mouse. Motion handlers therefore
+    # only note what happened; the work runs once per frame, with the latest event,
+    # at most every frame_ms. Discrete events (clicks, releases, undo) run the pending
+    # frame first, so they see the motion that came before them.
+    def schedule(self, callback, *args):
+        """Run callback(*args) in the next frame, replacing what it was scheduled with before."""
+        self.pending[callback] = args
+        if self.frame_job is None:
+            wait = self.last_frame + self.frame_ms / 1000 - time.perf_counter()
+            if wait > 0:
+                self.frame_job = self.root.after(math.ceil(wait * 1000), self.frame_due)
+            else:
+                self.frame_job = self.root.after_idle(self.frame_due)
+
+    def frame_due(self):
+        self.frame_job = None
+        if self.recorder is not None:  # how motion was split into frames decides where float moves end up
+            self.recorder.frame()
+        self.run_frame()
+
+    def run_frame(self):
+        """Do the pending work now."""
+        if self.frame_job is not None:
+            self.root.after_cancel(self.frame_job)
+            self.frame_job = None
+        if not self.pending:
+            return
+        self.last_frame = time.perf_counter()
+        pending, self.pending = self.pending, {}
+        for callback, args in pending.items():
+            callback(*args)
+
+    def coalesced(self, handler):
+        """Wrap a motion handler so it runs once per frame, with the latest event."""
+        return lambda event: self.schedule(handler, event)
+
+    def drag_motion(self, event):
+        """<B1-Motion>: like coalesced(perform_action), except that freehand strokes keep every sample."""
+        if isinstance(self.current_drawing_shape, Freehand):
+            self.stroke_buffer.append((event.x, event.y))
+            self.schedule(self.capture_stroke)
+        else:
+            self.schedule(self.perform_action, event)
+
+    def capture_stroke(self):
+        """Add the buffered samples to the freehand stroke and draw the new part as one line."""
+        shape, samples = self.current_drawing_shape, self.stroke_buffer
+        self.stroke_buffer = []
+        if not isinstance(shape, Freehand) or not samples:
+            return
+        start = len(shape.coords) - 2  # the new part continues from the last kept point
+        for x, y in samples:
+            shape.capture(x, y, self.stroke_tolerance / 2)
+        self.stroke_samples += len(samples)
+        # end_action replaces these pieces with a single line
+        if len(shape.coords) - start > 2:
+            self.items[shape].append(self.renderer.polyline(shape.coords[start:].tolist(), color=shape.color))
+
+    # The canvas shows the document through self.view. Handlers of drawing events get
+    # document coordinates, so hit tests and new shapes don't care about pan and zoom;
+    # only the shapes whose box is on screen have canvas items.
+    def bind_canvas(self, sequence, handler):
+        """Bind a canvas mouse event to a handler that works in document coordinates."""
+        self.bind_event(sequence, lambda event: handler(self.document_event(event)), self.canvas)
+
+    def bind_event(self, sequence, handler, widget=None):
+        """Route an event sequence to handler, through dispatch; binding again replaces the handler.
+
+        Without a widget (headless), the handler can still be reached through dispatch,
+        which is how recorded sessions are replayed.
+        """
+        if sequence not in self.bindings and widget is not None:
+            widget.bind(sequence, lambda event: self.dispatch(sequence, event))
+        self.bindings[sequence] = handler
+
+    def dispatch(self, sequence, event):
+        """Hand an event, in screen pixels like Tk's, to the handler bound to its sequence."""
+        if self.recorder is not None:
+            self.recorder.event(sequence, event)
+        return self.bindings[sequence](event)
+
+    def invoke(self, name, *args):
+        """Run a toolbar or menu action, the method `name`, where a recording can see it."""
+        if self.recorder is not None:
+            self.recorder.command(name, args)
+        return getattr(self, name)(*args)
+
+    def document_event(self, event):
+        x, y = self.view.to_document(event.x, event.y)
+        # whole numbers stay ints, so shapes drawn at 100% are saved the same as before
+        x, y = int(x) if x.is_integer() else x, int(y) if y.is_integer() else y
+        self.pointer = (x, y)
+        return SimpleNamespace(x=x, y=y, state=event.state)
+
+    def on_screen(self, shape):
+        return self.view.shows(shape.bbox(), self.cull_margin)
+
+    def visible_shapes(self):
+        """The shapes on screen, bottom to top."""
+        shapes = self.index.query(*self.view.visible(self.cull_margin))
+        shapes.sort(key=self.index.order.__getitem__)
+        return shapes
+
+    def pan_view(self, dx, dy):
+        """Scroll by (dx, dy) screen pixels."""
+        self.view.pan(dx, dy)
+        self.redraw_all()
+
+    def zoom_view(self, factor, x, y):
+        """Zoom by `factor` around the screen point (x, y)."""
+        self.view.zoom(factor, x, y)
         self.redraw_all()
+        self.update_status_bar(f"Zoom {self.view.scale:.0%}")
+
+    def start_pan(self, event):
+        self.pan_start = (event.x, event.y)
+
+    def pan(self, event):
+        if self.pan_start is not None:
+            self.view.pan(event.x - self.pan_start[0], event.y - self.pan_start[1])
+            self.pan_start = (event.x, event.y)
+            self.schedule(self.redraw_all)
+
+    def wheel_zoom(self, event):
+        zoom_in = event.num == 4 or getattr(event, "delta", 0) > 0
+        self.view.zoom(self.zoom_step if zoom_in else 1 / self.zoom_step, event.x, event.y)
+        self.schedule(self.redraw_all)
+        self.update_status_bar(f"Zoom {self.view.scale:.0%}")
+
+    def canvas_resized(self, event):
+        if (event.width, event.height) != (self.view.width, self.view.height):
+            self.view.resize(event.width, event.height)
+            self.schedule(self.redraw_all)
+
+    def reset_view(self, event=None):
+        self.view.reset()
+        self.redraw_all()
+        self.update_status_bar("Zoom 100%")
+
     def mouse_move(self, event):
-        if not self.selected_shape_class or not self.current_drawing_shape:
+        if not self.selected_shape_class or issubclass(self.selected_shape_class, Freehand):
+            self.mark_snap(None)
             return
 
-        x, y = event.x, event.y
-        self.current_drawing_shape.preview(self.canvas, x, y)
+        # shows where a click would snap to, before the shape is started too
+        x, y = self.snap(event.x, event.y, {self.current_drawing_shape})
+        if self.current_drawing_shape:
+            self.current_drawing_shape.preview(self.renderer, x, y)
     def start_action(self, event):
-        self.save_state()
+        self.run_frame()
         ctrl_pressed = event.state & 0x4  # Check if Ctrl is pressed
 
         if self.selected_shape_class is None:  # Selection/Move Mode
             
-            for shape in reversed(self.shapes):  # Check for shape under click
-                if shape.contains_point(event.x, event.y):
-                    self.clicked_shape = shape
-                    break
+            # Check for shape under click
+            self.clicked_shape = self.shape_at(event.x, event.y)
 
             if ctrl_pressed:  # Multiple selection
                 if self.clicked_shape:
                     #here only append inactive shape, not remove active one until we know it is a click, first q
                     self.drag_start = (event.x, event.y)
-                self.redraw_all()
+                    self.drag_origin = self.drag_start
+                else:  # a rubber band adding to the selection
+                    self.marquee = (event.x, event.y)
             # no ctrl mode, can deselect all, or  select single(if click) , or move multiple(if drag), we know when step 2
             else:  # Single selection or drag, we dont know 
                 if self.clicked_shape:
@@ -372,357 +472,990 @@ class DrawingApp:
                         self.active_shapes = [self.clicked_shape]  # Make only the clicked shape active
                     # else click shape is one of the active shapes, might move multiple/ might select single, see on step 2
                     self.drag_start = (event.x, event.y)
+                    self.drag_origin = self.drag_start
                 # click blanck space
                 else:
                     self.active_shapes = []  # Deselect all if clicking empty space
-                self.redraw_all()
+                    self.marquee = (event.x, event.y)  # and maybe drag a rubber band
+                self.update_highlights()
             self.is_dragging = False  # Reset dragging flag
         else:  # Drawing Mode
             #Polygon
             if self.selected_shape_class == Polygon:
-                x, y = event.x, event.y
+                x, y = self.snap(event.x, event.y, {self.current_drawing_shape})
                 # Initialize a new polygon if the current one is None
                 if self.current_drawing_shape is None:
                     self.current_drawing_shape = Polygon(color=self.color)
-                    self.shapes.append(self.current_drawing_shape)
+                    self.history.execute(AddShapes([self.current_drawing_shape]), self)
+                polygon = self.current_drawing_shape
                 # First point of the polygon
-                if not self.current_drawing_shape.points:
+                if not self.current_drawing_shape.coords:
                     self.current_drawing_shape.add_point(x, y)
                 else:
                     # Check if the click is near the initial point
-                    initial_x, initial_y = self.current_drawing_shape.points[0]
-                    if self.distance(x, y, initial_x, initial_y) <= self.tolerance:
+                    initial_x, initial_y = self.current_drawing_shape.coords[0], self.current_drawing_shape.coords[1]
+                    if self.distance(x, y, initial_x, initial_y) <= self.tolerance / self.view.scale:
                         # Snap to the initial point to close the polygon
                         self.current_drawing_shape.add_point(initial_x, initial_y)
-                        self.current_drawing_shape.draw(self.canvas)
                         self.current_drawing_shape = None  # Mark polygon as finished
                     else:
                         # Add a new point
                         self.current_drawing_shape.add_point(x, y)
 
-                # Draw the polygon after each point addition
-                if self.current_drawing_shape:
-                    self.current_drawing_shape.draw(self.canvas)
+                # Update the polygon's line after each point addition
+                self.refresh_shape(polygon)
+                self.reshaped(polygon)
             #Freehand
             elif issubclass(self.selected_shape_class, IrRegularShape):
                 if self.current_drawing_shape is None:
                     self.current_drawing_shape = self.selected_shape_class(color=self.color)
-                    self.shapes.append(self.current_drawing_shape)
-                self.current_drawing_shape.points.append((event.x, event.y))
-                self.redraw_all()
+                    self.history.execute(AddShapes([self.current_drawing_shape]), self)
+                    self.stroke_samples = 0
+                self.current_drawing_shape.add_point(event.x, event.y)
+                self.stroke_samples += 1
             elif issubclass(self.selected_shape_class, RegularShape):
+                point = self.snap(event.x, event.y)
                 self.current_drawing_shape = self.selected_shape_class(
-                    start_point=(event.x, event.y),
-                    end_point=(event.x, event.y),
+                    start_point=point,
+                    end_point=point,
                     color=self.color
                 )
-                self.shapes.append(self.current_drawing_shape)
+                self.history.execute(AddShapes([self.current_drawing_shape]), self)
+
+    def shape_at(self, x, y):
+        """The topmost shape containing (x, y), or None. Only the shapes near it are tested."""
+        pixel = 1 / self.view.scale  # the margins are in screen pixels
+        for shape in self.index.hits(x, y, self.hit_margin * pixel):
+            if shape.contains_point(x, y, pixel):
+                return shape
+        return None
+
+    # Drawing and dragging snap to the vertices, line and stroke ends, rectangle corners
+    # and ellipse centers of the shapes (Shape.snap_points), looked up in self.snaps.
+    # The shapes being drawn or dragged are left out, so they don't snap to themselves.
+    def snap(self, x, y, exclude=()):
+        """The snap point within snap_radius screen pixels of (x, y), or (x, y) if there is none."""
+        found = None
+        if self.snapping:
+            found = self.snaps.nearest(x, y, self.snap_radius / self.view.scale, exclude)
+        self.mark_snap(found)
+        return found or (x, y)
+
+    def drag_snapped(self, x, y):
+        """Where a drag to (x, y) goes: shifted so the dragged shape's handle lands on a snap point, if one is near."""
+        if not self.snapping:
+            return x, y
+        ox, oy = self.drag_origin
+        if self.drag_handle is None:  # the first motion of the drag, before anything moved
+            points = self.clicked_shape.snap_points()
+            self.drag_handle = min(zip(points[0::2], points[1::2]), default=self.drag_origin,
+                                   key=lambda point: (point[0] - ox) ** 2 + (point[1] - oy) ** 2)
+        hx, hy = self.drag_handle
+        found = self.snap(hx + x - ox, hy + y - oy, set(self.active_shapes))
+        if found == (hx + x - ox, hy + y - oy):
+            return x, y
+        return ox + found[0] - hx, oy + found[1] - hy
+
+    def mark_snap(self, point):
+        """Mark the point snapped to, or take the mark away if point is None."""
+        if point is None:
+            if self.snap_marker is not None:
+                self.renderer.delete(self.snap_marker)
+                self.snap_marker = None
+            return
+        half = 4 / self.view.scale  # screen pixels
+        box = [point[0] - half, point[1] - half, point[0] + half, point[1] + half]
+        if self.snap_marker is None:
+            self.snap_marker = self.renderer.rectangle(*box, outline="blue", tags=("snap",))
+        else:
+            self.renderer.coords(self.snap_marker, box)
+
+    def set_snapping(self, on):
+        self.snapping = on
+        if self.snap_var is not None:
+            self.snap_var.set(on)
+        if not on:
+            self.mark_snap(None)
 
     def perform_action(self, event):
         ctrl_pressed = event.state & 0x4  # Check if Ctrl is pressed
-        if self.active_shapes and self.selected_shape_class is None:  # Move selected shapes
+        if self.marquee is not None:  # Rubber-band selection
+            self.drag_marquee(event.x, event.y)
+        elif self.active_shapes and self.selected_shape_class is None:  # Move selected shapes
             #drag_start meant clicked on shape, so no need to re-check if self.clicked_shape
             if self.drag_start:
                 dx = event.x - self.drag_start[0]
                 dy = event.y - self.drag_start[1]
                 # is drag, not click, so we move shapes
-                if abs(dx) > self.THRESHOLD or abs(dy) > self.THRESHOLD:  # Check if movement exceeds the threshold
+                threshold = self.THRESHOLD / self.view.scale
+                if abs(dx) > threshold or abs(dy) > threshold:  # Check if movement exceeds the threshold
                     self.is_dragging = True  # Set dragging flag
                     if not ctrl_pressed:  # If Ctrl is not pressed, if we move a inactive shape, we move it single, but if we move a active shape, we move multiple
                         if self.clicked_shape not in self.active_shapes:
                             self.active_shapes = [self.clicked_shape]
+                            self.update_highlights()
                         #else, we move multiple shapes
                     else:  # If Ctrl is pressed, and the click shape not active, we make it active
                         if self.clicked_shape not in self.active_shapes:
                             self.active_shapes.append(self.clicked_shape)
-                    for shape in self.active_shapes:
-                        shape.move(dx, dy)
-                    self.drag_start = (event.x, event.y)  # Update drag start
-                    self.redraw_all()
+                            self.update_highlights()
+                    self.drag_to(event.x, event.y)
                 #drag continue
                 elif self.is_dragging:
-                    for shape in self.active_shapes:
-                        shape.move(dx, dy)
-                    self.drag_start = (event.x, event.y)  # Update drag start
-                    self.redraw_all()
+                    self.drag_to(event.x, event.y)
         elif self.current_drawing_shape:  # Drawing Mode
-            if isinstance(self.current_drawing_shape, RegularShape):
-                self.current_drawing_shape.end_point = (event.x, event.y)
-                self.redraw_all()
-            elif isinstance(self.current_drawing_shape, Freehand):
-                self.current_drawing_shape.points.append((event.x, event.y))
-                self.redraw_all()
-
-
+            shape = self.current_drawing_shape
+            if isinstance(shape, RegularShape):
+                shape.end_point = self.snap(event.x, event.y, {shape})
+                self.refresh_shape(shape)
+            elif isinstance(shape, Freehand):
+                self.stroke_buffer.append((event.x, event.y))
+                self.capture_stroke()
+
+    def drag_to(self, x, y):
+        """Move the dragged shapes on to (x, y), or to where snapping puts them."""
+        x, y = self.drag_snapped(x, y)
+        if (x, y) != self.drag_start:
+            self.move_shapes(self.active_shapes, x - self.drag_start[0], y - self.drag_start[1])
+            self.drag_start = (x, y)  # Update drag start
+
+    # Dragging from empty space in select mode stretches a rubber band. Dragged to the
+    # right it selects the shapes entirely inside it, to the left (drawn dashed) the
+    # shapes it touches as well; with Ctrl they are added to the selection. Either way
+    # the index finds the shapes whose boxes overlap it, and only those are looked at.
+    def drag_marquee(self, x, y):
+        x0, y0 = self.marquee
+        crossing = x < x0
+        if self.marquee_item is not None and crossing != self.marquee_crossing:
+            self.renderer.delete(self.marquee_item)  # the dash can't be changed through coords
+            self.marquee_item = None
+        if self.marquee_item is None:
+            self.marquee_item = self.renderer.rectangle(x0, y0, x, y, outline="blue",
+                                                        dash=(4, 2) if crossing else None, tags=("marquee",))
+            self.marquee_crossing = crossing
+        else:
+            self.renderer.coords(self.marquee_item, [x0, y0, x, y])
+
+    def end_marquee(self, x, y, add):
+        """Select what the rubber band from self.marquee to (x, y) holds, or crosses."""
+        x0, y0 = self.marquee
+        self.marquee = None
+        if self.marquee_item is not None:
+            self.renderer.delete(self.marquee_item)
+            self.marquee_item = None
+        threshold = self.THRESHOLD / self.view.scale
+        if abs(x - x0) <= threshold and abs(y - y0) <= threshold:
+            return  # a click on empty space, which already deselected
+        found = self.shapes_in((min(x0, x), min(y0, y), max(x0, x), max(y0, y)), crossing=x < x0)
+        if add:
+            selected = set(self.active_shapes)
+            self.active_shapes += [shape for shape in found if shape not in selected]
+        else:
+            self.active_shapes = found
+        self.update_highlights()
+        self.update_status_bar(f"Selected {len(self.active_shapes)} shapes")
+
+    def shapes_in(self, box, crossing=False):
+        """The shapes entirely inside box, bottom to top; with crossing, also those that touch it."""
+        x1, y1, x2, y2 = box
+        boxes = self.index.boxes
+        found = []
+        for shape in self.index.query(x1, y1, x2, y2):
+            b = boxes[shape]
+            if (x1 <= b[0] and y1 <= b[1] and b[2] <= x2 and b[3] <= y2) or (crossing and shape.intersects(box)):
+                found.append(shape)
+        found.sort(key=self.index.order.__getitem__)
+        return found
 
     def finish_polygon(self, event):
+        self.run_frame()
         if not self.selected_shape_class or not self.current_drawing_shape:
             return
 
         # right click to finish the open polygon
-        x, y = event.x, event.y
+        x, y = self.snap(event.x, event.y, {self.current_drawing_shape})
         self.current_drawing_shape.add_point(x, y)
-        self.current_drawing_shape.draw(self.canvas)
+        self.refresh_shape(self.current_drawing_shape)
+        self.reshaped(self.current_drawing_shape)
         self.current_drawing_shape = None  # Start a new polygon on the next click
 
     def end_action(self, event):
+        self.run_frame()
         ctrl_pressed = event.state & 0x4  # Check if Ctrl is pressed
-        if self.selected_shape_class is None and not self.is_dragging:  # Move/select mode. and If it's a click, not a drag
+        if self.marquee is not None:
+            self.end_marquee(event.x, event.y, ctrl_pressed)
+        elif self.selected_shape_class is None and self.is_dragging:  # record the whole drag as one move
+            dx = self.drag_start[0] - self.drag_origin[0]
+            dy = self.drag_start[1] - self.drag_origin[1]
+            self.history.record(MoveShapes(self.active_shapes, dx, dy))
+            for shape in self.active_shapes:  # moves while dragging were only noted
+                shape.settle()
+            self.mark_snap(None)
+        elif self.selected_shape_class is None:  # Move/select mode. and If it's a click, not a drag  # Move/select mode. and If it's a click, not a drag
             if ctrl_pressed:                 
                 if self.clicked_shape:
                     if self.clicked_shape not in self.active_shapes: 
                         self.active_shapes.append(self.clicked_shape)
                     elif self.clicked_shape in self.active_shapes:  
                         self.active_shapes.remove(self.clicked_shape)
-                self.redraw_all()
+                self.update_highlights()
             # no control mode, single click, only select the clicked shape
             else:
                 if self.clicked_shape:
                     self.active_shapes = [self.clicked_shape]  # Make only the clicked shape active
-                self.redraw_all()
+                self.update_highlights()
         elif self.current_drawing_shape:  # Finalize drawing shapes
             if isinstance(self.current_drawing_shape, Freehand):
-                self.current_drawing_shape.points.append((event.x, event.y))
-                self.current_drawing_shape.draw(self.canvas)
+                stroke = self.current_drawing_shape
+                self.stroke_samples += 1
+                if stroke.point_count() == 1:  # a plain click still leaves a dot
+                    stroke.add_point(event.x, event.y)
+                else:
+                    stroke.capture(event.x, event.y, self.stroke_tolerance / 2)
+                kept = stroke.point_count()
+                stroke.simplify(self.stroke_tolerance / 2)
+                self.update_status_bar(f"Freehand: {self.stroke_samples} samples, "
+                                       f"{kept} after capture, {stroke.point_count()} after simplifying")
+                self.draw_shape(stroke)  # swap the stroke segments for one line
+                self.reshaped(stroke)
                 self.current_drawing_shape = None
             elif isinstance(self.current_drawing_shape, RegularShape):
-                self.current_drawing_shape.end_point = (event.x, event.y)
-                self.current_drawing_shape.draw(self.canvas)
+                self.current_drawing_shape.end_point = self.snap(event.x, event.y, {self.current_drawing_shape})
+                self.refresh_shape(self.current_drawing_shape)
+                self.reshaped(self.current_drawing_shape)
                 self.current_drawing_shape = None
+                self.mark_snap(None)
         self.clicked_shape = None  # Reset clicked shape
+        self.drag_handle = None
         self.is_dragging=False
 
+    # Every top-level shape keeps its canvas items between events; self.items maps it
+    # to their ids and self.highlights to the ids of its selection outline. Edits touch
+    # only those items, by id: Tk looks ids up in a hash table but has to scan every
+    # item on the canvas to resolve a tag. redraw_all is left for the cases where the
+    # whole document is replaced.
+    def draw_shape(self, shape):
+        """(Re)create the canvas items of a top-level shape."""
+        ids = self.items.pop(shape, None)
+        if ids:
+            self.renderer.delete(*ids)
+        shape.draw(self.renderer)
+        self.items[shape] = shape.item_ids()
+
+    def refresh_shape(self, shape):
+        """Update a shape being drawn in place."""
+        shape.refresh(self.renderer)
+        self.items[shape] = shape.item_ids()
+
+    def erase_shape(self, shape):
+        """Remove a top-level shape's items, including its highlight."""
+        ids = self.items.pop(shape, []) + self.highlights.pop(shape, [])
+        if ids:
+            self.renderer.delete(*ids)
+
+    # Document edits. These keep self.shapes, self.groups, the spatial index, the
+    # canvas items and the journal in step; undo commands are built on top of them.
+    def add_shape(self, shape):
+        """Put a shape on top of the document."""
+        self.shapes.append(shape)
+        if isinstance(shape, Group):
+            self.groups.append(shape)
+        self.index.insert(shape, shape.bbox())
+        self.snaps.update(shape)
+        if self.on_screen(shape):
+            self.draw_shape(shape)
+        if self.tiles is not None:
+            self.invalidate_tiles(shape, shape.bbox())
+        self.journal.added(shape)
+
+    def insert_shape(self, position, shape):
+        """Put a shape back at a given stacking position, e.g. when undoing a delete."""
+        if position >= len(self.shapes):
+            self.add_shape(shape)
+            return
+        above = self.shapes[position]
+        below = self.shapes[position - 1] if position > 0 else None
+        self.shapes.insert(position, shape)
+        if isinstance(shape, Group):
+            self.groups.append(shape)
+        self.index.insert_between(shape, shape.bbox(), below, above)
+        self.snaps.update(shape)
+        self.journal.added(shape, position)
+        if self.tiles is not None:
+            self.invalidate_tiles(shape, shape.bbox())
+        if not self.on_screen(shape):
+            return
+        self.draw_shape(shape)
+        # slide the items under those of the nearest shape above that is drawn
+        anchor = next((self.items[above] for above in islice(self.shapes, position + 1, None)
+                       if self.items.get(above)), None)
+        if anchor:
+            for item in self.items[shape]:
+                self.renderer.lower(item, anchor[0])
+
+    def remove_shape(self, shape, position=None):
+        if position is None:
+            # usually the shape just drawn or pasted, so look at the top first
+            position = len(self.shapes) - 1 if self.shapes[-1] is shape else self.shapes.index(shape)
+        del self.shapes[position]
+        if isinstance(shape, Group) and shape in self.groups:
+            self.groups.remove(shape)
+        if self.tiles is not None:
+            self.invalidate_tiles(shape, self.index.boxes.get(shape))
+        self.index.remove(shape)
+        self.snaps.remove(shape)
+        self.erase_shape(shape)
+        self.journal.removed(shape, position)
+
+    def reshaped(self, shape):
+        """Catch up with a shape whose geometry changed while it was drawn."""
+        if self.tiles is not None:
+            self.invalidate_tiles(shape, self.index.boxes.get(shape))
+            self.invalidate_tiles(shape, shape.bbox())
+        self.index.update(shape, shape.bbox())
+        self.snaps.update(shape)
+        self.journal.changed(shape)
+
+    def set_shapes(self, shapes):
+        """Replace the whole document, e.g. on load."""
+        self.shapes = shapes
+        if self.journal.recording and not self.journal.follows(shapes):
+            self.journal.start(self.journal.untitled(), shapes)  # a new document, as far as the journal knows
+        self.groups = [shape for shape in shapes if isinstance(shape, Group)]
+        self.index.rebuild(shapes)
+        self.snaps.rebuild(shapes)
+        if self.tiles is not None:
+            self.tiles.clear()
+        self.redraw_all()
+
+    def move_shapes(self, shapes, dx, dy):
+        """Move shapes and shift their existing canvas items instead of redrawing them."""
+        entered = False  # whether a shape without items came on screen
+        outline = False  # whether one of those is selected and needs its outline, with tiles on
+        tiles = self.tiles
+        for shape in shapes:
+            if tiles is not None:
+                self.invalidate_tiles(shape, shape.bbox())
+            shape.move(dx, dy)
+            items = self.items.get(shape)
+            if tiles is not None:
+                self.invalidate_tiles(shape, shape.bbox())
+                if items is None and self.on_screen(shape):  # out of the tiles until they catch up
+                    self.draw_shape(shape)
+                    items = ()
+                    outline = outline or shape not in self.highlights
+            elif items is None:
+                entered = entered or self.on_screen(shape)
+            for item in items or ():
+                self.renderer.move(item, dx, dy)
+            for item in self.highlights.get(shape, ()):
+                self.renderer.move(item, dx, dy)
+            self.index.move(shape, dx, dy)
+            self.snaps.update(shape)
+        self.journal.moved(shapes, dx, dy)
+        if entered:
+            self.redraw_all()
+        elif outline:
+            self.update_highlights()
+
+    def update_highlights(self):
+        """Bring the selection outlines in line with active_shapes.
+
+        Only the outlines of shapes that left or joined the selection are deleted or
+        drawn, so Ctrl-clicking one more shape into a selection of thousands draws one,
+        and like the shapes, only those on screen are outlined. Outlines follow their
+        shapes through move_shapes and go with erase_shape; shapes coming on screen get
+        theirs from redraw_all, or from move_shapes.
+        """
+        selected = set(self.active_shapes)
+        for shape in [shape for shape in self.highlights if shape not in selected]:
+            ids = self.highlights.pop(shape)
+            if ids:
+                self.renderer.delete(*ids)
+        # Highlight active shapes (can be in a group or not)
+        for shape in self.active_shapes:
+            if shape not in self.highlights and self.on_screen(shape):
+                self.highlights[shape] = ids = []
+                self.draw_highlighted_shape(shape, ids)
+        if self.tiles is not None:  # selected shapes leave the tiles, deselected ones go back
+            self.schedule(self.update_tiles)
+
+    def draw_highlighted_shape(self, shape, ids):
+        """Outline a selected shape, a group as a whole, collecting the new item ids."""
+        if isinstance(shape, IrRegularShape):
+            # Highlight IrRegularShapes with a dashed outline
+            ids.append(self.renderer.polygon(
+                shape.detail(self.renderer.tolerance).tolist(),
+                outline="red", dash=(5, 2), width=2,
+                fill=None  # Ensure no fill to only show outline
+            ))
+        elif isinstance(shape, RegularShape):
+            # Highlight RegularShapes with a dashed rectangle
+            x1, y1, x2, y2 = shape.bbox()
+            ids.append(self.renderer.rectangle(
+                x1, y1, x2, y2,
+                outline="red", dash=(5, 2), width=2
+            ))
+        elif isinstance(shape, Group):
+            # One outline around the whole group, however many shapes it holds
+            x1, y1, x2, y2 = shape.bbox()
+            ids.append(self.renderer.rectangle(
+                x1, y1, x2, y2,
+                outline="red", dash=(5, 2), width=2
+            ))
+
     def redraw_all(self):
+        """Redraw the view from scratch, e.g. after a load, pan or zoom. Costs as much as the shapes on screen."""
         # Clear the canvas
-        self.canvas.delete("all")
+        self.renderer.clear()
+        self.items, self.highlights, self.preview_items = {}, {}, []
+        self.snap_marker = self.marquee_item = None
+        if isinstance(self.current_drawing_shape, Polygon):
+            self.current_drawing_shape.preview_id = None  # went with the rest
+
+        tiles = self.tiles
+        if tiles is not None:
+            tiles.reset(self.view.scale)
+            visible = self.view.visible()
+            for key in tiles.keys(visible):
+                tile = tiles.tiles.get(key)
+                if tile is not None and tile.rendered == tile.version:
+                    self.show_tile(key)
+            self.schedule(self.update_tiles)
+        # Draw the shapes on screen normally, those the tiles show aside
+        for shape in self.visible_shapes():
+            if tiles is None or shape in tiles.excluded or not tiles.covers(self.tile_box(shape.bbox()), visible):
+                shape.draw(self.renderer)
+                self.items[shape] = shape.item_ids()
+
+        self.update_highlights()
+        if getattr(self, 'is_pasting', False) and self.paste_preview:
+            self.draw_dotted_outline(self.paste_preview)
+
+    # With raster tiles on, the shapes that aren't being edited are drawn into images
+    # (tiles.py) and only the selection and the shape being drawn keep canvas items,
+    # on top. Edits mark the tiles under the shapes they touch; update_tiles renders
+    # those again, and drops a shape's items once the tiles under it are up to date.
+    # Until then the items stand in for the tiles, so nothing blinks.
+    def set_tiles(self, on):
+        """Show the shapes not being edited as raster tiles, or every shape as canvas items."""
+        if on and self.tiles is None:
+            self.tiles = TileLayer(self.tile_size, self.tile_limit, self.tile_thread)
+        elif not on and self.tiles is not None:
+            self.tiles.close()
+            self.tiles = None
+            if self.tiles_job is not None:
+                self.root.after_cancel(self.tiles_job)
+                self.tiles_job = None
+        else:
+            return
+        if self.tiles_var is not None:
+            self.tiles_var.set(on)
+        self.redraw_all()
 
-        # Function to highlight shapes (including nested groups)
-        def draw_highlighted_shape(shape):
-            if isinstance(shape, IrRegularShape):
-                # Highlight IrRegularShapes with a dashed outline
-                self.canvas.create_polygon(
-                    *shape.flatten_points(),
-                    outline="red", dash=(5, 2), width=2,
-                    fill=""  # Ensure no fill to only show outline
-                )
-            elif isinstance(shape, RegularShape):
-                # Highlight RegularShapes with a dashed rectangle
-                x1, y1 = shape.start_point
-                x2, y2 = shape.end_point
-                self.canvas.create_rectangle(
-                    x1, y1, x2, y2,
-                    outline="red", dash=(5, 2), width=2
-                )
-            elif isinstance(shape, Group):
-                # Recursively highlight all shapes within the group
-                for sub_shape in shape.shapes:
-                    draw_highlighted_shape(sub_shape)
+    def tile_box(self, box):
+        """A shape's box grown by what its outline may stick out on screen."""
+        margin = self.cull_margin / self.view.scale
+        return box[0] - margin, box[1] - margin, box[2] + margin, box[3] + margin
 
-        # Draw all shapes normally
-        for shape in self.shapes:
-            shape.draw(self.canvas)
+    def invalidate_tiles(self, shape, box):
+        if box is not None and shape not in self.tiles.excluded:
+            self.tiles.invalidate(self.tile_box(box))
+        self.schedule(self.update_tiles)  # also when the shape is excluded: its edit may be over
 
-        # Highlight active shapes (can be in a group or not)
-        for shape in self.active_shapes:
-            draw_highlighted_shape(shape)
+    def update_tiles(self):
+        """Render the out of date tiles on screen, for up to a frame, and show those that are done."""
+        tiles = self.tiles
+        if tiles is None:
+            return
+        # shapes that started being edited leave the tiles, those that stopped go back in
+        live = set(self.active_shapes)
+        if self.current_drawing_shape is not None:
+            live.add(self.current_drawing_shape)
+        for shape in live ^ tiles.excluded:
+            box = shape.bbox()
+            if box is not None:
+                tiles.invalidate(self.tile_box(box))
+            if shape in live and shape not in self.items and shape in self.index and self.on_screen(shape):
+                self.draw_shape(shape)
+                outline = self.highlights.get(shape)
+                for item in self.items[shape] if outline else ():  # under its selection outline
+                    self.renderer.lower(item, outline[0])
+        tiles.excluded = live
+        visible = self.view.visible()
+        deadline = time.perf_counter() + self.frame_ms / 1000
+        more = False
+        for key in tiles.stale(visible):
+            shapes = [shape for shape in self.index.query(*self.tile_box(tiles.box(key))) if shape not in live]
+            shapes.sort(key=self.index.order.__getitem__)
+            tiles.render(key, shapes)
+            if time.perf_counter() > deadline:
+                more = True
+                break
+        updated = tiles.collect()
+        for key in updated:
+            self.show_tile(key)
+        for tile in tiles.evict():
+            if tile.item is not None:
+                self.renderer.delete(tile.item)
+        if updated:
+            for shape in [shape for shape in self.items if shape not in live]:
+                box = shape.bbox()
+                if box is not None and tiles.covers(self.tile_box(box), visible):
+                    self.renderer.delete(*self.items.pop(shape))
+        if more:
+            self.schedule(self.update_tiles)
+        elif tiles.in_flight and self.tiles_job is None:
+            self.tiles_job = self.root.after(self.frame_ms, self.tiles_rendered)
+
+    def tiles_rendered(self):
+        self.tiles_job = None
+        self.schedule(self.update_tiles)
+
+    def show_tile(self, key):
+        tile = self.tiles.tiles[key]
+        if tile.item is not None:
+            self.renderer.delete(tile.item)
+        x, y, _, _ = self.tiles.box(key)
+        tile.item = self.renderer.image(x, y, tile.image, tags=("tile",))
+        self.renderer.lower(tile.item)  # under every shape
 
     def group_shapes(self,status_message):
-        self.save_state()
         """Set the app to selection/move mode."""
         self.stop_drawing_polygon()
         self.selected_shape_class = None  # Disable drawing mode
         self.current_drawing_shape = None  # Clear current drawing shape
         if len(self.active_shapes) > 1:  # Can only group multiple shapes
-            group = Group(self.active_shapes)
-            self.groups.append(group)
-            for shape in self.active_shapes:
-                self.shapes.remove(shape)  # Remove individual shapes from canvas
-            self.shapes.append(group)  # Add group to canvas
+            group = Group(list(self.active_shapes))
+            # members leave the canvas and are redrawn as part of the group
+            self.history.execute(GroupShapes(group), self)
             self.active_shapes = [group]  # Make the group active
             self.update_status_bar(status_message)
-            self.redraw_all()
+            self.update_highlights()
 
     def ungroup_shapes(self,status_message):
-        self.save_state()
         """Set the app to selection/move mode."""
         self.stop_drawing_polygon()
         self.selected_shape_class = None  # Disable drawing mode
         self.current_drawing_shape = None  # Clear current drawing shape
         if len(self.active_shapes) == 1 and isinstance(self.active_shapes[0], Group):
             group = self.active_shapes[0]
-            self.shapes.remove(group)
-            for shape in group.shapes:
-                self.shapes.append(shape)  # Restore individual shapes to canvas
-            self.groups.remove(group)
-            self.active_shapes = group.shapes  # Select individual shapes
+            self.history.execute(UngroupShapes(group), self)  # Restore individual shapes to canvas
+            self.active_shapes = list(group.shapes)  # Select individual shapes
             self.update_status_bar(status_message)
-            self.redraw_all()
+            self.update_highlights()
     def cut_shapes(self, status_message, event=None):
-        self.save_state()
         """Cut the selected shapes: copy them to memory and delete them from the canvas."""
         if self.active_shapes:
             # Copy shapes to memory
-            self.copied_shapes = cp.deepcopy(self.active_shapes)
+            self.copied_shapes = [shape.clone() for shape in self.active_shapes]
             
             # Remove the shapes from the canvas
-            for shape in self.active_shapes:
-                if isinstance(shape, Group) and shape in self.groups:
-                    self.groups.remove(shape)  # If it's a group, remove from the groups list
-                if shape in self.shapes:
-                    self.shapes.remove(shape)  # Remove from the shapes list
+            self.history.execute(RemoveShapes(self.active_shapes), self)
             # Clear active selection
             self.active_shapes.clear()
             self.update_status_bar(status_message)
-            # Redraw the canvas to reflect the changes
-            self.redraw_all()
 
     def copy_shapes(self, event=None):
         """Copy the selected shapes."""
         if self.active_shapes:
-            self.copied_shapes = cp.deepcopy(self.active_shapes)  # Deep copy to avoid changes to original shapes
+            self.copied_shapes = [shape.clone() for shape in self.active_shapes]  # points are shared until edited
 
     def paste_shapes(self, event=None):
-        self.save_state()
         """Paste the copied shapes at the mouse location."""
         if hasattr(self, 'copied_shapes') and self.copied_shapes:
-            # Find the reference point (top-left corner of the copied shapes)
-            min_x, min_y = float('inf'), float('inf')
-
-            def get_min_coords(shape):
-                """Recursively calculate the minimum x and y coordinates for a shape or group."""
-                nonlocal min_x, min_y
-                if isinstance(shape, IrRegularShape):
-                    for x, y in shape.points:
-                        min_x = min(min_x, x)
-                        min_y = min(min_y, y)
-                elif isinstance(shape, RegularShape):
-                    min_x = min(min_x, shape.start_point[0], shape.end_point[0])
-                    min_y = min(min_y, shape.start_point[1], shape.end_point[1])
-                elif isinstance(shape, Group):
-                    for sub_shape in shape.shapes:
-                        get_min_coords(sub_shape)
-
-            # Iterate over all copied shapes to calculate the reference point
-            for shape in self.copied_shapes:
-                get_min_coords(shape)
-
-            # Get mouse position
-            mouse_x, mouse_y = self.canvas.winfo_pointerx() - self.canvas.winfo_rootx(), \
-                            self.canvas.winfo_pointery() - self.canvas.winfo_rooty()
+            # The reference point is the top-left corner of the copied shapes
+            min_x, min_y = self.anchor(self.copied_shapes)
+
+            # Get mouse position, as the canvas last saw it, so a replayed session pastes in the same place
+            if self.pointer is not None:
+                mouse_x, mouse_y = self.pointer
+            elif self.canvas is not None:
+                mouse_x, mouse_y = self.view.to_document(self.canvas.winfo_pointerx() - self.canvas.winfo_rootx(),
+                                                         self.canvas.winfo_pointery() - self.canvas.winfo_rooty())
+            else:  # headless, there is no mouse
+                mouse_x, mouse_y = self.view.to_document(0, 0)
 
             # Calculate offset to align the top-left corner with the mouse position
             dx, dy = mouse_x - min_x, mouse_y - min_y
 
             # Create new shapes by moving the copied shapes to the new location
-            new_shapes = cp.deepcopy(self.copied_shapes)
+            new_shapes = [shape.clone() for shape in self.copied_shapes]
             for shape in new_shapes:
                 shape.move(dx, dy)
-                self.shapes.append(shape)
+            self.history.execute(AddShapes(new_shapes), self)
 
-            # Redraw canvas
-            self.redraw_all()
+    def anchor(self, shapes):
+        """Top-left corner of the shapes. Their boxes are cached, so this is cheap enough for every mouse move."""
+        box = bounding_box(shapes)
+        return (box[0], box[1]) if box is not None else (0, 0)
 
     def start_paste_mode(self,status_message):
         """Activate paste mode where shapes follow the mouse until placed."""
         if hasattr(self, 'copied_shapes') and self.copied_shapes:
             self.is_pasting = True
-            self.paste_preview = cp.deepcopy(self.copied_shapes)  # Temporary copy for preview
-            self.canvas.bind("<Motion>", self.update_paste_preview)  # Follow mouse
-            self.canvas.bind("<Button-1>", self.finalize_paste)  # Place shapes on click
+            self.paste_preview = [shape.clone() for shape in self.copied_shapes]  # Temporary copy for preview
+            self.draw_dotted_outline(self.paste_preview)  # drawn once, then shifted as the mouse moves
+            self.bind_canvas("<Motion>", self.coalesced(self.update_paste_preview))  # Follow mouse
+            self.bind_canvas("<Button-1>", self.finalize_paste)  # Place shapes on click
             self.update_status_bar(status_message)
     def update_paste_preview(self, event):
         """Update the dotted outline position for the paste preview."""
         if self.is_pasting and self.paste_preview:
             # Calculate the offset for preview
-            min_x, min_y = float('inf'), float('inf')
-
-            def get_min_coords(shape):
-                """Recursively calculate the minimum x and y coordinates for a shape or group."""
-                nonlocal min_x, min_y
-                if isinstance(shape, IrRegularShape):
-                    for x, y in shape.points:
-                        min_x = min(min_x, x)
-                        min_y = min(min_y, y)
-                elif isinstance(shape, RegularShape):
-                    min_x = min(min_x, shape.start_point[0], shape.end_point[0])
-                    min_y = min(min_y, shape.start_point[1], shape.end_point[1])
-                elif isinstance(shape, Group):
-                    for sub_shape in shape.shapes:
-                        get_min_coords(sub_shape)
-
-            # Calculate reference point
-            for shape in self.paste_preview:
-                get_min_coords(shape)
-
+            min_x, min_y = self.anchor(self.paste_preview)
             dx, dy = event.x - min_x, event.y - min_y
 
-            # Move preview shapes
+            # Move preview shapes and their dotted outline
             for shape in self.paste_preview:
                 shape.move(dx, dy)
-
-            # Redraw canvas with preview
-            self.redraw_all()
-            self.draw_dotted_outline(self.paste_preview)  # Draw dotted preview
+            for item in self.preview_items:
+                self.renderer.move(item, dx, dy)
     def finalize_paste(self, event):
-        self.save_state()
         """Finalize the paste operation by placing the shapes on the canvas."""
+        self.run_frame()
         if self.is_pasting and self.paste_preview:
             # Add the preview shapes to the main shapes list
-            self.shapes.extend(self.paste_preview)
+            self.renderer.delete(*self.preview_items)
+            self.preview_items = []
+            self.history.execute(AddShapes(self.paste_preview), self)
             self.paste_preview = None  # Clear the preview
             self.is_pasting = False  # Exit paste mode
-            self.canvas.unbind("<Motion>")
-            self.canvas.unbind("<Button-1>")
-            self.redraw_all()
+            self.bind_canvas("<Motion>", self.coalesced(self.mouse_move))
+            self.bind_canvas("<Button-1>", self.start_action)
     def draw_dotted_outline(self, shapes):
         """Draw shapes with a dotted outline for preview."""
         for shape in shapes:
             if isinstance(shape, IrRegularShape):
-                self.canvas.create_line(
-                    *shape.flatten_points(),
-                    fill="gray", dash=(4, 2), tags="preview"
-                )
+                self.preview_items.append(self.renderer.polyline(
+                    shape.detail(self.renderer.tolerance).tolist(),
+                    color="gray", dash=(4, 2)
+                ))
             elif isinstance(shape, RegularShape):
-                x1, y1 = shape.start_point
-                x2, y2 = shape.end_point
-                self.canvas.create_rectangle(
+                x1, y1, x2, y2 = shape.bbox()
+                self.preview_items.append(self.renderer.rectangle(
                     x1, y1, x2, y2,
-                    outline="gray", dash=(4, 2), tags="preview"
-                )
+                    outline="gray", dash=(4, 2)
+                ))
             elif isinstance(shape, Group):
                 for sub_shape in shape.shapes:
                     self.draw_dotted_outline([sub_shape])
 
-    def save_state(self):
-        """Save the current state of shapes to the undo stack."""
-        self.undo_stack.append(cp.deepcopy(self.shapes))
-        self.redo_stack.clear()  # Clear redo stack on a new action
     def undo(self, event=None):
         """Undo the last action."""
-        if self.undo_stack:
-            self.redo_stack.append(cp.deepcopy(self.shapes))  # Save current state to redo stack
-            self.shapes = self.undo_stack.pop()  # Restore the previous state
-            self.redraw_all()
+        self.run_frame()
+        self.finish_drawing()
+        if self.history.undo(self):
+            self.prune_selection()
+
     def redo(self, event=None):
         """Redo the last undone action."""
-        if self.redo_stack:
-            self.undo_stack.append(cp.deepcopy(self.shapes))  # Save current state to undo stack
-            self.shapes = self.redo_stack.pop()  # Restore the state from redo stack
-            self.redraw_all()
+        self.run_frame()
+        self.finish_drawing()
+        if self.history.redo(self):
+            self.prune_selection()
+
+    def show_history_stats(self):
+        """Tell how much memory the undo history takes, in the status bar."""
+        stats = self.history.stats()
+        self.update_status_bar(
+            f"History: {stats['live']} steps in memory (~{stats['live_bytes'] / 2**20:.1f} MB), "
+            f"{stats['packed']} compressed ({stats['packed_bytes'] / 2**20:.1f} MB), "
+            f"{stats['spilled']} on disk ({stats['spilled_bytes'] / 2**20:.1f} MB), {stats['redo']} to redo")
+
+    # Profiling times the methods below by wrapping them (profiling.py); while it is
+    # off they are left alone. The overlay samples what the profiler saw once per
+    # overlay_ms and shows it in the status bar.
+    def profiled_methods(self):
+        """The hot paths the profiler times, as (object, attribute, name, name_of)."""
+        return [(self, "dispatch", None, lambda sequence, event: sequence),
+                (self, "invoke", None, lambda name, *args: name),
+                (self, "frame_due", "frame", None),
+                (self, "redraw_all", None, None),
+                (self, "shape_at", None, None),
+                (self, "save_to", "save", None),
+                (self, "start_loading", "load", None),
+                (self, "load_chunk", None, None),
+                (self.journal, "flush", "journal.flush", None)] + self.history_methods()
+
+    def history_methods(self):
+        return [(self.history, "execute", "history.execute", None),
+                (self.history, "record", "history.record", None)]
+
+    def set_profiling(self, on):
+        """Start or stop timing the hot paths. What was collected stays until profiling starts again."""
+        if on and not self.profiler.enabled:
+            self.profiler.clear()
+            self.profiler.start(self.profiled_methods())
+        elif not on:
+            self.set_overlay(False)
+            self.profiler.stop()
+
+    def set_overlay(self, on):
+        """Show frame times, document size, undo memory and the slowest recent call in the status bar.
+
+        The overlay profiles while it is on, and turning it off stops profiling.
+        """
+        if on and self.overlay_job is None:
+            self.set_profiling(True)
+            frames = self.profiler.timings.get("frame")
+            self.overlay_frames = (frames.count, frames.total) if frames else (0, 0.0)
+            self.profiler.take_slowest()
+            self.overlay = "Profiling..."
+            self.overlay_job = self.root.after(self.overlay_ms, self.update_overlay)
+        elif not on and self.overlay_job is not None:
+            self.root.after_cancel(self.overlay_job)
+            self.overlay_job = self.overlay = None
+            self.profiler.stop()  # nothing is timed with the overlay off; the trace stays for export
+        else:
+            return
+        if self.overlay_var is not None:
+            self.overlay_var.set(on)
+        if self.status_bar is not None:
+            self.status_bar.config(text=self.overlay or self.status)
+
+    def update_overlay(self):
+        frames = self.profiler.timings.get("frame")
+        count, total = (frames.count, frames.total) if frames else (0, 0.0)
+        frame_count, frame_time = count - self.overlay_frames[0], total - self.overlay_frames[1]
+        self.overlay_frames = (count, total)
+        drawn = len(self.items)
+        points = sum(point_count(shape) for shape in self.items)
+        stats = self.history.stats()
+        self.profiler.counters("document", shapes=len(self.shapes), drawn=drawn, points=points)
+        self.profiler.counters("undo memory", live=stats["live_bytes"], packed=stats["packed_bytes"],
+                               spilled=stats["spilled_bytes"])
+        parts = [f"{frame_count} frames, {frame_time / frame_count * 1000:.1f} ms each" if frame_count else "no frames",
+                 f"{len(self.shapes)} shapes, {drawn} drawn ({points} points)",
+                 f"undo {(stats['live_bytes'] + stats['packed_bytes']) / 2**20:.1f} MB"
+                 f" + {stats['spilled_bytes'] / 2**20:.1f} MB on disk"]
+        slowest = self.profiler.take_slowest()
+        if slowest:
+            parts.append(f"slowest {slowest[1]} {slowest[0] * 1000:.1f} ms")
+        self.overlay = " | ".join(parts)
+        if self.status_bar is not None:
+            self.status_bar.config(text=self.overlay)
+        self.overlay_job = self.root.after(self.overlay_ms, self.update_overlay)
+
+    def export_trace(self):
+        if not self.profiler.trace:
+            self.update_status_bar("Nothing profiled yet: turn on View > Performance Overlay first")
+            return
+        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Chrome trace", "*.json")])
+        if file_path:
+            self.write_trace(file_path)
+
+    def write_trace(self, file_path):
+        """Write what the profiler recorded as Chrome trace events (chrome://tracing, Perfetto)."""
+        self.profiler.export_trace(file_path)
+        self.update_status_bar(f"Wrote {len(self.profiler.trace)} trace events to {file_path}")
+
+    def finish_drawing(self):
+        """Let go of an in-progress polygon so history changes don't edit a shape that left the document."""
+        if isinstance(self.current_drawing_shape, Polygon):
+            self.current_drawing_shape.clear_preview(self.renderer)
+            self.current_drawing_shape = None
+
+    def prune_selection(self):
+        """Drop selected shapes that are no longer in the document."""
+        self.active_shapes = [shape for shape in self.active_shapes if shape in self.index]
+        self.update_highlights()
+
+    FILE_TYPES = [("Sketch", "*.json"), ("Sketch, one shape per line", "*.jsonl"),
+                  ("Binary sketch", "*.skb"), ("All files", "*.*")]
 
     def save(self):
-        file_path = filedialog.asksaveasfilename(defaultextension=".json")
+        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=self.FILE_TYPES)
+        if file_path:
+            self.save_to(file_path)
+
+    # Saving runs in the background. save_to takes a snapshot of the document, clones
+    # whose point buffers are shared copy-on-write (see IrRegularShape), so it costs
+    # little and later edits don't reach it; a worker thread writes the snapshot to a
+    # temporary file and renames it over the old one. check_save, on a root.after
+    # timer, reports the outcome and moves the journal onto the new file, carrying
+    # over the edits made while the save ran.
+    def save_to(self, file_path):
+        """Start saving the document as it is now; editing goes on while it is written."""
+        if self.saving is not None:
+            self.save_queued = file_path  # after the running save, which may be writing the same file
+            return
+        if self.loading:
+            self.save_queued = file_path  # once the whole file is in, see loaded()
+            self.update_status_bar(f"Will save to {file_path} once loaded")
+            return
+        snapshot = [shape.clone() for shape in self.shapes]
+        ids = self.journal.mark(self.shapes)
+        outcome = {}
+
+        def write():
+            try:
+                save_shapes(file_path, snapshot)
+            except Exception as error:  # reported on the Tk thread
+                outcome["error"] = error
+
+        thread = threading.Thread(target=write, daemon=True)
+        self.saving = (thread, file_path, ids, outcome, time.perf_counter())
+        thread.start()
+        self.update_status_bar(f"Saving {len(snapshot)} shapes to {file_path}...")
+        self.save_job = self.root.after(self.save_poll_ms, self.check_save)
+
+    def check_save(self):
+        self.save_job = None
+        if self.saving[0].is_alive():
+            self.save_job = self.root.after(self.save_poll_ms, self.check_save)
+        else:
+            self.saved()
+
+    def finish_save(self):
+        """Wait for the background save, and any queued after it, e.g. before quitting or loading."""
+        while self.saving is not None:
+            if self.save_job is not None:
+                self.root.after_cancel(self.save_job)
+                self.save_job = None
+            self.saving[0].join()
+            self.saved()
+
+    def saved(self):
+        thread, file_path, ids, outcome, started = self.saving
+        self.saving = None
+        error = outcome.get("error")
+        if error is None:
+            self.journal.rebase(file_path, ids, self.shapes)  # the saved file is the new base
+            self.update_status_bar(f"Saved to {file_path} in {time.perf_counter() - started:.1f} s")
+        else:
+            self.journal.since = None  # the old journal goes on
+            self.update_status_bar(f"Could not save {file_path}: {error}")
+        if self.save_queued is not None:
+            file_path, self.save_queued = self.save_queued, None
+            self.save_to(file_path)
+
+    def record_session(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".jsonl", filetypes=[("Session recording", "*.jsonl")])
         if file_path:
-            with open(file_path, "w") as file:
-                json.dump([shape.to_dict() for shape in self.shapes], file)
+            self.start_recording(file_path)
+
+    def start_recording(self, file_path):
+        """Write the events handled from now on to file_path, to be replayed with recording.py."""
+        self.stop_recording()
+        self.run_frame()  # motion from before the recording is not in it
+        self.recorder = Recorder(self, file_path)
+        self.update_status_bar(f"Recording to {file_path}")
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+            self.update_status_bar("Recording stopped")
 
     def load(self):
-        file_path = filedialog.askopenfilename(defaultextension=".json")
+        file_path = filedialog.askopenfilename(defaultextension=".json", filetypes=self.FILE_TYPES)
         if file_path:
-            with open(file_path, "r") as file:
-                data = json.load(file)
-                self.shapes = [Shape.from_dict(shape_data) for shape_data in data]
-                self.redraw_all()
+            self.start_loading(file_path)
+
+    def start_loading(self, file_path):
+        """Stream a file into a fresh document; shapes appear, and can be edited, as they arrive."""
+        self.finish_save()  # its journal is about to go
+        if self.loading:
+            self.save_queued = None  # was waiting for a document that is going away
+        self.stop_loading()
+        self.stop_drawing_polygon()
+        self.active_shapes = []
+        self.history.close()
+        self.history = History(self.history_budget, self.history_packed_budget)  # the old commands refer to the old document
+        self.profiler.attach(self.history_methods())
+        self.journal.stop()  # restarted once the file is in
+        self.set_shapes([])
+        try:
+            if is_binary(file_path):
+                reader = BinaryReader(file_path, SHAPE_CLASSES)
+                shapes = iter(reader)
+            else:
+                reader = RecordReader(file_path)
+                shapes = (Shape.from_dict(record) for record in reader)
+        except (OSError, ValueError, KeyError) as error:
+            self.update_status_bar(f"Could not load {file_path}: {error}")
+            self.journal.start(self.journal.untitled(), self.shapes)
+            return
+        self.loading = (reader, shapes, file_path)
+        self.load_job = self.root.after(0, self.load_chunk)
+
+    def load_chunk(self):
+        """Add shapes for up to load_slice_ms, then hand control back to Tk until the next chunk."""
+        reader, shapes, file_path = self.loading
+        deadline = time.perf_counter() + self.load_slice_ms / 1000
+        try:
+            for shape in shapes:
+                self.add_shape(shape)
+                if time.perf_counter() > deadline:
+                    break
+            else:
+                self.stop_loading()
+                self.update_status_bar(f"Loaded {len(self.shapes)} shapes from {file_path}")
+                self.loaded(file_path, complete=True)
+                return
+        except (TypeError, ValueError, KeyError) as error:  # a malformed record
+            self.stop_loading()
+            self.update_status_bar(f"Could not load {file_path}: {error}")
+            self.loaded(file_path, complete=False)
+            return
+        self.update_status_bar(f"Loading {file_path}... {reader.progress():.0%}, {len(self.shapes)} shapes")
+        self.load_job = self.root.after(1, self.load_chunk)
+
+    def loaded(self, file_path, complete):
+        """Start journaling the document a load produced, then any save asked for while it loaded."""
+        if complete and not self.history.undo_stack:
+            # nothing was edited while loading: the file itself is the base
+            self.journal.start(file_path, self.shapes, source=file_path)
+        else:
+            self.journal.start(file_path, self.shapes)
+        if self.save_queued is not None:
+            file_path, self.save_queued = self.save_queued, None
+            self.save_to(file_path)
+
+    def stop_loading(self):
+        if self.load_job is not None:
+            self.root.after_cancel(self.load_job)
+            self.load_job = None
+        if self.loading:
+            self.loading[0].close()
+            self.loading = None
+
+    def open_journal(self):
+        """Bring back the document an unexpected exit left journaled, then keep journaling."""
+        base = self.journal.recover()
+        if base is not None:
+            try:
+                self.set_shapes(self.journal.resume(base))
+                self.update_status_bar(f"Recovered {len(self.shapes)} shapes from the journal at {base}")
+            except (OSError, ValueError, KeyError) as error:
+                self.update_status_bar(f"Could not recover from the journal at {base}: {error}")
+                base = None
+        if base is None:
+            self.journal.start(self.journal.untitled(), self.shapes)
+        self.journal_job = self.root.after(self.journal_interval_ms, self.flush_journal)
+
+    def flush_journal(self):
+        try:
+            self.journal.flush()
+        except OSError as error:  # keep the records and try again on the next tick
+            self.update_status_bar(f"Could not write the journal: {error}")
+        self.journal_job = self.root.after(self.journal_interval_ms, self.flush_journal)
+
+    def quit(self):
+        """Close the window. A clean exit leaves no journal behind to recover."""
+        self.finish_save()
+        self.stop_loading()
+        self.stop_recording()
+        self.set_profiling(False)
+        self.set_tiles(False)
+        if self.journal_job is not None:
+            self.root.after_cancel(self.journal_job)
+        if self.frame_job is not None:
+            self.root.after_cancel(self.frame_job)
+        self.journal.discard()
+        self.history.close()
+        self.root.destroy()
 
     @staticmethod
     def distance(x1, y1, x2, y2):
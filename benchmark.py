@@ -0,0 +1,779 @@
+"""Rough timings for the hot paths of SketchPad on large synthetic drawings.
+
+Run with: python benchmark.py
+For regression tracking across changes, see benchsuite.py.
+"""
+import copy
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from shapes import Line, Rectangle, Ellipse, Freehand, Polygon, Group, Shape, SHAPE_CLASSES, bounding_box
+from render import RecordingRenderer, RasterRenderer, ViewRenderer
+from viewport import Viewport
+from fileformats import write_binary, read_shapes, convert, write_shapes
+from journal import Journal, replay
+from recording import replay as replay_recording, document_hash
+from spatial import GridIndex, PointIndex
+from geometry import segment_distance
+from types import SimpleNamespace
+from SketchPad import DrawingApp, HeadlessRoot
+from history import History, AddShapes, RemoveShapes
+
+
+def random_shapes(count, extent=20000, seed=1):
+    """Build `count` small shapes scattered over an extent x extent area."""
+    rng = random.Random(seed)
+    shapes = []
+    for _ in range(count):
+        x, y = rng.uniform(0, extent), rng.uniform(0, extent)
+        w, h = rng.uniform(5, 80), rng.uniform(5, 80)
+        kind = rng.randrange(5)
+        if kind == 0:
+            shapes.append(Line((x, y), (x + w, y + h), "black"))
+        elif kind == 1:
+            shapes.append(Rectangle((x, y), (x + w, y + h), "black"))
+        elif kind == 2:
+            shapes.append(Ellipse((x, y), (x + w, y + h), "black"))
+        elif kind == 3:
+            shape = Polygon("black")
+            shape.points = [(x, y), (x + w, y), (x + w / 2, y + h), (x, y)]
+            shapes.append(shape)
+        else:
+            shape = Freehand("black")
+            shape.points = [(x + i * w / 20, y + rng.uniform(0, h)) for i in range(20)]
+            shapes.append(shape)
+    return shapes
+
+
+def linear_hit(shapes, x, y):
+    """The original hit-test: walk every shape from the top."""
+    for shape in reversed(shapes):
+        if shape.contains_point(x, y):
+            return shape
+    return None
+
+
+def indexed_hit(index, x, y, margin=10):
+    for shape in index.hits(x, y, margin):
+        if shape.contains_point(x, y):
+            return shape
+    return None
+
+
+def bench_hit_test(count=100_000, clicks=200, extent=20000):
+    shapes = random_shapes(count, extent)
+    rng = random.Random(2)
+    # click on shapes half of the time, on (mostly) empty space otherwise
+    points = []
+    for i in range(clicks):
+        if i % 2:
+            box = rng.choice(shapes).bbox()
+            points.append(((box[0] + box[2]) / 2, (box[1] + box[3]) / 2))
+        else:
+            points.append((rng.uniform(0, extent), rng.uniform(0, extent)))
+
+    start = time.perf_counter()
+    index = GridIndex()
+    index.rebuild(shapes)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    linear = [linear_hit(shapes, x, y) for x, y in points]
+    linear_time = (time.perf_counter() - start) / clicks
+
+    start = time.perf_counter()
+    indexed = [indexed_hit(index, x, y) for x, y in points]
+    indexed_time = (time.perf_counter() - start) / clicks
+
+    assert linear == indexed, "index disagrees with the linear scan"
+    print(f"hit-test, {count} shapes, {clicks} clicks")
+    print(f"  index build      {build * 1000:10.1f} ms")
+    print(f"  linear scan      {linear_time * 1000:10.3f} ms/click")
+    print(f"  grid index       {indexed_time * 1000:10.3f} ms/click")
+    print(f"  speed-up         {linear_time / indexed_time:10.0f}x")
+
+
+def grouped(shapes, size=8):
+    """Group shapes that sit near each other, then the groups, up to one group around everything."""
+    while len(shapes) > 1:
+        shapes.sort(key=lambda shape: (int(shape.bbox()[1] // 2000), shape.bbox()[0]))
+        shapes = [Group(shapes[i:i + size]) for i in range(0, len(shapes), size)]
+    return shapes[0]
+
+
+def flat_contains(shape, x, y):
+    """Group hit-testing as it was: ask every member."""
+    if isinstance(shape, Group):
+        return any(flat_contains(member, x, y) for member in shape.shapes)
+    return shape.contains_point(x, y)
+
+
+def bench_groups(count=20_000, clicks=200, extent=20000):
+    """Hit-testing a deep group, and finding the corner of a selection of groups to paste at."""
+    group = grouped(random_shapes(count, extent))
+    rng = random.Random(3)
+    points = [(rng.uniform(0, extent), rng.uniform(0, extent)) for _ in range(clicks)]
+    start = time.perf_counter()
+    flat = [flat_contains(group, x, y) for x, y in points]
+    flat_time = (time.perf_counter() - start) / clicks
+    start = time.perf_counter()
+    pruned = [group.contains_point(x, y) for x, y in points]
+    pruned_time = (time.perf_counter() - start) / clicks
+    assert flat == pruned, "pruned hit-test disagrees"
+
+    def forget(shape):
+        shape.invalidate()
+        for member in getattr(shape, "shapes", ()):
+            forget(member)
+
+    selection = group.shapes
+    forget(group)
+    start = time.perf_counter()
+    uncached = bounding_box(selection)[0]  # computed from every point, as the recursive walk did
+    uncached_time = time.perf_counter() - start
+    start = time.perf_counter()
+    cached = bounding_box(selection)[0]
+    cached_time = time.perf_counter() - start
+    assert cached == uncached
+    print(f"groups, {count} shapes in one nested group, {len(selection)} groups selected")
+    print(f"  every member     {flat_time * 1000:10.3f} ms/click")
+    print(f"  box pruning      {pruned_time * 1000:10.3f} ms/click")
+    print(f"  paste corner     {uncached_time * 1000:10.3f} ms uncached, {cached_time * 1000:.3f} ms cached")
+
+
+def bench_shape_hits(points=20_000, polygon_sides=200, clicks=2000):
+    """Hit tests inside one shape: against the vertices or Line objects, and against the segments."""
+    rng = random.Random(11)
+    stroke = Freehand("black")
+    x, y = 5000.0, 5000.0
+    for _ in range(points):
+        x += rng.uniform(-40, 40)  # spaced like the samples of a simplified stroke
+        y += rng.uniform(-40, 40)
+        stroke.add_point(x, y)
+    coords = stroke.coords.tolist()
+
+    def vertex_hit(px, py):  # what Freehand.contains_point did
+        samples = iter(coords)
+        return any(abs(px - sx) < 10 and abs(py - sy) < 10 for sx, sy in zip(samples, samples))
+
+    # clicks on the stroke halfway between samples, and anywhere around it
+    middles = [((coords[2 * i] + coords[2 * i + 2]) / 2, (coords[2 * i + 1] + coords[2 * i + 3]) / 2)
+               for i in (rng.randrange(points - 1) for _ in range(clicks // 2))]
+    box = stroke.bbox()
+    anywhere = [(rng.uniform(box[0], box[2]), rng.uniform(box[1], box[3])) for _ in range(clicks // 2)]
+    stroke.contains_point(*middles[0])  # builds the segment grid
+    print(f"hit tests inside one freehand stroke of {points} points, {clicks} clicks")
+    for name, hit in (("vertices", vertex_hit), ("segments", stroke.contains_point)):
+        start = time.perf_counter()
+        found = sum(hit(px, py) for px, py in middles + anywhere)
+        elapsed = (time.perf_counter() - start) / clicks
+        missed = sum(not hit(px, py) for px, py in middles)
+        print(f"  {name:10} {elapsed * 1000:10.4f} ms/click, {found} hits, {missed} clicks on the line missed")
+
+    polygon = Polygon("black")
+    polygon.points = [(500 + 400 * math.cos(2 * math.pi * i / polygon_sides), 500 + 400 * math.sin(2 * math.pi * i / polygon_sides))
+                      for i in range(polygon_sides + 1)]
+    points = polygon.points
+
+    def line_objects(px, py):  # what Polygon.contains_point did for the edges
+        return any(Line(points[i], points[i + 1], "black").contains_point(px, py) for i in range(len(points) - 1))
+
+    queries = [(rng.uniform(50, 950), rng.uniform(50, 950)) for _ in range(clicks)]
+    print(f"polygon of {polygon_sides} sides, edge tests")
+    for name, hit in (("Line objects", line_objects), ("segments", lambda px, py: polygon.near_path(px, py, 5))):
+        start = time.perf_counter()
+        for px, py in queries:
+            hit(px, py)
+        print(f"  {name:12} {(time.perf_counter() - start) / clicks * 1000:8.4f} ms/click")
+
+
+def bench_lazy_move(strokes=200, points=1000, frames=100):
+    """Dragging a group of long strokes: moves applied to every point each frame, against noted until the drop."""
+    rng = random.Random(8)
+
+    def group():
+        members = []
+        for _ in range(strokes):
+            shape = Freehand("black")
+            shape.points = [(rng.uniform(0, 500), rng.uniform(0, 500)) for _ in range(points)]
+            members.append(shape)
+        return Group([Group(members[:strokes // 2]), Group(members[strokes // 2:])])
+
+    eager, lazy = group(), group()
+    start = time.perf_counter()
+    for _ in range(frames):
+        eager.move(2, 1)
+        eager.settle()  # what every move did before
+    eager_time = (time.perf_counter() - start) / frames
+    start = time.perf_counter()
+    for _ in range(frames):
+        lazy.move(2, 1)
+    lazy_time = (time.perf_counter() - start) / frames
+    start = time.perf_counter()
+    lazy.settle()  # once, on the drop
+    settle = time.perf_counter() - start
+    print(f"dragging a group of {strokes} strokes of {points} points, {frames} frames")
+    print(f"  move every point {eager_time * 1000:10.3f} ms/frame")
+    print(f"  note the move    {lazy_time * 1000:10.4f} ms/frame, {settle * 1000:.1f} ms to settle on the drop")
+
+
+def bench_paste(strokes=50, points=1000, pastes=20):
+    """Pasting a group of 50k points again and again: deep copies, against clones sharing the points."""
+    rng = random.Random(9)
+    members = []
+    for _ in range(strokes):
+        shape = Freehand("black")
+        shape.points = [(rng.uniform(0, 500), rng.uniform(0, 500)) for _ in range(points)]
+        members.append(shape)
+    group = Group(members)
+    print(f"pasting a group of {strokes * points} points {pastes} times")
+    group.bbox()
+    for name, duplicate in (("deep copy", copy.deepcopy), ("clone", Group.clone)):
+        def paste():
+            pasted = []
+            for i in range(pastes):
+                twin = duplicate(group)
+                twin.move(i * 10, 0)
+                twin.bbox()
+                pasted.append(twin)
+            return pasted
+
+        start = time.perf_counter()
+        pasted = paste()
+        elapsed = (time.perf_counter() - start) / pastes
+        size = allocated(paste)  # timed without tracemalloc, which slows everything down
+        print(f"  {name:10} {elapsed * 1000:10.3f} ms/paste, {size / pastes / 1024:8.0f} KiB/paste")
+    assert [shape.coords.tolist() for shape in pasted[-1].shapes] == \
+        [[value + (pastes - 1) * 10 * (1 - i % 2) for i, value in enumerate(shape.coords)] for shape in members]
+
+
+def bench_history(steps=300, points=2000, budget=4 << 20, packed_budget=1 << 20):
+    """A long session of drawing and deleting long strokes: the undo history unbounded, and within a budget."""
+    rng = random.Random(10)
+    strokes = []
+    for _ in range(steps):
+        stroke = Freehand("black")
+        stroke.points = [(rng.uniform(0, 800), rng.uniform(0, 600)) for _ in range(points)]
+        strokes.append(stroke)
+    folder = tempfile.mkdtemp()
+    print(f"history of {steps} deleted strokes of {points} points")
+    try:
+        for name, limits in (("unbounded", (float("inf"), float("inf"))), ("budget", (budget, packed_budget))):
+            app = DrawingApp(HeadlessRoot(), RecordingRenderer(), recovery_dir=folder)
+            app.history = History(*limits)
+            app.journal.stop()  # only the history's memory is measured
+
+            def session():
+                for stroke in strokes:
+                    clone = stroke.clone()
+                    clone.own()  # points of its own, like a stroke just drawn
+                    app.history.execute(AddShapes([clone]), app)
+                    app.history.execute(RemoveShapes([clone]), app)
+                return app.history
+
+            size = allocated(session)
+            stats = app.history.stats()
+            timings = []
+            for _ in range(2 * steps):
+                start = time.perf_counter()
+                app.undo()
+                timings.append(time.perf_counter() - start)
+            assert not app.shapes and not app.history.undo_stack
+            print(f"  {name:10} {size / 2**20:7.1f} MB held, {stats['spilled_bytes'] / 2**20:5.1f} MB on disk, "
+                  f"undo: newest {timings[0] * 1000:.2f} ms, "
+                  f"oldest {max(timings) * 1000:.2f} ms")
+            app.quit()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def allocated(build):
+    """Bytes still held by whatever build() returns."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return size
+
+
+def bench_point_memory(count=100_000):
+    rng = random.Random(3)
+    samples = [(rng.randrange(300, 3000), rng.randrange(300, 3000)) for _ in range(count)]
+
+    def as_tuples():
+        # what a stroke used to hold: one (x, y) tuple per motion event, with fresh
+        # int objects like the ones each Tk event carries
+        return [(int(str(x)), int(str(y))) for x, y in samples]
+
+    def as_freehand():
+        stroke = Freehand("black")
+        for x, y in samples:
+            stroke.add_point(x, y)
+        return stroke
+
+    old, new = allocated(as_tuples), allocated(as_freehand)
+    print(f"freehand stroke memory, {count} points")
+    print(f"  list of tuples   {old / count:10.1f} bytes/point")
+    print(f"  array('d')       {new / count:10.1f} bytes/point")
+    print(f"  reduction        {old / new:10.1f}x")
+
+
+def mouse_path(count=3000, seed=4):
+    """Integer samples of a wobbly hand-drawn curve, taken faster than the mouse moves."""
+    rng = random.Random(seed)
+    samples = []
+    for i in range(count):
+        t = i / count
+        speed = 0.3 + abs(math.sin(t * 7))  # slows down and speeds up like a hand
+        x = 100 + 900 * t + 40 * math.sin(t * 25) * speed
+        y = 400 + 250 * math.sin(t * 6) + 20 * math.cos(t * 40)
+        samples.append((round(x + rng.uniform(-0.4, 0.4)), round(y + rng.uniform(-0.4, 0.4))))
+    return samples
+
+
+def bench_stroke_simplification(tolerance=2.0):
+    """Run the freehand capture pipeline the way DrawingApp does and check the error bound."""
+    samples = mouse_path()
+    stroke = Freehand("black")
+    stroke.add_point(*samples[0])
+    for x, y in samples[1:]:
+        stroke.capture(x, y, tolerance / 2)
+    captured = stroke.point_count()
+    start = time.perf_counter()
+    stroke.simplify(tolerance / 2)
+    elapsed = time.perf_counter() - start
+    kept = stroke.points
+    error = max(min(segment_distance(x, y, *kept[i], *kept[i + 1]) for i in range(len(kept) - 1))
+                for x, y in samples)
+    assert error <= tolerance, f"stroke strays {error:.2f} px from the mouse path"
+    print(f"freehand simplification, tolerance {tolerance} px")
+    print(f"  mouse samples    {len(samples):10d}")
+    print(f"  after capture    {captured:10d}")
+    print(f"  after simplify   {len(kept):10d}  ({len(samples) / len(kept):.0f}x fewer, {elapsed * 1000:.1f} ms)")
+    print(f"  max error        {error:10.2f} px")
+
+
+def bench_file_formats(count=20_000, strokes=200, stroke_points=2000):
+    """File size and load time of the JSON path against the binary format."""
+    shapes = random_shapes(count)
+    rng = random.Random(5)
+    for _ in range(strokes):
+        stroke = Freehand("#1f77b4")
+        x, y = rng.uniform(0, 20000), rng.uniform(0, 20000)
+        for _ in range(stroke_points):
+            x, y = x + rng.randint(-3, 3), y + rng.randint(-3, 3)
+            stroke.add_point(x, y)
+        shapes.append(stroke)
+    folder = tempfile.mkdtemp()
+    json_path, binary_path = os.path.join(folder, "bench.json"), os.path.join(folder, "bench.skb")
+
+    start = time.perf_counter()
+    with open(json_path, "w") as file:
+        json.dump([shape.to_dict() for shape in shapes], file)
+    json_save = time.perf_counter() - start
+    start = time.perf_counter()
+    with open(json_path) as file:
+        loaded_json = [Shape.from_dict(data) for data in json.load(file)]
+    json_load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_binary(binary_path, shapes)
+    binary_save = time.perf_counter() - start
+    start = time.perf_counter()
+    loaded_binary = read_shapes(binary_path, SHAPE_CLASSES)
+    binary_load = time.perf_counter() - start
+
+    # the binary file holds the same document, and converts back to the same JSON
+    records = json.dumps([shape.to_dict() for shape in loaded_json])
+    assert json.dumps([shape.to_dict() for shape in loaded_binary]) == records
+    round_trip = os.path.join(folder, "round-trip.json")
+    convert(binary_path, round_trip, SHAPE_CLASSES)
+    with open(round_trip) as converted, open(json_path) as original:
+        assert json.load(converted) == json.load(original)
+
+    json_size, binary_size = os.path.getsize(json_path), os.path.getsize(binary_path)
+    print(f"file formats, {len(shapes)} shapes ({strokes} strokes of {stroke_points} points)")
+    print(f"  json   {json_size / 1e6:8.1f} MB  save {json_save * 1000:8.0f} ms  load {json_load * 1000:8.0f} ms")
+    print(f"  binary {binary_size / 1e6:8.1f} MB  save {binary_save * 1000:8.0f} ms  load {binary_load * 1000:8.0f} ms")
+    print(f"  binary is {json_size / binary_size:.1f}x smaller and loads {json_load / binary_load:.1f}x faster")
+    for path in (json_path, binary_path, round_trip):
+        os.remove(path)
+    os.rmdir(folder)
+
+
+def bench_journal(count=20_000, edits=100):
+    """Saving the whole document after every few edits against journaling the edits."""
+    shapes = random_shapes(count)
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "bench.json")
+    start = time.perf_counter()
+    write_shapes(path, shapes)
+    save = time.perf_counter() - start
+
+    journal = Journal(SHAPE_CLASSES, folder)
+    journal.start(path, shapes, source=path)
+    rng = random.Random(6)
+    start = time.perf_counter()
+    for i in range(edits):
+        if i % 2:
+            moved = rng.sample(shapes, 3)
+            for shape in moved:
+                shape.move(5, -5)
+            journal.moved(moved, 5, -5)
+        else:
+            shape = Line((i, i), (i + 40, i + 20), "black")
+            shapes.append(shape)
+            journal.added(shape)
+        journal.flush()  # the worst case: every edit gets a timer tick of its own
+    journaled = (time.perf_counter() - start) / edits
+
+    start = time.perf_counter()
+    recovered, _, _ = replay(journal.base, SHAPE_CLASSES)
+    recovery = time.perf_counter() - start
+    assert json.dumps([shape.to_dict() for shape in recovered]) == json.dumps([shape.to_dict() for shape in shapes])
+
+    # a drag that goes on while a background save runs, before the timer flushes its start
+    dragged = shapes[-1:]
+    dragged[0].move(30, 30)
+    journal.moved(dragged, 30, 30)
+    ids = journal.mark(shapes)
+    snapshot = [shape.clone() for shape in shapes]  # what save_to writes
+    dragged[0].move(30, 30)
+    journal.moved(dragged, 30, 30)
+    saved = os.path.join(folder, "saved.json")
+    write_shapes(saved, snapshot)
+    journal.rebase(saved, ids, shapes)
+    journal.flush()
+    recovered, _, _ = replay(journal.base, SHAPE_CLASSES)  # after a crash
+    assert json.dumps([shape.to_dict() for shape in recovered]) == json.dumps([shape.to_dict() for shape in shapes])
+    journal.discard()
+    os.remove(path)
+    os.remove(saved)
+    os.rmdir(folder)
+    print(f"journal, {count} shapes, {edits} edits")
+    print(f"  full save        {save * 1000:10.1f} ms")
+    print(f"  journaled edit   {journaled * 1000:10.3f} ms (written and fsynced)")
+    print(f"  recovery         {recovery * 1000:10.1f} ms")
+
+
+def bench_render(count=100_000, raster_count=5_000):
+    """Draw cost per shape through the renderer interface, without a display."""
+    shapes = random_shapes(count)
+    renderer = RecordingRenderer()
+    start = time.perf_counter()
+    for shape in shapes:
+        shape.draw(renderer)
+    recorded = time.perf_counter() - start
+
+    raster = RasterRenderer(2000, 2000)
+    for shape in random_shapes(raster_count, extent=2000):
+        shape.draw(raster)
+    start = time.perf_counter()
+    raster.render()
+    rasterized = time.perf_counter() - start
+    print(f"rendering, {count} shapes recorded, {raster_count} rasterized")
+    print(f"  record           {recorded / count * 1e6:10.2f} us/shape  {dict(sorted(renderer.calls.items()))}")
+    print(f"  rasterize        {rasterized / raster_count * 1e6:10.2f} us/shape  (2000 x 2000 px)")
+
+
+def bench_detail_levels(strokes=300, points=2000, extent=8000, scales=(1, 0.25, 0.1, 0.05)):
+    """Drawing long freehand strokes at several zoom levels, with every point and with the simplified levels."""
+    rng = random.Random(5)
+    shapes = []
+    for _ in range(strokes):
+        x, y, heading = rng.uniform(0, extent), rng.uniform(0, extent), rng.uniform(0, 2 * math.pi)
+        coords = []
+        for _ in range(points):  # a wandering pen, a few units per sample
+            heading += rng.uniform(-0.3, 0.3)
+            x, y = x + 3 * math.cos(heading), y + 3 * math.sin(heading)
+            coords += (x, y)
+        shape = Freehand("black")
+        shape.points = zip(coords[0::2], coords[1::2])
+        shape.simplify(1.0)  # as the app does when the mouse is released
+        shapes.append(shape)
+
+    def draw(scale, pixel_tolerance):
+        """Returns points sent, first and second draw time, and raster time of an 800 x 800 view."""
+        view = Viewport(800, 800)
+        view.scale = scale
+        raster = RasterRenderer(800, 800)
+        renderer = ViewRenderer(raster, view, pixel_tolerance)
+        times = []
+        for _ in range(2):
+            raster.clear()
+            start = time.perf_counter()
+            for shape in shapes:
+                shape.draw(renderer)
+            times.append(time.perf_counter() - start)
+        sent = sum(len(item.coords) for item in raster.items.values()) // 2
+        start = time.perf_counter()
+        raster.render()
+        return sent, times[0], times[1], time.perf_counter() - start
+
+    print(f"level of detail, {strokes} strokes of {sum(shape.point_count() for shape in shapes) // strokes} points "
+          f"over {extent} x {extent}, 800 x 800 view; the first draw at a zoom builds its level")
+    print(f"  {'zoom':>5}  {'points sent':>16}  {'draw ms':>15}  {'first draw':>10}  {'rasterize ms':>15}")
+    for scale in scales:
+        every, levels = draw(scale, 0), draw(scale, 0.5)
+        print(f"  {scale:5.0%}  {every[0]:7} -> {levels[0]:<6}  {every[2] * 1000:6.1f} -> {levels[2] * 1000:<5.1f}"
+              f"  {levels[1] * 1000:7.1f} ms  {every[3] * 1000:6.0f} -> {levels[3] * 1000:<5.0f}")
+
+
+def bench_motion(count=20_000, selected=2_000, events=1_000):
+    """One second of a 1 kHz mouse dragging a big selection: handled per event, and once per frame.
+
+    Events arrive on the wall clock, as they would from Tk, and the headless root's
+    timers are kept in step with it.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        print(f"mouse motion, dragging {selected} of {count} shapes, {events} events 1 ms apart")
+        for mode in ("every event", "per frame"):
+            app = DrawingApp(HeadlessRoot(), RecordingRenderer(), recovery_dir=folder)
+            app.set_shapes(random_shapes(count, extent=2000))
+            app.save_to(os.path.join(folder, "base.skb"))
+            app.finish_save()
+            app.set_select_mode("")
+            app.active_shapes = app.shapes[:selected]
+            app.clicked_shape = app.active_shapes[0]
+            app.drag_start = app.drag_origin = (0, 0)
+            moves = []
+            move_shapes = app.move_shapes
+            app.move_shapes = lambda shapes, dx, dy: (moves.append(dx), move_shapes(shapes, dx, dy))
+            start = time.perf_counter()
+            delivered = 0
+            while delivered < events:
+                now = (time.perf_counter() - start) * 1000
+                while delivered < min(events, now):  # the events that queued up meanwhile
+                    delivered += 1
+                    event = SimpleNamespace(x=delivered, y=delivered // 2, state=0)
+                    if mode == "every event":
+                        app.perform_action(event)
+                    else:
+                        app.drag_motion(event)
+                app.root.run(max(0, now - app.root.time))
+            app.end_action(SimpleNamespace(x=events, y=events // 2, state=0))
+            lag = (time.perf_counter() - start) * 1000 - events
+            assert sum(moves) == events
+            print(f"  {mode:12} {len(moves):6} redraws, caught up {max(lag, 0):8.0f} ms after the mouse stopped")
+            app.quit()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_profiling(count=20_000, clicks=2_000):
+    """Clicks through the event dispatch with profiling off, and on (every hot path wrapped and timed)."""
+    folder = tempfile.mkdtemp()
+    try:
+        app = DrawingApp(HeadlessRoot(), RecordingRenderer(), recovery_dir=folder)
+        app.set_shapes(random_shapes(count, extent=2000))
+        app.set_select_mode("")
+        rng = random.Random(12)
+        events = [SimpleNamespace(x=rng.uniform(0, 2000), y=rng.uniform(0, 2000), state=0) for _ in range(clicks)]
+        print(f"clicks in a document of {count} shapes, through dispatch")
+        for profiling in (False, True):
+            app.set_profiling(profiling)
+            start = time.perf_counter()
+            for event in events:
+                app.dispatch("<Button-1>", event)
+                app.dispatch("<ButtonRelease-1>", event)
+            elapsed = (time.perf_counter() - start) / clicks
+            print(f"  profiling {'on ' if profiling else 'off'} {elapsed * 1e6:8.1f} us/click")
+        app.quit()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_tiles(count=2_000, selected=10, frames=60):
+    """Dragging a few shapes over a full view: canvas items, and the app's time, with and without raster tiles.
+
+    Tk's own redraw cost grows with the items under the damaged area, which is what
+    the tiles cut; that part can't be timed headless, so the item counts stand in for it.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        print(f"dragging {selected} of {count} shapes in an 800x600 view, {frames} frames")
+        for tiled in (False, True):
+            app = DrawingApp(HeadlessRoot(), RecordingRenderer(), recovery_dir=folder)
+            app.tile_thread = False
+            app.set_shapes(random_shapes(count, extent=700))
+            app.save_to(os.path.join(folder, "base.skb"))
+            app.finish_save()
+            app.set_select_mode("")
+            start = time.perf_counter()
+            if tiled:
+                app.set_tiles(True)
+                while app.pending:
+                    app.run_frame()
+            warm = time.perf_counter() - start
+            app.active_shapes = app.shapes[:selected]
+            app.update_highlights()
+            while app.pending:  # the tiles drop the selection
+                app.run_frame()
+            app.clicked_shape = app.active_shapes[0]
+            app.drag_start = app.drag_origin = (0, 0)
+            start = time.perf_counter()
+            for frame in range(1, frames + 1):
+                app.perform_action(SimpleNamespace(x=frame * 3, y=frame * 2, state=0))
+                app.run_frame()
+            elapsed = (time.perf_counter() - start) / frames
+            app.end_action(SimpleNamespace(x=frames * 3, y=frames * 2, state=0))
+            items = len(app.renderer.renderer.items)
+            print(f"  tiles {'on ' if tiled else 'off'} {items:6} canvas items while dragging, "
+                  f"{elapsed * 1000:7.2f} ms/frame in the app" + (f", tiles rendered in {warm:.2f} s" if tiled else ""))
+            app.quit()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_snapping(polygons=5_000, sides=200, extent=100_000, queries=2_000, radius=8):
+    """Nearest snap point within a radius, over 1M polygon vertices: a scan of them all, and the point grid."""
+    rng = random.Random(12)
+    shapes = []
+    for _ in range(polygons):
+        x, y = rng.uniform(0, extent), rng.uniform(0, extent)
+        shape = Polygon("black")
+        shape.points = [(x + rng.uniform(0, 400), y + rng.uniform(0, 400)) for _ in range(sides)]
+        shapes.append(shape)
+    # half the queries next to a vertex, half anywhere
+    vertices = [shape.coords for shape in rng.sample(shapes, 100)]
+    targets = [(coords[i] + rng.uniform(-5, 5), coords[i + 1] + rng.uniform(-5, 5))
+               for coords in vertices for i in [2 * rng.randrange(sides)] for _ in range(queries // 200)]
+    targets += [(rng.uniform(0, extent), rng.uniform(0, extent)) for _ in range(queries - len(targets))]
+
+    def scan(x, y):
+        best, limit = None, radius * radius
+        for shape in shapes:
+            coords = shape.coords
+            for i in range(0, len(coords), 2):
+                distance = (coords[i] - x) ** 2 + (coords[i + 1] - y) ** 2
+                if distance <= limit:
+                    best, limit = (coords[i], coords[i + 1]), distance
+        return best
+
+    print(f"snapping among {polygons * sides} vertices of {polygons} polygons, radius {radius}")
+    start = time.perf_counter()
+    for x, y in targets[:3]:
+        scan(x, y)
+    print(f"  scan        {(time.perf_counter() - start) / 3 * 1000:10.3f} ms/query")
+    index = PointIndex()
+    start = time.perf_counter()
+    index.rebuild(shapes)
+    index.flush()
+    print(f"  index built in {time.perf_counter() - start:.2f} s")
+    times = []
+    found = 0
+    for x, y in targets:
+        start = time.perf_counter()
+        found += index.nearest(x, y, radius) is not None
+        times.append(time.perf_counter() - start)
+    times.sort()
+    print(f"  point grid  {sum(times) / len(times) * 1000:10.4f} ms/query, p99 {times[len(times) * 99 // 100] * 1000:.4f} ms, "
+          f"{found} of {len(targets)} snapped")
+    # a shape dragged elsewhere, then a query that has to take it in
+    start = time.perf_counter()
+    for shape in shapes[:100]:
+        shape.move(rng.uniform(-500, 500), rng.uniform(-500, 500))
+        index.update(shape)
+        index.nearest(*targets[0], radius)
+    print(f"  {(time.perf_counter() - start) / 100 * 1000:.4f} ms to re-index a moved {sides}-vertex polygon and query")
+
+
+def bench_marquee(count=100_000, extent=20000, selected=5_000):
+    """Rubber-band selection: every shape tested, or a range query; then one more shape Ctrl-clicked in."""
+    folder = tempfile.mkdtemp()
+    try:
+        app = DrawingApp(HeadlessRoot(), RecordingRenderer(), recovery_dir=folder)
+        shapes = random_shapes(count, extent)
+        app.set_shapes(shapes)
+        print(f"marquee selection among {count} shapes")
+        for side in (800, extent // 2):
+            box = (1000, 1000, 1000 + side, 1000 + side)
+            start = time.perf_counter()
+            found = [shape for shape in shapes if box[0] <= shape.bbox()[0] and box[1] <= shape.bbox()[1]
+                     and shape.bbox()[2] <= box[2] and shape.bbox()[3] <= box[3]]
+            scan = time.perf_counter() - start
+            start = time.perf_counter()
+            inside = app.shapes_in(box)
+            query = time.perf_counter() - start
+            start = time.perf_counter()
+            crossing = app.shapes_in(box, crossing=True)
+            crossed = time.perf_counter() - start
+            assert len(found) == len(inside)
+            print(f"  {side:5}x{side:<5} scan {scan * 1000:8.2f} ms, range query {query * 1000:8.2f} ms "
+                  f"({len(inside)} inside), crossing {crossed * 1000:8.2f} ms ({len(crossing)})")
+        # every selected shape on screen, as after a marquee at a zoom that shows them all
+        app.view.scale = 800 / extent
+        app.redraw_all()
+        app.active_shapes = shapes[:selected]
+        app.update_highlights()
+        start = time.perf_counter()
+        app.active_shapes.append(shapes[selected])
+        app.update_highlights()
+        print(f"  one more into {selected} selected: {(time.perf_counter() - start) * 1000:.2f} ms")
+        app.quit()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_replay(count=2_000, drags=100, moves=10):
+    """Records dragging shapes of a loaded document around, replays it, and checks the replay ends the same."""
+    folder = tempfile.mkdtemp()
+    try:
+        app = DrawingApp(HeadlessRoot(), RecordingRenderer(), recovery_dir=folder)
+        app.set_shapes(random_shapes(count, extent=700))
+        app.save_to(os.path.join(folder, "base.skb"))  # saved strokes share their points with the snapshot
+        app.finish_save()
+        app.set_select_mode("")
+        path = os.path.join(folder, "session.jsonl")
+        app.start_recording(path)
+        rng = random.Random(5)
+        for _ in range(drags):
+            x0, y0, x1, y1 = rng.choice(app.shapes).bbox()
+            x, y = app.view.to_screen(x0, y0)
+            app.dispatch("<Button-1>", SimpleNamespace(x=x, y=y, state=0))
+            for step in range(1, moves + 1):
+                app.dispatch("<B1-Motion>", SimpleNamespace(x=x + 3 * step, y=y + 2 * step, state=0))
+                app.root.run(app.frame_ms)  # the frame timer, recorded like Tk's
+            app.dispatch("<ButtonRelease-1>", SimpleNamespace(x=x + 3 * moves, y=y + 2 * moves, state=0))
+            if rng.random() < 0.2:
+                app.dispatch("<Delete>", SimpleNamespace(x=x, y=y, state=0))
+        app.stop_recording()
+        expected = document_hash(app.shapes)
+        app.quit()
+        start = time.perf_counter()
+        result = replay_recording(path)
+        elapsed = time.perf_counter() - start
+        assert result["hash"] == expected, "the replay ended with another document"
+        print(f"replaying {drags} drags in a document of {count} shapes: {elapsed * 1000:.0f} ms, {result['events']} events")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    bench_hit_test()
+    bench_groups()
+    bench_shape_hits()
+    bench_lazy_move()
+    bench_paste()
+    bench_history()
+    bench_point_memory()
+    bench_stroke_simplification()
+    bench_file_formats()
+    bench_journal()
+    bench_render()
+    bench_detail_levels()
+    bench_motion()
+    bench_profiling()
+    bench_tiles()
+    bench_snapping()
+    bench_marquee()
+    bench_replay()
@@ -0,0 +1,288 @@
+"""Regression benchmarks: the editor's operations timed on synthetic documents.
+
+The app runs headless, on a RecordingRenderer and a HeadlessRoot, so the suite
+needs no display. Results are written as JSON, and two result files can be
+compared to catch slowdowns:
+
+    python benchsuite.py run --sizes 1000 10000 100000 --output new.json
+    python benchsuite.py compare old.json new.json --threshold 0.15
+
+compare exits with status 1 when an operation got slower than the threshold
+allows. Each case runs once to warm up and then `--repeat` times with the garbage
+collector paused. The fastest run is what gets compared: other processes and
+the garbage collector only ever add time, so the minimum varies least.
+"""
+from array import array
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from shapes import Line, Rectangle, Ellipse, Polygon, Freehand, Group
+from render import RecordingRenderer
+from SketchPad import DrawingApp, HeadlessRoot
+
+SIZES = [1_000, 10_000, 100_000]  # 1_000_000 works too, given the time and memory
+
+
+def stroke(rng, x, y, points):
+    """A random-walk freehand stroke starting at (x, y)."""
+    coords = array('d')
+    for _ in range(points):
+        x, y = x + rng.uniform(-4, 4), y + rng.uniform(-4, 4)
+        coords.append(x)
+        coords.append(y)
+    shape = Freehand("black")
+    shape.coords = coords
+    return shape
+
+
+def random_shape(rng, x, y, depth=0):
+    w, h = rng.uniform(5, 80), rng.uniform(5, 80)
+    kind = rng.random()
+    if kind < 0.25:
+        return Line((x, y), (x + w, y + h), "black")
+    if kind < 0.45:
+        return Rectangle((x, y), (x + w, y + h), "blue")
+    if kind < 0.65:
+        return Ellipse((x, y), (x + w, y + h), "red")
+    if kind < 0.80:
+        shape = Polygon("black")
+        shape.points = [(x + w * math.cos(a / 3), y + h * math.sin(a / 3)) for a in range(19)]
+        return shape
+    if kind < 0.95:
+        # most strokes are short scribbles, one in twenty is long
+        return stroke(rng, x, y, rng.randint(200, 1000) if rng.random() < 0.05 else rng.randint(20, 80))
+    if depth < 2:  # groups nest up to two levels deep
+        return Group([random_shape(rng, x + rng.uniform(-40, 40), y + rng.uniform(-40, 40), depth + 1)
+                      for _ in range(rng.randint(2, 5))])
+    return Line((x, y), (x + w, y + h), "black")
+
+
+def synthetic_document(count, seed=7):
+    """`count` top-level shapes spread at about one per 100 x 100 px, whatever the count."""
+    rng = random.Random(seed)
+    extent = math.sqrt(count) * 100
+    return [random_shape(rng, rng.uniform(0, extent), rng.uniform(0, extent)) for _ in range(count)]
+
+
+def event(x, y, state=0):
+    return SimpleNamespace(x=x, y=y, state=state)
+
+
+def select(app, rng, count):
+    app.active_shapes = rng.sample(app.shapes, min(count, len(app.shapes)))
+    app.update_highlights()
+
+
+def timed(operation, *args):
+    start = time.perf_counter()
+    operation(*args)
+    return time.perf_counter() - start
+
+
+# Each case runs one repetition and returns seconds per operation, by operation name.
+
+def case_hit_test(app, rng, clicks=100):
+    app.set_select_mode("")
+    extent = math.sqrt(len(app.shapes)) * 100
+    points = []
+    for i in range(clicks):
+        if i % 2:  # on a shape
+            box = rng.choice(app.shapes).bbox()
+            points.append(((box[0] + box[2]) / 2, (box[1] + box[3]) / 2))
+        else:  # anywhere, mostly empty space
+            points.append((rng.uniform(0, extent), rng.uniform(0, extent)))
+
+    def click_all():
+        for x, y in points:
+            app.start_action(event(x, y))
+            app.end_action(event(x, y))
+    return {"hit_test": timed(click_all) / clicks}
+
+
+def case_move(app, rng, steps=20):
+    select(app, rng, 10)
+
+    def drag():
+        for _ in range(steps):
+            app.move_shapes(app.active_shapes, 3, 2)
+    return {"move": timed(drag) / steps}
+
+
+def case_redraw(app, rng):
+    return {"redraw_all": timed(app.redraw_all)}
+
+
+def case_view(app, rng, steps=10):
+    """Frames while panning at 100%, and one zoomed out to show 64 times the area."""
+    app.reset_view()
+
+    def pan():
+        for _ in range(steps):
+            app.pan_view(-40, -25)
+    results = {"pan": timed(pan) / steps, "zoom_out": timed(app.zoom_view, 1 / 8, 0, 0)}
+    app.reset_view()
+    return results
+
+
+def case_history(app, rng):
+    select(app, rng, 10)
+    return {"delete": timed(app.delete_shapes), "undo": timed(app.undo), "redo": timed(app.redo),
+            "undo_again": timed(app.undo)}  # leaves the document as it was
+
+
+def case_copy_paste(app, rng):
+    select(app, rng, 10)
+    copy, paste = timed(app.copy_shapes), timed(app.paste_shapes)
+    app.undo()
+    return {"copy": copy, "paste": paste}
+
+
+def case_files(app, rng, folder):
+    results = {}
+    for extension in (".json", ".skb"):
+        path = os.path.join(folder, "document" + extension)
+        results["save_blocking" + extension] = timed(app.save_to, path)  # what the Tk thread spends
+        app.finish_save()
+
+        def save():
+            app.save_to(path)
+            app.finish_save()
+        results["save" + extension] = timed(save)
+
+        def load():
+            app.start_loading(path)
+            while app.loading:
+                app.root.run(1)
+        results["load" + extension] = timed(load)
+    return results
+
+
+CASES = {
+    "hit_test": case_hit_test,
+    "move": case_move,
+    "redraw": case_redraw,
+    "view": case_view,
+    "history": case_history,
+    "copy_paste": case_copy_paste,
+    "files": case_files,
+}
+
+
+def run_suite(sizes, repeat, cases, report=print):
+    folder = tempfile.mkdtemp()
+    results = {}
+    try:
+        for size in sizes:
+            document = synthetic_document(size)
+            app = DrawingApp(HeadlessRoot(), RecordingRenderer(), recovery_dir=folder)
+            app.set_shapes(document)
+            app.save_to(os.path.join(folder, "base.skb"))  # gives the journal a base
+            app.finish_save()
+            for name in cases:
+                case = CASES[name]
+                extra = (folder,) if case is case_files else ()
+                rng = random.Random(size)
+                samples = {}
+                for run in range(repeat + 1):
+                    gc.collect()
+                    gc.disable()
+                    try:
+                        timings = case(app, rng, *extra)
+                    finally:
+                        gc.enable()
+                    if run:  # the first run warms up
+                        for operation, seconds in timings.items():
+                            samples.setdefault(operation, []).append(seconds * 1000)
+                for operation, times in samples.items():
+                    key = f"{operation}/{size}"
+                    results[key] = {"median_ms": statistics.median(times), "min_ms": min(times),
+                                    "max_ms": max(times), "runs": len(times)}
+                    report(f"{key:24} {min(times):12.3f} ms  (median {results[key]['median_ms']:.3f})")
+            app.quit()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return {
+        "format": 1,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def compare(old, new, threshold, noise_ms=0.01):
+    """Compare two result sets. Returns the rows and the keys that got slower than `threshold` allows."""
+    rows, regressions = [], []
+    for key in sorted(set(old["results"]) | set(new["results"])):
+        before, after = old["results"].get(key), new["results"].get(key)
+        if before is None or after is None:
+            rows.append((key, before and before["min_ms"], after and after["min_ms"], None, "only in one"))
+            continue
+        before, after = before["min_ms"], after["min_ms"]
+        ratio = after / before if before else math.inf
+        status = ""
+        if ratio > 1 + threshold and after - before > noise_ms:
+            status = "SLOWER"
+            regressions.append(key)
+        elif ratio < 1 - threshold and before - after > noise_ms:
+            status = "faster"
+        rows.append((key, before, after, ratio, status))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="time the editor and write the results as JSON")
+    run.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="document sizes, in shapes")
+    run.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    run.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    run.add_argument("--output", help="result file (default: stdout)")
+    check = commands.add_parser("compare", help="compare two result files")
+    check.add_argument("baseline")
+    check.add_argument("results")
+    check.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown, 0.15 is 15%%")
+    options = parser.parse_args(argv)
+
+    if options.command == "run":
+        report = print if options.output else (lambda line: print(line, file=sys.stderr))
+        results = run_suite(options.sizes, options.repeat, options.cases, report)
+        if options.output:
+            with open(options.output, "w") as file:
+                json.dump(results, file, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+        return 0
+
+    with open(options.baseline) as file:
+        old = json.load(file)
+    with open(options.results) as file:
+        new = json.load(file)
+    rows, regressions = compare(old, new, options.threshold)
+    print(f"{'operation/size':24} {'baseline ms':>12} {'new ms':>12} {'ratio':>7}")
+    for key, before, after, ratio, status in rows:
+        print(f"{key:24} {fmt(before):>12} {fmt(after):>12} {fmt(ratio, 2):>7}  {status}")
+    if regressions:
+        print(f"{len(regressions)} operation(s) slower by more than {options.threshold:.0%}")
+        return 1
+    return 0
+
+
+def fmt(value, digits=3):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""Batch jobs on sketch files from the command line, without Tk.
+
+    python cli.py validate archive/
+    python cli.py convert archive/ --to skb --output-dir converted/
+    python cli.py png archive/ --size 256 --output-dir thumbnails/
+    python cli.py svg plan.json other.jsonl --output-dir svg/
+    python cli.py stats archive/ --json > stats.jsonl
+
+Arguments are files or folders; folders are searched for .json, .jsonl and .skb
+files. The files are spread over a pool of worker processes (--jobs), and each
+result is printed as soon as it is in, one line per file, with the error if the
+file failed. The exit status is 1 if any file failed (or didn't validate).
+
+New files are named after the input without its extension, plan.png for
+plan.json, unless two inputs would get the same name, as plan.json and plan.skb
+do, or the name is another input's; those keep their extension, plan.json.png.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain, islice
+
+from fileformats import BinaryReader, RecordReader, is_binary, read_shapes, write_shapes
+from render import export_png, export_svg
+from shapes import Group, IrRegularShape, RegularShape, Shape, SHAPE_CLASSES, bounding_box
+
+EXTENSIONS = (".json", ".jsonl", ".skb")
+
+
+def sketch_files(paths):
+    """The files named, and the sketch files in the folders named, in order, each once."""
+    seen = set()
+    for path in paths:
+        found = [path]
+        if os.path.isdir(path):
+            found = []
+            for folder, subfolders, names in os.walk(path):
+                subfolders.sort()
+                found += [os.path.join(folder, name) for name in sorted(names) if name.endswith(EXTENSIONS)]
+        for path in found:
+            if os.path.abspath(path) not in seen:
+                seen.add(os.path.abspath(path))
+                yield path
+
+
+def is_point(value):
+    return (isinstance(value, (list, tuple)) and len(value) == 2
+            and all(isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in value))
+
+
+def record_problems(record, where):
+    """What is wrong with a shape record, as messages naming it by `where`."""
+    shape_class = SHAPE_CLASSES.get(record.get("type")) if isinstance(record, dict) else None
+    if shape_class is None:
+        return [f"{where}: not a shape record" if not isinstance(record, dict)
+                else f"{where}: unknown type {record.get('type')!r}"]
+    if issubclass(shape_class, Group):
+        members = record.get("shapes")
+        if not isinstance(members, list) or not members:
+            return [f"{where}: group without shapes"]
+        return [problem for i, member in enumerate(members) for problem in record_problems(member, f"{where}.{i}")]
+    problems = []
+    if not isinstance(record.get("color"), str) or not record["color"]:
+        problems.append(f"{where}: bad color {record.get('color')!r}")
+    if issubclass(shape_class, RegularShape):
+        for key in ("start_point", "end_point"):
+            if not is_point(record.get(key)):
+                problems.append(f"{where}: bad {key} {record.get(key)!r}")
+    elif issubclass(shape_class, IrRegularShape):
+        points = record.get("points")
+        if not isinstance(points, list) or not points:
+            problems.append(f"{where}: no points")
+        else:
+            bad = sum(not is_point(point) for point in points)
+            if bad:
+                problems.append(f"{where}: {bad} bad points")
+    return problems
+
+
+def validate(path, **options):
+    problems = []
+    count = 0
+    if is_binary(path):
+        with BinaryReader(path, SHAPE_CLASSES) as reader:
+            records = [shape.to_dict() for shape in reader]
+    else:
+        with RecordReader(path) as reader:
+            records = list(reader)
+    for count, record in enumerate(records, 1):
+        found = record_problems(record, f"shape {count - 1}")
+        if not found:
+            try:
+                Shape.from_dict(record)
+            except (KeyError, TypeError, ValueError) as error:
+                found = [f"shape {count - 1}: {type(error).__name__}: {error}"]
+        problems += found
+    return {"ok": not problems, "message": f"{count} shapes" if not problems else
+            "; ".join(problems[:5]) + (f"; and {len(problems) - 5} more" if len(problems) > 5 else ""),
+            "shapes": count, "problems": len(problems)}
+
+
+def output_paths(paths, extension, output_dir):
+    """Where each file's output goes, by input path; None where no name is free of the others."""
+    def target(path, name):
+        return os.path.join(output_dir or os.path.dirname(path), name + extension)
+
+    inputs = {os.path.abspath(path) for path in paths}
+    targets = {path: target(path, os.path.splitext(os.path.basename(path))[0]) for path in paths}
+    whole = set()  # inputs already named with their extension
+    changed = True
+    while changed:
+        changed = False
+        holders = {}
+        for path, name in targets.items():
+            if name is not None and os.path.abspath(name) != os.path.abspath(path):  # else: overwrites its input
+                holders.setdefault(os.path.abspath(name), []).append(path)
+        for key, owners in holders.items():
+            if len(owners) == 1 and key not in inputs:
+                continue
+            # written twice, or read by another job: the stem names give way first
+            renamed = [path for path in owners if path not in whole]
+            for path in renamed:
+                targets[path] = target(path, os.path.basename(path))
+                whole.add(path)
+            if not renamed:  # no name left to try
+                for path in owners:
+                    targets[path] = None
+            changed = True
+    return targets
+
+
+def check_output(path, output):
+    if output is None:
+        raise ValueError("its output would have the name of another file's output, or of an input")
+    if os.path.abspath(output) == os.path.abspath(path):
+        raise ValueError(f"{output} would overwrite the input")
+
+
+def convert(path, to, output, **options):
+    check_output(path, output)
+    target = output
+    shapes = read_shapes(path, SHAPE_CLASSES)
+    write_shapes(target, shapes)
+    return {"ok": True, "message": f"{len(shapes)} shapes to {target}", "output": target}
+
+
+def png(path, output, size=None, **options):
+    check_output(path, output)
+    target = output
+    raster = export_png(read_shapes(path, SHAPE_CLASSES), target, size=size)
+    return {"ok": True, "message": f"{raster.width}x{raster.height} to {target}", "output": target}
+
+
+def svg(path, output, size=None, **options):
+    check_output(path, output)
+    target = output
+    export_svg(read_shapes(path, SHAPE_CLASSES), target, size=size)
+    return {"ok": True, "message": f"to {target}", "output": target}
+
+
+def count_shapes(shapes, types):
+    """Add the shapes, group members included, to types by type name; returns their points."""
+    points = 0
+    for shape in shapes:
+        name = type(shape).__name__
+        types[name] = types.get(name, 0) + 1
+        if isinstance(shape, Group):
+            points += count_shapes(shape.shapes, types)
+        elif isinstance(shape, IrRegularShape):
+            points += shape.point_count()
+        else:
+            points += 2
+    return points
+
+
+def stats(path, **options):
+    start = time.perf_counter()
+    shapes = read_shapes(path, SHAPE_CLASSES)
+    load = time.perf_counter() - start
+    types = {}
+    points = count_shapes(shapes, types)
+    box = bounding_box(shapes)
+    return {"ok": True, "message": f"{len(shapes)} shapes, {points} points, "
+                                   + ", ".join(f"{count} {name}" for name, count in sorted(types.items())),
+            "shapes": len(shapes), "points": points, "types": types, "bbox": box,
+            "bytes": os.path.getsize(path), "load_ms": load * 1000}
+
+
+COMMANDS = {"validate": validate, "convert": convert, "png": png, "svg": svg, "stats": stats}
+OUTPUTS = {"convert": lambda options: "." + options["to"], "png": lambda options: ".png",
+           "svg": lambda options: ".svg"}  # extension of the files the command writes
+WORKER_DIED = ("BrokenProcessPool: a worker process died, e.g. killed for running out of memory, "
+               "while this file was queued or running; --jobs 1 tells which file it was")
+
+
+def run(command, path, options):
+    """Do one command on one file, in a worker process. Errors come back as results."""
+    start = time.perf_counter()
+    try:
+        result = COMMANDS[command](path, **options)
+    except Exception as error:  # one bad file must not stop the batch
+        result = {"ok": False, "message": f"{type(error).__name__}: {error}"}
+    result["path"] = path
+    result["ms"] = (time.perf_counter() - start) * 1000
+    return result
+
+
+def results(command, tasks, jobs):
+    """Run the command on every (path, options) task, yielding the results as they are done.
+
+    Only a few tasks per worker are handed to the pool at a time. If a worker dies, the
+    pool is lost with the tasks it held: those are reported as failed and the rest go
+    on in a new pool.
+    """
+    if jobs == 1:  # in this process: easier to debug and profile
+        for path, options in tasks:
+            yield run(command, path, options)
+        return
+    tasks = iter(tasks)
+    pool = ProcessPoolExecutor(jobs)
+    running = {}  # future -> path
+    broken = False
+    try:
+        while True:
+            if broken and not running:
+                pool.shutdown()
+                pool, broken = ProcessPoolExecutor(jobs), False
+            if not broken:
+                for path, options in islice(tasks, 2 * jobs - len(running)):
+                    try:
+                        running[pool.submit(run, command, path, options)] = path
+                    except BrokenProcessPool:
+                        tasks = chain([(path, options)], tasks)  # for the next pool
+                        broken = True
+                        break
+            if not running:
+                if broken:
+                    continue
+                return
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    broken = True
+                    yield {"ok": False, "message": WORKER_DIED, "path": path, "ms": 0.0}
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    helps = {"validate": "check that every shape record is well formed",
+             "convert": "rewrite in another format", "png": "render to PNG", "svg": "render to SVG",
+             "stats": "count shapes and points"}
+    for name, text in helps.items():
+        command = commands.add_parser(name, help=text)
+        command.add_argument("paths", nargs="+", help="sketch files, or folders to search for them")
+        command.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+        command.add_argument("--json", action="store_true", help="print each result as a JSON line")
+        if name == "convert":
+            command.add_argument("--to", choices=("json", "jsonl", "skb"), required=True)
+        if name in ("png", "svg"):
+            command.add_argument("--size", type=int, help="scale down to fit size x size pixels, for thumbnails")
+        if name in ("convert", "png", "svg"):
+            command.add_argument("--output-dir", help="where the new files go (default: next to each input)")
+    options = parser.parse_args(argv)
+
+    command_options = {key: getattr(options, key) for key in ("to", "size", "output_dir") if hasattr(options, key)}
+    if command_options.get("output_dir"):
+        os.makedirs(command_options["output_dir"], exist_ok=True)
+    paths = list(sketch_files(options.paths))
+    if options.command in OUTPUTS:
+        extension = OUTPUTS[options.command](command_options)
+        outputs = output_paths(paths, extension, command_options.pop("output_dir"))
+        tasks = [(path, dict(command_options, output=outputs[path])) for path in paths]
+    else:
+        tasks = [(path, command_options) for path in paths]
+    failed = 0
+    start = time.perf_counter()
+    for done, result in enumerate(results(options.command, tasks, max(1, options.jobs)), 1):
+        failed += not result["ok"]
+        if options.json:
+            print(json.dumps(result), flush=True)
+        else:
+            status = "ok  " if result["ok"] else "FAIL"
+            print(f"[{done}/{len(paths)}] {status} {result['path']}: {result['message']}", flush=True)
+    print(f"{len(paths)} files, {failed} failed, {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""Reading and writing sketch files.
+
+A sketch is a list of shape records, the dicts made by Shape.to_dict. Two text
+layouts are understood: the original one, a single JSON array, and JSON Lines
+(.jsonl), one top-level shape per line. Both can be read a record at a time.
+There is also a compact, versioned binary format (.skb) that stores coordinates
+as packed doubles and is loaded through mmap.
+"""
+from array import array
+import codecs
+import json
+import mmap
+import os
+import struct
+import sys
+
+
+def write_json(path, records):
+    with open(path, "w") as file:
+        json.dump(records, file)
+
+
+def write_jsonl(path, records):
+    with open(path, "w") as file:
+        for record in records:
+            file.write(json.dumps(record))
+            file.write("\n")
+
+
+def write_records(path, records):
+    """Write records in the layout the file extension asks for."""
+    if path.endswith(".jsonl"):
+        write_jsonl(path, records)
+    else:
+        write_json(path, records)
+
+
+class RecordReader:
+    """Yields the shape records of a sketch file one by one, without reading it whole.
+
+    The layout is detected from the first character: '[' for a JSON array, '{' for
+    JSON Lines. progress() says how much of the file has been read so far.
+    """
+
+    def __init__(self, path, block_size=1 << 20):
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.block_size = block_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def progress(self):
+        return self.file.tell() / self.size if self.size else 1.0
+
+    def __iter__(self):
+        head = self.file.read(self.block_size)
+        while True:
+            stripped = head.lstrip()
+            if stripped.startswith(b"\xef\xbb\xbf"):  # tolerate a UTF-8 byte order mark
+                stripped = stripped[3:].lstrip()
+            block = self.file.read(self.block_size) if len(stripped) < 3 else b""
+            if not block:
+                break
+            head += block
+        if stripped.startswith(b"["):
+            return self.iter_array(head)
+        if stripped.startswith(b"{") or not stripped:
+            return self.iter_lines(head)
+        raise ValueError("not a sketch file")
+
+    def iter_lines(self, head):
+        pending = b""
+        while head:
+            lines = (pending + head).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            head = self.file.read(self.block_size)
+        if pending.strip():
+            yield json.loads(pending)
+
+    def iter_array(self, head):
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+        text = utf8.decode(head)
+        position = text.index("[") + 1
+        at_end = False
+        while True:
+            # skip the separators between records
+            while position < len(text) and text[position] in " \t\r\n,":
+                position += 1
+            if position < len(text) and text[position] == "]":
+                return
+            if position < len(text):
+                try:
+                    record, position = decoder.raw_decode(text, position)
+                    yield record
+                    continue
+                except json.JSONDecodeError:
+                    if at_end:
+                        raise
+            elif at_end:
+                raise ValueError("sketch file ends before the closing ']'")
+            # the next record is cut off, read more; at least as much again as is buffered,
+            # so a record spanning many blocks isn't re-parsed once per block
+            text = text[position:]
+            position = 0
+            wanted = max(self.block_size, len(text))
+            block = self.file.read(wanted)
+            at_end = len(block) < wanted
+            text += utf8.decode(block, final=at_end)
+
+
+# Binary layout (.skb), all little-endian:
+#   header      HEADER
+#   type table  per type: kind (B), name length (B), UTF-8 name
+#   color table per color: length (H), UTF-8 color string
+#   padding to a multiple of 8
+#   nodes       NODE per shape, depth first; a group is followed by its children
+#   padding to a multiple of 8
+#   coordinates every point buffer back to back, float64
+# A node holds its type index, color index (NO_COLOR for groups), its count
+# (children for a group, points otherwise) and where its points start, counted
+# in coordinates from the start of the coordinate section.
+MAGIC = b"SKPB"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIHIIQ")  # magic, version, flags, top-level shapes, types, colors, nodes, coordinates
+NODE = struct.Struct("<HIIQ")  # type, color, count, first coordinate
+NO_COLOR = 0xFFFFFFFF
+POINTS, BOX, GROUP = 0, 1, 2  # how a type stores its geometry
+
+
+def shape_kind(shape):
+    if hasattr(shape, "shapes"):
+        return GROUP
+    if hasattr(shape, "coords"):
+        return POINTS
+    return BOX
+
+
+def padding(offset):
+    return -offset % 8
+
+
+def little_endian(coords):
+    if sys.byteorder == "big":
+        coords = array("d", coords)
+        coords.byteswap()
+    return coords
+
+
+def write_binary(path, shapes):
+    types, colors, nodes, buffers = {}, {}, [], []
+    coordinate_count = 0
+
+    def visit(shape):
+        nonlocal coordinate_count
+        kind = shape_kind(shape)
+        type_index = types.setdefault(type(shape).__name__, (len(types), kind))[0]
+        color = NO_COLOR if shape.color is None else colors.setdefault(shape.color, len(colors))
+        if kind == GROUP:
+            nodes.append(NODE.pack(type_index, color, len(shape.shapes), 0))
+            for child in shape.shapes:
+                visit(child)
+            return
+        if kind == POINTS:
+            coords = shape.coords
+        else:
+            coords = array("d", (*shape.start_point, *shape.end_point))
+        nodes.append(NODE.pack(type_index, color, len(coords) // 2, coordinate_count))
+        buffers.append(little_endian(coords).tobytes())
+        coordinate_count += len(coords)
+
+    for shape in shapes:
+        visit(shape)
+    tables = bytearray()
+    for name, (_, kind) in types.items():
+        encoded = name.encode()
+        tables += struct.pack("<BB", kind, len(encoded)) + encoded
+    for color in colors:
+        encoded = color.encode()
+        tables += struct.pack("<H", len(encoded)) + encoded
+    tables += bytes(padding(HEADER.size + len(tables)))
+    node_bytes = b"".join(nodes)
+    with open(path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, 0, len(shapes), len(types), len(colors), len(nodes), coordinate_count))
+        file.write(tables)
+        file.write(node_bytes)
+        file.write(bytes(padding(len(node_bytes))))
+        for buffer in buffers:
+            file.write(buffer)
+
+
+def is_binary(path):
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+class BinaryReader:
+    """Yields the top-level shapes of a .skb file, building them straight from a memory map.
+
+    Point buffers are copied out of the map in one go each, nothing is parsed per
+    coordinate. `classes` maps the type names stored in the file to shape classes.
+    """
+
+    def __init__(self, path, classes):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        (magic, version, _, self.shape_count, type_count, color_count,
+         self.node_count, coordinate_count) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("not a binary sketch file")
+        if version > VERSION:
+            self.close()
+            raise ValueError(f"binary sketch version {version} is newer than this program")
+        offset = HEADER.size
+        self.types = []
+        for _ in range(type_count):
+            kind, length = struct.unpack_from("<BB", self.map, offset)
+            name = bytes(self.view[offset + 2:offset + 2 + length]).decode()
+            self.types.append((classes[name], kind))
+            offset += 2 + length
+        self.colors = []
+        for _ in range(color_count):
+            (length,) = struct.unpack_from("<H", self.map, offset)
+            self.colors.append(bytes(self.view[offset + 2:offset + 2 + length]).decode())
+            offset += 2 + length
+        offset += padding(offset)
+        self.node_offset = offset
+        self.coordinate_offset = offset + self.node_count * NODE.size
+        self.coordinate_offset += padding(self.coordinate_offset)
+        if self.coordinate_offset + coordinate_count * 8 > len(self.map):
+            self.close()
+            raise ValueError("binary sketch file is truncated")
+        self.nodes_read = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.view.release()
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+    def progress(self):
+        return self.nodes_read / self.node_count if self.node_count else 1.0
+
+    def __iter__(self):
+        for _ in range(self.shape_count):
+            yield self.read_shape()
+
+    def read_shape(self):
+        type_index, color_index, count, first = NODE.unpack_from(self.map, self.node_offset + self.nodes_read * NODE.size)
+        self.nodes_read += 1
+        shape_class, kind = self.types[type_index]
+        if kind == GROUP:
+            return shape_class([self.read_shape() for _ in range(count)])
+        start = self.coordinate_offset + first * 8
+        coords = array("d")
+        coords.frombytes(self.view[start:start + count * 16])
+        if sys.byteorder == "big":
+            coords.byteswap()
+        color = None if color_index == NO_COLOR else self.colors[color_index]
+        if kind == POINTS:
+            shape = shape_class(color)
+            shape.coords = coords
+            return shape
+        # whole numbers come back as ints, the way the mouse produced them
+        x1, y1, x2, y2 = (int(value) if value.is_integer() else value for value in coords)
+        return shape_class((x1, y1), (x2, y2), color)
+
+
+def read_shapes(path, classes):
+    """Load every shape of a sketch file in any supported format."""
+    if is_binary(path):
+        with BinaryReader(path, classes) as reader:
+            return list(reader)
+    with RecordReader(path) as reader:
+        return [classes[record["type"]].from_dict(record) for record in reader]
+
+
+def write_shapes(path, shapes):
+    """Save shapes in the format the file extension asks for: .skb binary, .jsonl or .json."""
+    if path.endswith(".skb"):
+        write_binary(path, shapes)
+    else:
+        write_records(path, [shape.to_dict() for shape in shapes])
+
+
+def save_shapes(path, shapes):
+    """write_shapes, all or nothing: into a temporary file next to `path`, synced, then renamed over it.
+
+    A crash or an error part way leaves the old file as it was.
+    """
+    stem, extension = os.path.splitext(path)
+    temporary = f"{stem}.saving{extension}"  # keeps the extension, which picks the format
+    try:
+        write_shapes(temporary, shapes)
+        with open(temporary, "r+b") as file:
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
+
+
+def convert(source, target, classes):
+    """Rewrite a sketch in another format, e.g. convert("plan.json", "plan.skb", classes)."""
+    write_shapes(target, read_shapes(source, classes))
@@ -0,0 +1,201 @@
+"""Geometry helpers that work on flat x0, y0, x1, y1, ... coordinate buffers."""
+from array import array
+import math
+
+
+def segment_distance(px, py, x1, y1, x2, y2):
+    """Distance from (px, py) to the segment (x1, y1)-(x2, y2)."""
+    dx, dy = x2 - x1, y2 - y1
+    length = dx * dx + dy * dy
+    if length == 0:
+        return math.hypot(px - x1, py - y1)
+    t = ((px - x1) * dx + (py - y1) * dy) / length
+    t = 0.0 if t < 0 else 1.0 if t > 1 else t
+    return math.hypot(px - x1 - t * dx, py - y1 - t * dy)
+
+
+def near_segments(coords, px, py, distance, indices):
+    """Whether (px, py) is within `distance` of a segment from point i to point i + 1, for i in `indices`.
+
+    Works on the flat buffer directly and skips segments whose box is too far away
+    before measuring, so a hit test builds no objects per segment.
+    """
+    limit = distance * distance
+    for i in indices:
+        j = 2 * i
+        x1, y1, x2, y2 = coords[j], coords[j + 1], coords[j + 2], coords[j + 3]
+        if ((px < x1 - distance and px < x2 - distance) or (px > x1 + distance and px > x2 + distance)
+                or (py < y1 - distance and py < y2 - distance) or (py > y1 + distance and py > y2 + distance)):
+            continue
+        dx, dy = x2 - x1, y2 - y1
+        ex, ey = px - x1, py - y1
+        length = dx * dx + dy * dy
+        if length:
+            t = (ex * dx + ey * dy) / length
+            t = 0.0 if t < 0 else 1.0 if t > 1 else t
+            ex, ey = ex - t * dx, ey - t * dy
+        if ex * ex + ey * ey <= limit:
+            return True
+    return False
+
+
+def near_polyline(coords, px, py, distance, grid=None):
+    """Whether (px, py) is within `distance` of the polyline, a lone point counting as a dot."""
+    if len(coords) == 2:
+        return (px - coords[0]) ** 2 + (py - coords[1]) ** 2 <= distance * distance
+    if grid is not None:
+        return grid.near(coords, px, py, distance)
+    return near_segments(coords, px, py, distance, range(len(coords) // 2 - 1))
+
+
+def inside_polygon(coords, px, py):
+    """Even-odd test of (px, py) against the polygon through the points, closed back to the first."""
+    inside = False
+    x1, y1 = coords[-2], coords[-1]
+    for j in range(0, len(coords), 2):
+        x2, y2 = coords[j], coords[j + 1]
+        if (y1 > py) != (y2 > py) and px < x1 + (py - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+        x1, y1 = x2, y2
+    return inside
+
+
+def segment_in_box(x1, y1, x2, y2, box):
+    """Whether the segment (x1, y1)-(x2, y2) touches the box (left, top, right, bottom).
+
+    Clips the segment to the box one side at a time (Liang-Barsky); it touches the
+    box if some of it is left.
+    """
+    t0, t1 = 0.0, 1.0
+    dx, dy = x2 - x1, y2 - y1
+    for p, q in ((-dx, x1 - box[0]), (dx, box[2] - x1), (-dy, y1 - box[1]), (dy, box[3] - y1)):
+        if p == 0:  # parallel to this side
+            if q < 0:
+                return False
+        elif p < 0:
+            t = q / p
+            if t > t1:
+                return False
+            if t > t0:
+                t0 = t
+        else:
+            t = q / p
+            if t < t0:
+                return False
+            if t < t1:
+                t1 = t
+    return True
+
+
+def polyline_in_box(coords, box, closed=False):
+    """Whether the polyline (closed back to its first point, if asked) touches the box."""
+    left, top, right, bottom = box
+    if len(coords) == 2:
+        return left <= coords[0] <= right and top <= coords[1] <= bottom
+    x1, y1 = (coords[-2], coords[-1]) if closed else (coords[0], coords[1])
+    for j in range(0 if closed else 2, len(coords), 2):
+        x2, y2 = coords[j], coords[j + 1]
+        if not ((x1 < left and x2 < left) or (x1 > right and x2 > right)
+                or (y1 < top and y2 < top) or (y1 > bottom and y2 > bottom)) \
+                and segment_in_box(x1, y1, x2, y2, box):
+            return True
+        x1, y1 = x2, y2
+    return False
+
+
+class SegmentGrid:
+    """The segments of a long polyline bucketed by the grid cells their boxes cover.
+
+    A hit test then measures the few segments in the cells around the point instead
+    of all of them. Cells are a few segments long; a segment that would cover more
+    than `max_cells` cells goes in `long`, which every query checks. The grid holds
+    segment numbers, not coordinates, so it follows the buffer it was built from as
+    long as the points only move, together with shift.
+    """
+    __slots__ = ('cell', 'x0', 'y0', 'cells', 'long')
+
+    def __init__(self, coords, max_cells=64):
+        count = len(coords) // 2 - 1
+        xs, ys = coords[0::2], coords[1::2]
+        length = sum(math.hypot(xs[i + 1] - xs[i], ys[i + 1] - ys[i]) for i in range(count))
+        self.cell = cell = max(4 * length / max(count, 1), 1.0)
+        self.x0, self.y0 = x0, y0 = min(xs), min(ys)
+        self.cells = cells = {}  # (column, row) -> segment numbers
+        self.long = []
+        for i in range(count):
+            x1, x2 = (xs[i], xs[i + 1]) if xs[i] <= xs[i + 1] else (xs[i + 1], xs[i])
+            y1, y2 = (ys[i], ys[i + 1]) if ys[i] <= ys[i + 1] else (ys[i + 1], ys[i])
+            c1, c2 = int((x1 - x0) // cell), int((x2 - x0) // cell)
+            r1, r2 = int((y1 - y0) // cell), int((y2 - y0) // cell)
+            if (c2 - c1 + 1) * (r2 - r1 + 1) > max_cells:
+                self.long.append(i)
+                continue
+            for column in range(c1, c2 + 1):
+                for row in range(r1, r2 + 1):
+                    bucket = cells.get((column, row))
+                    if bucket is None:
+                        cells[(column, row)] = [i]
+                    else:
+                        bucket.append(i)
+
+    def shift(self, dx, dy):
+        """Follow the buffer after it was translated by (dx, dy)."""
+        self.x0 += dx
+        self.y0 += dy
+
+    def near(self, coords, px, py, distance):
+        """Whether (px, py) is within `distance` of a segment of `coords`, the buffer the grid was built from."""
+        cell, x0, y0, cells = self.cell, self.x0, self.y0, self.cells
+        for column in range(int((px - distance - x0) // cell), int((px + distance - x0) // cell) + 1):
+            for row in range(int((py - distance - y0) // cell), int((py + distance - y0) // cell) + 1):
+                bucket = cells.get((column, row))
+                if bucket is not None and near_segments(coords, px, py, distance, bucket):
+                    return True
+        return near_segments(coords, px, py, distance, self.long)
+
+
+def translate(coords, dx, dy):
+    """Shift a flat coordinate buffer in place; the buffer keeps its identity and size."""
+    coords[0::2] = array('d', [x + dx for x in coords[0::2]])
+    coords[1::2] = array('d', [y + dy for y in coords[1::2]])
+
+
+def simplify(coords, tolerance):
+    """Ramer-Douglas-Peucker simplification of a polyline.
+
+    Returns a new buffer whose first and last points match the input, and every
+    dropped point lies within `tolerance` of the simplified line.
+    """
+    count = len(coords) // 2
+    if count < 3 or tolerance <= 0:
+        return array('d', coords)
+    keep = bytearray(count)
+    keep[0] = keep[count - 1] = 1
+    limit = tolerance * tolerance
+    stack = [(0, count - 1)]  # explicit stack, long strokes would overflow recursion
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = coords[2 * first], coords[2 * first + 1]
+        x2, y2 = coords[2 * last], coords[2 * last + 1]
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        worst, worst_index = -1.0, 0
+        for i in range(first + 1, last):
+            px, py = coords[2 * i] - x1, coords[2 * i + 1] - y1
+            if length:
+                t = (px * dx + py * dy) / length
+                t = 0.0 if t < 0 else 1.0 if t > 1 else t
+                px, py = px - t * dx, py - t * dy
+            distance = px * px + py * py  # squared, compared against limit
+            if distance > worst:
+                worst, worst_index = distance, i
+        if worst > limit:
+            keep[worst_index] = 1
+            stack.append((first, worst_index))
+            stack.append((worst_index, last))
+    result = array('d')
+    for i in range(count):
+        if keep[i]:
+            result.append(coords[2 * i])
+            result.append(coords[2 * i + 1])
+    return result
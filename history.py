@@ -0,0 +1,337 @@
+"""Undo/redo history built from small commands instead of document snapshots.
+
+A command only remembers what its operation touched, so undoing or redoing it costs
+as much as the change itself, not as much as the document. Commands act on the app
+through add_shape, insert_shape, remove_shape and move_shapes, which keep the canvas
+items and the spatial index in step with the shapes list.
+
+What the history holds beyond the document is mostly deleted shapes. Past a memory
+budget, the oldest undo steps are packed: written out as zlib-compressed JSON, and
+read back when undo reaches them. Past a second budget, packed steps move from memory
+to a temporary file. Packed steps can't hold on to shapes, so they name the shapes
+still in the document by history_key. History is linear: when a step is undone, the
+document is back to what it was right after the step, so the shapes it names are there.
+"""
+import json
+import tempfile
+import zlib
+
+from shapes import Group, IrRegularShape, Shape
+
+COMMAND_BYTES = 200  # rough size of a command object and its lists
+SHAPE_BYTES = 300  # rough size of a shape object, without its points
+
+
+def footprint(shape):
+    """Rough bytes of memory a shape holds."""
+    if isinstance(shape, Group):
+        return SHAPE_BYTES + sum(footprint(member) for member in shape.shapes)
+    if isinstance(shape, IrRegularShape):
+        return SHAPE_BYTES + 16 * shape.point_count()
+    return SHAPE_BYTES
+
+
+def pack_shape(shape, key):
+    """A shape as JSON data, with the history keys of it and its members."""
+    return {"keys": pack_keys(shape, key), "shape": shape.to_dict()}
+
+
+def pack_keys(shape, key):
+    if isinstance(shape, Group):
+        return [key(shape), [pack_keys(member, key) for member in shape.shapes]]
+    return key(shape)
+
+
+def unpack_shape(data):
+    shape = Shape.from_dict(data["shape"])
+    unpack_keys(shape, data["keys"])
+    return shape
+
+
+def unpack_keys(shape, keys):
+    if isinstance(shape, Group):
+        shape.history_key, member_keys = keys
+        for member, keys in zip(shape.shapes, member_keys):
+            unpack_keys(member, keys)
+    else:
+        shape.history_key = keys
+
+
+class Command:
+    def do(self, app):
+        raise NotImplementedError
+
+    def undo(self, app):
+        raise NotImplementedError
+
+    def footprint(self):
+        """Rough bytes of memory the command keeps alive besides the document."""
+        return COMMAND_BYTES
+
+    def pack(self, key):
+        """The command as JSON data, shapes in the document named by key(shape)."""
+        raise NotImplementedError
+
+    @classmethod
+    def unpack(cls, data, shapes):
+        """Rebuild a packed command; `shapes` maps history keys to the document's shapes."""
+        raise NotImplementedError
+
+
+class AddShapes(Command):
+    """New shapes on top of the document: drawing, paste."""
+
+    def __init__(self, shapes):
+        self.shapes = list(shapes)
+
+    def do(self, app):
+        for shape in self.shapes:
+            app.add_shape(shape)
+
+    def undo(self, app):
+        for shape in self.shapes:
+            app.remove_shape(shape)
+
+    def pack(self, key):
+        return {"keys": [key(shape) for shape in self.shapes]}
+
+    @classmethod
+    def unpack(cls, data, shapes):
+        return cls(shapes[shape_key] for shape_key in data["keys"])
+
+
+class RemoveShapes(Command):
+    """Delete and cut. Remembers where each shape sat so undo restores the stacking order."""
+
+    def __init__(self, shapes):
+        self.shapes = list(shapes)
+        self.positions = []
+
+    def do(self, app):
+        if len(self.shapes) < 16:
+            placed = sorted(((app.shapes.index(shape), shape) for shape in self.shapes), key=lambda item: item[0])
+        else:  # one pass over the document beats many list.index scans
+            wanted = set(self.shapes)
+            placed = [(position, shape) for position, shape in enumerate(app.shapes) if shape in wanted]
+        self.positions = placed
+        for position, shape in reversed(placed):
+            app.remove_shape(shape, position)
+
+    def undo(self, app):
+        for position, shape in self.positions:
+            app.insert_shape(position, shape)
+
+    def footprint(self):
+        return COMMAND_BYTES + sum(footprint(shape) for shape in self.shapes)
+
+    def pack(self, key):
+        # the removed shapes are only here, so they go in whole
+        return {"removed": [[position, pack_shape(shape, key)] for position, shape in self.positions]}
+
+    @classmethod
+    def unpack(cls, data, shapes):
+        command = cls([])
+        command.positions = [(position, unpack_shape(shape)) for position, shape in data["removed"]]
+        command.shapes = [shape for _, shape in command.positions]
+        return command
+
+
+class MoveShapes(Command):
+    def __init__(self, shapes, dx, dy):
+        self.shapes = list(shapes)
+        self.dx, self.dy = dx, dy
+
+    def do(self, app):
+        app.move_shapes(self.shapes, self.dx, self.dy)
+
+    def undo(self, app):
+        app.move_shapes(self.shapes, -self.dx, -self.dy)
+
+    def pack(self, key):
+        return {"keys": [key(shape) for shape in self.shapes], "dx": self.dx, "dy": self.dy}
+
+    @classmethod
+    def unpack(cls, data, shapes):
+        return cls([shapes[shape_key] for shape_key in data["keys"]], data["dx"], data["dy"])
+
+
+class GroupShapes(Command):
+    def __init__(self, group):
+        self.group = group
+        self.members = RemoveShapes(group.shapes)
+
+    def do(self, app):
+        self.members.do(app)
+        app.add_shape(self.group)
+
+    def undo(self, app):
+        app.remove_shape(self.group)
+        self.members.undo(app)
+
+    def pack(self, key):
+        index = {id(member): i for i, member in enumerate(self.group.shapes)}
+        return {"key": key(self.group),
+                "positions": [[position, index[id(member)]] for position, member in self.members.positions]}
+
+    @classmethod
+    def unpack(cls, data, shapes):
+        command = cls(shapes[data["key"]])
+        members = command.group.shapes
+        command.members.positions = [(position, members[i]) for position, i in data["positions"]]
+        return command
+
+
+class UngroupShapes(Command):
+    def __init__(self, group):
+        self.group = group
+        self.removed = RemoveShapes([group])
+
+    def do(self, app):
+        self.removed.do(app)
+        for shape in self.group.shapes:
+            app.add_shape(shape)
+
+    def undo(self, app):
+        for shape in self.group.shapes:
+            app.remove_shape(shape)
+        self.removed.undo(app)
+
+    def pack(self, key):
+        (position, _), = self.removed.positions
+        return {"keys": [key(shape) for shape in self.group.shapes], "key": key(self.group), "at": position}
+
+    @classmethod
+    def unpack(cls, data, shapes):
+        group = Group([shapes[shape_key] for shape_key in data["keys"]])
+        group.history_key = data["key"]
+        command = cls(group)
+        command.removed.positions = [(data["at"], group)]
+        return command
+
+
+# Command classes by the name stored in packed steps
+COMMAND_CLASSES = {command_class.__name__: command_class
+                   for command_class in (AddShapes, RemoveShapes, MoveShapes, GroupShapes, UngroupShapes)}
+
+
+class Packed:
+    """An undo step stored as compressed JSON: in memory (data), or in the spill file at offset."""
+    __slots__ = ('data', 'offset', 'size')
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = None
+        self.size = len(data)
+
+
+class History:
+    # The undo stack holds, from the bottom: steps spilled to the file, packed steps
+    # in memory, then live commands. The file is a stack too, so reading a step back
+    # truncates the file to where it began.
+    def __init__(self, budget=64 << 20, packed_budget=16 << 20):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.budget = budget  # Estimated bytes of live undo commands before the oldest get packed
+        self.packed_budget = packed_budget  # Compressed bytes kept in memory before the oldest go to disk
+        self.live_bytes = 0
+        self.packed_bytes = 0
+        self.packed = 0  # Packed steps at the bottom of undo_stack, spilled ones included
+        self.spilled = 0  # Steps at the bottom of undo_stack that are in the spill file
+        self.spill = None  # Temporary file, opened when first needed
+        self.next_key = 0
+
+    def execute(self, command, app):
+        """Apply a command and record it."""
+        command.do(app)
+        self.record(command)
+
+    def record(self, command):
+        """Record a command whose effect has already been applied, e.g. a finished drag."""
+        self.push(command)
+        self.redo_stack.clear()  # Clear redo stack on a new action
+
+    def undo(self, app):
+        if self.undo_stack:
+            command = self.pop(app)
+            command.undo(app)
+            self.redo_stack.append(command)
+            return command
+
+    def redo(self, app):
+        if self.redo_stack:
+            command = self.redo_stack.pop()
+            command.do(app)
+            self.push(command)
+            return command
+
+    def push(self, command):
+        command.size = command.footprint()
+        self.undo_stack.append(command)
+        self.live_bytes += command.size
+        self.trim()
+
+    def pop(self, app):
+        """Take the newest undo step off the stack, reading it back if it was packed."""
+        entry = self.undo_stack.pop()
+        if not isinstance(entry, Packed):
+            self.live_bytes -= entry.size
+            return entry
+        self.packed -= 1
+        if entry.data is None:
+            self.spilled -= 1
+            self.spill.seek(entry.offset)
+            data = self.spill.read(entry.size)
+            self.spill.truncate(entry.offset)
+        else:
+            data = entry.data
+            self.packed_bytes -= entry.size
+        record = json.loads(zlib.decompress(data))
+        shapes = {shape.history_key: shape for shape in app.shapes if shape.history_key is not None}
+        return COMMAND_CLASSES[record["type"]].unpack(record, shapes)
+
+    def trim(self):
+        """Pack the oldest live commands past the budget, and spill the oldest packed ones past theirs."""
+        # the newest command stays live: it may still be changing, like a stroke being drawn
+        while self.live_bytes > self.budget and len(self.undo_stack) - self.packed > 1:
+            command = self.undo_stack[self.packed]
+            record = command.pack(self.key)
+            record["type"] = type(command).__name__
+            entry = Packed(zlib.compress(json.dumps(record, separators=(",", ":")).encode()))
+            self.undo_stack[self.packed] = entry
+            self.packed += 1
+            self.live_bytes -= command.size
+            self.packed_bytes += entry.size
+        while self.packed_bytes > self.packed_budget and self.spilled < self.packed:
+            if self.spill is None:
+                self.spill = tempfile.TemporaryFile()
+            entry = self.undo_stack[self.spilled]
+            entry.offset = self.spill.seek(0, 2)
+            self.spill.write(entry.data)
+            entry.data = None
+            self.spilled += 1
+            self.packed_bytes -= entry.size
+
+    def key(self, shape):
+        """The shape's history key, given one if it has none yet."""
+        if shape.history_key is None:
+            shape.history_key = self.next_key
+            self.next_key += 1
+        return shape.history_key
+
+    def stats(self):
+        """What the history holds, for the status bar."""
+        return {
+            "live": len(self.undo_stack) - self.packed,
+            "live_bytes": self.live_bytes,
+            "packed": self.packed - self.spilled,
+            "packed_bytes": self.packed_bytes,
+            "spilled": self.spilled,
+            "spilled_bytes": self.spill.seek(0, 2) if self.spill is not None else 0,
+            "redo": len(self.redo_stack),
+        }
+
+    def close(self):
+        """Drop the spill file; the history is not used any more."""
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
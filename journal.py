@@ -0,0 +1,447 @@
+"""Crash recovery: an append-only journal of document edits, kept next to the sketch.
+
+A journal starts from a base, the file the document was loaded from or saved to,
+or an empty document, and records every later change to the top-level shapes
+(add, remove, move, replace) as one JSON line. Records are buffered and written
+out together, with an fsync; the app flushes on a timer, so a burst of edits
+costs one write instead of a full save.
+
+Shapes are named by ids the journal hands out and never reuses. Once a journal
+file grows long, a new one is started and a background thread replays the old
+ones into a snapshot, so recovery never has to go far back. After a crash,
+recovery does the same replay over whatever files were left behind.
+
+Each running app has a session in the recovery folder: a file naming the base of
+its journal, and a lock it holds until it exits. Only sessions whose lock is free,
+those of instances that are gone, are recovered, so two windows never share a
+journal.
+
+Files, for a document at `path` journaled by session `S`, so that two windows
+on one sketch keep apart:
+    path.S.snapshot   {"generation", "next_id"}, then {"id", "shape"} per shape
+    path.S.journal.N  the edits made on top of snapshot N; journal 0 opens with
+                      {"op": "begin", "source": ...}, the file its base was read from
+and, in the recovery folder:
+    session-S.json    {"base"}, the journal in use
+    session-S.lock    locked while the app runs
+"""
+import json
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from fileformats import read_shapes
+
+RECOVERY_DIR = os.path.join(os.path.expanduser("~"), ".sketchpad")
+
+
+def journal_path(base, generation):
+    return f"{base}.journal.{generation}"
+
+
+def snapshot_path(base):
+    return base + ".snapshot"
+
+
+def journal_generations(base):
+    """Generations of the journal files that exist for `base`, oldest first."""
+    folder, name = os.path.split(os.path.abspath(base))
+    prefix = name + ".journal."
+    return sorted(int(entry[len(prefix):]) for entry in os.listdir(folder)
+                  if entry.startswith(prefix) and entry[len(prefix):].isdigit())
+
+
+def read_lines(path):
+    """The records of a journal file, up to the first line a crash cut short."""
+    with open(path, "rb") as file:
+        for line in file:
+            if not line.endswith(b"\n"):
+                return
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return
+            yield record
+
+
+def write_snapshot(base, generation, entries, next_id):
+    """Write (id, shape) entries as the snapshot of `generation`, replacing the old one only once it is on disk."""
+    path = snapshot_path(base)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as file:
+        file.write(json.dumps({"generation": generation, "next_id": next_id}) + "\n")
+        for shape_id, shape in entries:
+            file.write(json.dumps({"id": shape_id, "shape": shape.to_dict()}) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def replay(base, classes, until=None):
+    """Rebuild the document from the snapshot and journals of `base`.
+
+    Only journals older than generation `until` are read, if given. Returns the
+    shapes bottom to top, their ids and the next free id.
+    """
+    def build(data):
+        return classes[data["type"]].from_dict(data)
+
+    shapes, order, next_id, generation = {}, [], 0, 0  # id -> shape, ids bottom to top
+    if os.path.exists(snapshot_path(base)):
+        records = read_lines(snapshot_path(base))
+        header = next(records)
+        generation, next_id = header["generation"], header["next_id"]
+        for record in records:
+            shapes[record["id"]] = build(record["shape"])
+            order.append(record["id"])
+    for journal in journal_generations(base):
+        if journal < generation or (until is not None and journal >= until):
+            continue
+        for record in read_lines(journal_path(base, journal)):
+            op = record["op"]
+            if op == "begin":
+                if record["source"] is not None:
+                    loaded = read_shapes(record["source"], classes)
+                    shapes, order, next_id = dict(enumerate(loaded)), list(range(len(loaded))), len(loaded)
+            elif op == "add":
+                shape_id = record["id"]
+                shapes[shape_id] = build(record["shape"])
+                order.insert(record.get("at", len(order)), shape_id)
+                next_id = max(next_id, shape_id + 1)
+            elif op == "remove":
+                del shapes[order.pop(record["at"])]
+            elif op == "move":
+                for shape_id in record["ids"]:
+                    shapes[shape_id].move(record["dx"], record["dy"])
+            elif op == "set":
+                shapes[record["id"]] = build(record["shape"])
+    return [shapes[shape_id] for shape_id in order], order, next_id
+
+
+def compact(base, generation, classes):
+    """Fold the journals older than `generation` into a snapshot, then delete them."""
+    shapes, ids, next_id = replay(base, classes, until=generation)
+    write_snapshot(base, generation, zip(ids, shapes), next_id)
+    for journal in journal_generations(base):
+        if journal < generation:
+            os.remove(journal_path(base, journal))
+
+
+def remove_files(base):
+    """Delete the snapshot and journals of `base`."""
+    for journal in journal_generations(base):
+        os.remove(journal_path(base, journal))
+    if os.path.exists(snapshot_path(base)):
+        os.remove(snapshot_path(base))
+
+
+def lock_file(path):
+    """Open and lock `path`, held until the file is closed, or None if someone else holds it.
+
+    The system drops the lock when the process ends, however it ends.
+    """
+    file = open(path, "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+
+def session_path(folder, session, extension):
+    return os.path.join(folder, f"session-{session}.{extension}")
+
+
+def sessions(folder):
+    """The sessions in `folder`, the most recently started first."""
+    try:
+        names = [name for name in os.listdir(folder) if name.startswith("session-") and name.endswith(".json")]
+    except FileNotFoundError:
+        return []
+    names.sort(key=lambda name: os.path.getmtime(os.path.join(folder, name)), reverse=True)
+    return [name[len("session-"):-len(".json")] for name in names]
+
+
+class Journal:
+    """Records the edits of one document; the app reports each change to the top-level shapes.
+
+    `classes` maps type names to shape classes, as for fileformats. Nothing is
+    recorded until start() or resume() names the document.
+    """
+
+    def __init__(self, classes, folder=RECOVERY_DIR, compact_after=5000):
+        self.classes = classes
+        self.folder = folder
+        self.compact_after = compact_after  # records written before a compaction starts
+        self.base = None
+        self.recording = False
+        self.ids = {}  # top-level shape -> id
+        self.next_id = 0
+        self.generation = 0
+        self.pending = []
+        self.written = 0  # records in the current journal file
+        self.file = None
+        self.compaction = None
+        self.since = None  # records made since mark(), while a background save runs
+        self.session = None  # names this app's files in the folder
+        self.lock = None  # the open session lock, held until discard()
+
+    def claim(self):
+        """Start a session of our own, unless we have one: a name no other session uses, locked."""
+        if self.session is not None:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        number = 0
+        while True:
+            session = f"{os.getpid()}-{number}"
+            if not os.path.exists(session_path(self.folder, session, "json")):
+                self.lock = lock_file(session_path(self.folder, session, "lock"))
+                if self.lock is not None:
+                    self.session = session
+                    return
+            number += 1
+
+    def recover(self):
+        """Take over the session an app left behind when it ended without quitting; returns its base, or None.
+
+        Sessions whose lock is held belong to apps still running and are left alone.
+        Call it before start(), as the app's own session is never recovered.
+        """
+        if self.session is not None:
+            return None
+        for session in sessions(self.folder):
+            lock = lock_file(session_path(self.folder, session, "lock"))
+            if lock is None:
+                continue  # still running
+            try:
+                with open(session_path(self.folder, session, "json")) as file:
+                    base = json.load(file)["base"]
+            except (OSError, ValueError, KeyError):
+                base = None
+            if base is not None and (os.path.exists(snapshot_path(base)) or journal_generations(base)):
+                self.session, self.lock = session, lock
+                return base
+            lock.close()  # nothing to recover: clear it away
+            for extension in ("json", "lock"):
+                try:
+                    os.remove(session_path(self.folder, session, extension))
+                except FileNotFoundError:
+                    pass
+        return None
+
+    def untitled(self):
+        """Where the journal of a document that was never saved lives."""
+        return os.path.join(self.folder, "untitled")
+
+    def start(self, base, shapes, source=None):
+        """Journal a document from here on, dropping any older journal.
+
+        `source` is the file `shapes` were just loaded from or saved to; without
+        one the shapes are written to a snapshot first. The journal files are named
+        after `base` and the session, which self.base then holds.
+        """
+        self.stop()
+        self.claim()
+        base = f"{os.path.abspath(base)}.{self.session}"  # another window may journal the same file
+        remove_files(base)  # left over from this session's last time on the document
+        self.base = base
+        self.ids = {shape: shape_id for shape_id, shape in enumerate(shapes)}
+        self.next_id = len(shapes)
+        self.generation = 0
+        if source is None and shapes:
+            write_snapshot(base, 0, enumerate(shapes), self.next_id)
+        self.open()
+        self.file.write(json.dumps({"op": "begin", "source": source}) + "\n")
+        self.sync()
+        self.recording = True
+        with open(session_path(self.folder, self.session, "json"), "w") as file:
+            json.dump({"base": base}, file)
+
+    def resume(self, base):
+        """Rebuild the document a crash left journaled at `base` and carry on journaling it."""
+        shapes, ids, next_id = replay(base, self.classes)
+        self.stop(keep=True)
+        self.base = base
+        self.ids = dict(zip(shapes, ids))
+        self.next_id = next_id
+        generations = journal_generations(base)
+        self.generation = generations[-1] if generations else 0
+        self.recording = True
+        self.compact()  # continue in a fresh file, the last line of the old one may be torn
+        return shapes
+
+    def stop(self, keep=False):
+        """Stop recording and delete the journal files, unless `keep`."""
+        self.wait()
+        self.recording = False
+        self.pending = []
+        self.since = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.base is not None and not keep:
+            remove_files(self.base)
+
+    def discard(self):
+        """Forget the document, e.g. on a clean exit: nothing is left to recover."""
+        self.stop()
+        if self.session is None:
+            return
+        self.lock.close()
+        self.lock = None
+        for extension in ("json", "lock"):
+            try:
+                os.remove(session_path(self.folder, self.session, extension))
+            except FileNotFoundError:
+                pass
+        self.session = None
+
+    def follows(self, shapes):
+        """Whether `shapes` are the document the journal is recording."""
+        return self.recording and len(shapes) == len(self.ids) and all(shape in self.ids for shape in shapes)
+
+    def mark(self, shapes):
+        """Note the document a background save is writing; returns the ids of its shapes, for rebase.
+
+        The records made from here on are kept as well, so the journal can go on from
+        the saved file however long the save takes. Returns None if the journal doesn't
+        know the shapes, e.g. while it is stopped.
+        """
+        ids = [self.ids.get(shape) for shape in shapes] if self.recording else [None]
+        self.since = [] if None not in ids else None
+        return ids if self.since is not None else None
+
+    def rebase(self, base, ids, shapes):
+        """Journal on top of the file a background save wrote at `base`, dropping the old journal.
+
+        `ids` are what mark() returned when the save started. The edits made since
+        then are written to the new journal straight away, with the ids the new base
+        gives their shapes. Without ids, the journal starts over from the file with
+        `shapes`, the document now, as the old one couldn't have followed the edits.
+        """
+        since, self.since = self.since, None
+        if not self.recording:
+            return
+        if ids is None or since is None:
+            self.start(base, shapes, source=base)
+            return
+        renumber = {old: new for new, old in enumerate(ids)}
+        next_id = len(ids)
+        records = []
+        for record in since:
+            record = dict(record)
+            if record["op"] == "add":
+                renumber[record["id"]] = record["id"] = next_id
+                next_id += 1
+            elif record["op"] == "set":
+                record["id"] = renumber[record["id"]]
+            elif record["op"] == "move":
+                record["ids"] = [renumber[shape_id] for shape_id in record["ids"]]
+            records.append(record)
+        current = {shape: renumber[shape_id] for shape, shape_id in self.ids.items()}
+        self.start(base, (), source=base)
+        self.ids, self.next_id = current, next_id
+        self.pending = records
+        self.flush()
+
+    def note(self, record):
+        self.pending.append(record)
+        if self.since is not None:
+            self.since.append(record)
+
+    def mergeable(self):
+        """The last buffered record, if a new edit may be folded into it, or None.
+
+        While a save runs, only records made since mark() may: an older one isn't
+        carried over by rebase(), and neither would the edit folded into it.
+        """
+        last = self.pending[-1] if self.pending else None
+        if last is None or self.since is None or (self.since and self.since[-1] is last):
+            return last
+        return None
+
+    def open(self):
+        self.file = open(journal_path(self.base, self.generation), "a")
+        self.written = 0
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def added(self, shape, position=None):
+        """A shape went on top of the document, or to `position` in the stacking order."""
+        if not self.recording:
+            return
+        shape_id = self.ids[shape] = self.next_id
+        self.next_id += 1
+        record = {"op": "add", "id": shape_id, "shape": shape.to_dict()}
+        if position is not None:
+            record["at"] = position
+        self.note(record)
+
+    def removed(self, shape, position):
+        if not self.recording:
+            return
+        del self.ids[shape]
+        self.note({"op": "remove", "at": position})
+
+    def moved(self, shapes, dx, dy):
+        if not self.recording:
+            return
+        ids = [self.ids[shape] for shape in shapes]
+        last = self.mergeable()
+        if last is not None and last["op"] == "move" and last["ids"] == ids:  # the next step of a drag
+            last["dx"] += dx  # the same dict as in since, if a save is running
+            last["dy"] += dy
+        else:
+            self.note({"op": "move", "ids": ids, "dx": dx, "dy": dy})
+
+    def changed(self, shape):
+        """The geometry of a shape changed in place, e.g. while it is being drawn."""
+        if not self.recording:
+            return
+        record = {"op": "set", "id": self.ids[shape], "shape": shape.to_dict()}
+        last = self.mergeable()
+        if last is not None and last["op"] == "set" and last["id"] == record["id"]:
+            self.pending[-1] = record
+            if self.since is not None:
+                self.since[-1] = record
+        else:
+            self.note(record)
+
+    def flush(self):
+        """Write out and fsync the buffered records; compact once the journal file is long."""
+        if not self.pending:
+            return
+        self.file.write("".join(json.dumps(record) + "\n" for record in self.pending))
+        self.sync()
+        self.written += len(self.pending)
+        self.pending = []
+        if self.written >= self.compact_after and not (self.compaction and self.compaction.is_alive()):
+            self.compact()
+
+    def compact(self):
+        """Switch to a new journal file and fold the older ones into a snapshot in the background."""
+        if self.file is not None:
+            self.file.close()
+        self.generation += 1
+        self.open()
+        self.compaction = threading.Thread(target=compact, args=(self.base, self.generation, self.classes),
+                                           daemon=True)
+        self.compaction.start()
+
+    def wait(self):
+        """Let a running compaction finish."""
+        if self.compaction is not None:
+            self.compaction.join()
+            self.compaction = None
@@ -0,0 +1,146 @@
+"""Timing the app's hot paths while it runs, for the performance overlay and traces.
+
+A Profiler times methods by replacing them, on the instance, with a timed wrapper;
+detach() deletes the wrappers again. So when profiling is off nothing is wrapped,
+and the methods cost what they always did.
+
+Each timed name gets a count, a total, the worst call and a histogram with one bucket
+per power of two microseconds. The latest calls are also kept as a trace, with
+counters (shapes, undo memory) sampled by the overlay, and export_trace() writes them
+as Chrome trace events, for chrome://tracing or https://ui.perfetto.dev.
+"""
+import json
+import os
+import time
+from collections import deque
+
+from shapes import Group, IrRegularShape
+
+BUCKETS = 32  # Histogram buckets: bucket n counts calls of under 2**n microseconds, the last one the rest
+
+
+def point_count(shape):
+    """Points of a shape, the members of a group included."""
+    if isinstance(shape, Group):
+        return sum(point_count(member) for member in shape.shapes)
+    if isinstance(shape, IrRegularShape):
+        return shape.point_count()
+    return 2
+
+
+class Timing:
+    """Calls of one timed name."""
+    __slots__ = ('count', 'total', 'worst', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.worst:
+            self.worst = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound, in seconds, of the bucket holding the given fraction of the calls."""
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(2 ** bucket / 1e6, self.worst)
+        return self.worst
+
+
+class Profiler:
+    def __init__(self, trace_length=100_000):
+        self.enabled = False
+        self.timings = {}  # name -> Timing
+        self.trace = deque(maxlen=trace_length)  # (name, start, seconds) or (name, time, counters)
+        self.origin = time.perf_counter()
+        self.slowest = None  # (seconds, name) of the slowest call since take_slowest()
+        self.wrapped = []  # (object, attribute) of the wrappers in place
+
+    def timed(self, name, method, name_of=None):
+        """Wrap method so its calls are recorded under name, or under name_of(*args)."""
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.add(name_of(*args) if name_of else name, start, time.perf_counter() - start)
+        return wrapper
+
+    def attach(self, targets):
+        """Time the methods named by targets, (object, attribute, name or None, name_of or None)
+        tuples; the name defaults to the attribute. Does nothing while profiling is off."""
+        if not self.enabled:
+            return
+        for target, attribute, name, name_of in targets:
+            setattr(target, attribute, self.timed(name or attribute, getattr(target, attribute), name_of))
+            self.wrapped.append((target, attribute))
+
+    def detach(self):
+        for target, attribute in self.wrapped:
+            if attribute in vars(target):
+                delattr(target, attribute)
+        self.wrapped = []
+
+    def start(self, targets):
+        self.enabled = True
+        self.attach(targets)
+
+    def stop(self):
+        self.detach()
+        self.enabled = False
+
+    def add(self, name, start, seconds):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = Timing()
+        timing.add(seconds)
+        self.trace.append((name, start, seconds))
+        if self.slowest is None or seconds > self.slowest[0]:
+            self.slowest = (seconds, name)
+
+    def counters(self, name, **values):
+        """Sample counters, e.g. memory in use, into the trace."""
+        self.trace.append((name, time.perf_counter(), values))
+
+    def take_slowest(self):
+        """The slowest call since the last time this was asked, as (seconds, name), or None."""
+        slowest, self.slowest = self.slowest, None
+        return slowest
+
+    def summary(self):
+        """{name: {"count", "total_ms", "mean_ms", "p50_ms", "p99_ms", "worst_ms"}}, slowest total first."""
+        results = {}
+        for name, timing in sorted(self.timings.items(), key=lambda item: -item[1].total):
+            results[name] = {"count": timing.count, "total_ms": timing.total * 1000,
+                             "mean_ms": timing.total / timing.count * 1000,
+                             "p50_ms": timing.percentile(0.5) * 1000, "p99_ms": timing.percentile(0.99) * 1000,
+                             "worst_ms": timing.worst * 1000}
+        return results
+
+    def clear(self):
+        self.timings.clear()
+        self.trace.clear()
+        self.slowest = None
+
+    def export_trace(self, file_path):
+        """Write the trace as Chrome trace-event JSON."""
+        pid = os.getpid()
+        events = []
+        for name, start, value in self.trace:
+            event = {"name": name, "pid": pid, "tid": 1, "ts": round((start - self.origin) * 1e6, 3)}
+            if isinstance(value, dict):
+                event.update(ph="C", args=value)
+            else:
+                event.update(ph="X", cat="sketchpad", dur=round(value * 1e6, 3))
+            events.append(event)
+        with open(file_path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,209 @@
+"""Recording the events a DrawingApp handles, and replaying them headless.
+
+A recording is a JSON Lines file. The first line holds what the session started
+from: the document, clipboard, selection, view, tool, color and whether snapping
+was on. Every further
+line is an event as Tk delivered it (sequence, screen pixels, modifier state), a
+toolbar or menu action, or a frame: the timer running the motion work noted since
+the last one. Each line also holds the milliseconds since the start and the tool
+that was active.
+
+replay() feeds a recording to a fresh headless app as fast as it can. Frames run
+where the recording has them rather than by the clock, so motion is split the same
+way as in the session: moves add up in floating point, and a different split could
+leave shapes a hair off. Every replay ends with the same document as the session.
+It reports latency percentiles per event sequence and a hash of the final document:
+
+    python recording.py session.jsonl
+    python recording.py session.jsonl --repeat 5 --output new.json --expect-hash 3f2a...
+    python benchsuite.py compare old.json new.json
+
+The JSON output has the format of benchsuite.py results, so a recorded session can
+serve as a regression test like the synthetic ones.
+"""
+import argparse
+import hashlib
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from render import RecordingRenderer
+from shapes import Shape, SHAPE_CLASSES
+
+EVENT_FIELDS = ("x", "y", "state", "delta", "num", "width", "height")  # What is kept of a Tk event
+FRAMES = "(frames)"  # Latency key of the motion work run once per frame
+
+
+def tool_name(app):
+    shape_class = app.selected_shape_class
+    return shape_class.__name__ if shape_class is not None else "select"
+
+
+def document_hash(shapes):
+    """SHA-256 of the shapes' JSON, the same for the same drawing."""
+    data = json.dumps([shape.to_dict() for shape in shapes], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Recorder:
+    """Writes the events and actions an app handles to a file, for replay()."""
+
+    def __init__(self, app, file_path):
+        self.app = app
+        self.file = open(file_path, "w")
+        self.start = time.perf_counter()
+        view = app.view
+        positions = {shape: position for position, shape in enumerate(app.shapes)}
+        self.write({
+            "kind": "start", "format": 1, "tool": tool_name(app), "color": app.color,
+            "snapping": app.snapping, "view": [view.x, view.y, view.scale, view.width, view.height],
+            "shapes": [shape.to_dict() for shape in app.shapes],
+            "selected": [positions[shape] for shape in app.active_shapes if shape in positions],
+            "clipboard": [shape.to_dict() for shape in getattr(app, "copied_shapes", None) or ()],
+        })
+
+    def write(self, record):
+        record = {"t": round((time.perf_counter() - self.start) * 1000, 3), **record}
+        self.file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def event(self, sequence, event):
+        record = {"kind": "event", "seq": sequence, "tool": tool_name(self.app)}
+        for field in EVENT_FIELDS:
+            value = getattr(event, field, None)
+            if isinstance(value, (int, float)):  # Tk fills fields an event doesn't have with "??"
+                record[field] = value
+        self.write(record)
+
+    def frame(self):
+        self.write({"kind": "frame", "tool": tool_name(self.app)})
+
+    def command(self, name, args):
+        args = [{"shape": arg.__name__} if isinstance(arg, type) else arg for arg in args]
+        self.write({"kind": "command", "name": name, "args": args, "tool": tool_name(self.app)})
+
+    def close(self):
+        self.file.close()
+
+
+def replay(file_path, renderer=None):
+    """Run a recording on a fresh headless app.
+
+    Returns {"latency": {key: [seconds, ...]}, "hash": ..., "shapes": ..., "events": ...,
+    "mismatches": ...}. Keys are event sequences, action names and FRAMES; shapes is
+    the final document; mismatches counts lines recorded with another tool than the
+    replay had, a sign that the replay went its own way.
+    """
+    from SketchPad import DrawingApp, HeadlessRoot  # SketchPad imports this module
+
+    folder = tempfile.mkdtemp()  # journal of the replayed document, thrown away
+    app = DrawingApp(HeadlessRoot(), renderer or RecordingRenderer(), recovery_dir=folder)
+    latency = {}
+    events = mismatches = 0
+    try:
+        with open(file_path) as file:
+            start(app, json.loads(next(file)))
+            for line in file:
+                record = json.loads(line)
+                mismatches += record["tool"] != tool_name(app)
+                began = time.perf_counter()
+                if record["kind"] == "frame":
+                    app.run_frame()
+                    key = FRAMES
+                elif record["kind"] == "event":
+                    event = SimpleNamespace(**{field: record.get(field, 0) for field in EVENT_FIELDS})
+                    app.dispatch(record["seq"], event)
+                    key = record["seq"]
+                else:
+                    args = [SHAPE_CLASSES[arg["shape"]] if isinstance(arg, dict) else arg for arg in record["args"]]
+                    app.invoke(record["name"], *args)
+                    key = record["name"]
+                latency.setdefault(key, []).append(time.perf_counter() - began)
+                events += key != FRAMES
+        app.run_frame()  # motion after the last frame
+        return {"latency": latency, "hash": document_hash(app.shapes), "shapes": app.shapes,
+                "events": events, "mismatches": mismatches}
+    finally:
+        app.quit()
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def start(app, header):
+    """Put the app in the state the recording started from."""
+    app.set_shapes([Shape.from_dict(data) for data in header["shapes"]])
+    app.copied_shapes = [Shape.from_dict(data) for data in header["clipboard"]]
+    x, y, scale, width, height = header["view"]
+    app.view.resize(width, height)
+    app.view.x, app.view.y, app.view.scale = x, y, scale
+    app.color = header["color"]
+    app.snapping = header.get("snapping", False)  # recordings from before snapping drew without it
+    if header["tool"] != "select":
+        app.set_shape(SHAPE_CLASSES[header["tool"]], "")
+    app.active_shapes = [app.shapes[position] for position in header["selected"]]
+    app.redraw_all()
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of already sorted values."""
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(runs):
+    """benchsuite-style results from several replays of one recording.
+
+    An event sequence's total time per run is what min_ms and median_ms describe,
+    like an operation of the suite; the percentiles are of single events, over all runs.
+    """
+    results = {}
+    for key in sorted(runs[0]["latency"]):
+        totals = [sum(run["latency"].get(key, ())) * 1000 for run in runs]
+        samples = sorted(seconds * 1000 for run in runs for seconds in run["latency"].get(key, ()))
+        results[key] = {"min_ms": min(totals), "median_ms": sorted(totals)[len(totals) // 2],
+                        "max_ms": max(totals), "runs": len(runs), "count": len(samples) // len(runs),
+                        "p50_ms": percentile(samples, 0.5), "p90_ms": percentile(samples, 0.9),
+                        "p99_ms": percentile(samples, 0.99), "worst_ms": samples[-1]}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded session headless and time it.")
+    parser.add_argument("recording")
+    parser.add_argument("--repeat", type=int, default=1, help="replays to run")
+    parser.add_argument("--output", help="write benchsuite-style JSON results here")
+    parser.add_argument("--expect-hash", help="fail unless the final document has this hash")
+    options = parser.parse_args(argv)
+
+    runs = []
+    for _ in range(options.repeat):
+        runs.append(replay(options.recording))
+    hashes = {run["hash"] for run in runs}
+    results = summarize(runs)
+    print(f"{runs[0]['events']} events, document {runs[0]['hash']}")
+    print(f"{'sequence':20} {'count':>7} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'worst ms':>9}")
+    for key, result in results.items():
+        print(f"{key:20} {result['count']:7} {result['p50_ms']:9.3f} {result['p90_ms']:9.3f} "
+              f"{result['p99_ms']:9.3f} {result['worst_ms']:9.3f}")
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump({"format": 1, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "repeat": options.repeat, "recording": options.recording, "hash": runs[0]["hash"],
+                       "results": results}, file, indent=2)
+    status = 0
+    if len(hashes) > 1:
+        print("replays ended with different documents", file=sys.stderr)
+        status = 1
+    if any(run["mismatches"] for run in runs):
+        print(f"{runs[0]['mismatches']} lines were recorded with another tool than the replay had", file=sys.stderr)
+        status = 1
+    if options.expect_hash and options.expect_hash not in hashes:
+        print(f"expected document {options.expect_hash}", file=sys.stderr)
+        status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
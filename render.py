@@ -0,0 +1,561 @@
+"""Renderers: where shapes and the editor's overlays get drawn.
+
+Drawing is retained, the way a Tk canvas works: every call that draws returns an
+item id, and later calls move, reshape, restack or delete the item by that id.
+TkRenderer draws on a tk.Canvas. RecordingRenderer keeps the items in memory, for
+tests and profiling without a display, and RasterRenderer turns those items into
+pixels that can be saved as PNG, e.g. for exporting sketches on a server.
+ViewRenderer sits in front of any of them and applies the editor's pan and zoom.
+SvgRenderer writes the items out as SVG instead.
+
+Coordinates are flat x0, y0, x1, y1, ... sequences. Colors are Tk color strings;
+`dash` is a Tk dash pattern such as (4, 2). Images are Rasters, placed by their
+top-left corner and never scaled.
+"""
+import math
+import struct
+import zlib
+
+from shapes import bounding_box
+from viewport import Viewport
+
+MAX_EXPORT_SIZE = 8192  # Pixels on the longer side of an exported PNG without a size; bigger drawings are scaled down
+
+
+class Raster:
+    """An RGB image: `pixels` holds the rows, 3 bytes per pixel."""
+    __slots__ = ('width', 'height', 'pixels', 'handle')
+
+    def __init__(self, width, height, pixels):
+        self.width, self.height = width, height
+        self.pixels = pixels
+        self.handle = None  # what a renderer made of the image, e.g. a Tk PhotoImage, to reuse it
+
+
+class Renderer:
+    # How far drawn geometry may stray from the shapes, in document units, before it
+    # shows; shapes may draw fewer points within it (see IrRegularShape.detail)
+    tolerance = 0.0
+
+    def line(self, x1, y1, x2, y2, color="black", width=1, dash=None, tags=()):
+        return self.polyline([x1, y1, x2, y2], color, width, dash, tags)
+
+    def polyline(self, coords, color="black", width=1, dash=None, tags=()):
+        raise NotImplementedError
+
+    def rectangle(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        raise NotImplementedError
+
+    def oval(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        raise NotImplementedError
+
+    def polygon(self, coords, outline="black", fill=None, width=1, dash=None, tags=()):
+        raise NotImplementedError
+
+    def image(self, x, y, image, tags=()):
+        """Show a Raster with its top-left corner at (x, y)."""
+        raise NotImplementedError
+
+    def coords(self, item, coords):
+        """Give an item new points, as many as it was drawn with."""
+        raise NotImplementedError
+
+    def move(self, item, dx, dy):
+        raise NotImplementedError
+
+    def lower(self, item, below=None):
+        """Restack `item` just under the item `below`, or under every item."""
+        raise NotImplementedError
+
+    def delete(self, *items):
+        raise NotImplementedError
+
+    def clear(self):
+        """Delete every item."""
+        raise NotImplementedError
+
+
+class TkRenderer(Renderer):
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.images = {}  # item id -> PhotoImage shown, which Tk drops once Python lets go of it
+
+    @staticmethod
+    def options(dash, tags):
+        return {"dash": dash, "tags": tags} if dash else {"tags": tags}
+
+    def line(self, x1, y1, x2, y2, color="black", width=1, dash=None, tags=()):
+        return self.canvas.create_line(x1, y1, x2, y2, fill=color, width=width, **self.options(dash, tags))
+
+    def polyline(self, coords, color="black", width=1, dash=None, tags=()):
+        return self.canvas.create_line(coords, fill=color, width=width, **self.options(dash, tags))
+
+    def rectangle(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        return self.canvas.create_rectangle(x1, y1, x2, y2, outline=outline, fill=fill or "", width=width,
+                                            **self.options(dash, tags))
+
+    def oval(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        return self.canvas.create_oval(x1, y1, x2, y2, outline=outline, fill=fill or "", width=width,
+                                       **self.options(dash, tags))
+
+    def polygon(self, coords, outline="black", fill=None, width=1, dash=None, tags=()):
+        return self.canvas.create_polygon(coords, outline=outline, fill=fill or "", width=width,
+                                          **self.options(dash, tags))
+
+    def image(self, x, y, image, tags=()):
+        if image.handle is None:
+            from tkinter import PhotoImage  # this module doesn't need Tk otherwise
+            header = b"P6 %d %d 255\n" % (image.width, image.height)
+            image.handle = PhotoImage(master=self.canvas, data=header + bytes(image.pixels), format="PPM")
+        item = self.canvas.create_image(x, y, image=image.handle, anchor="nw", tags=tags)
+        self.images[item] = image.handle
+        return item
+
+    def coords(self, item, coords):
+        self.canvas.coords(item, coords)
+
+    def move(self, item, dx, dy):
+        self.canvas.move(item, dx, dy)
+
+    def lower(self, item, below=None):
+        if below is None:
+            self.canvas.tag_lower(item)
+        else:
+            self.canvas.tag_lower(item, below)
+
+    def delete(self, *items):
+        if items:
+            self.canvas.delete(*items)
+            for item in items:
+                self.images.pop(item, None)
+
+    def clear(self):
+        self.canvas.delete("all")
+        self.images.clear()
+
+
+class ViewRenderer(Renderer):
+    """Draws through another renderer, mapping document coordinates to the screen.
+
+    Shapes and the app keep working in document coordinates; a Viewport (see
+    viewport.py) says where the screen is. Line widths and dashes stay in screen
+    pixels, so outlines keep their weight at any zoom.
+    """
+
+    def __init__(self, renderer, view, pixel_tolerance=0.5):
+        self.renderer = renderer
+        self.view = view
+        self.pixel_tolerance = pixel_tolerance  # error hidden by rasterization, in screen pixels
+
+    @property
+    def tolerance(self):
+        return self.pixel_tolerance / self.view.scale
+
+    def line(self, x1, y1, x2, y2, color="black", width=1, dash=None, tags=()):
+        x1, y1 = self.view.to_screen(x1, y1)
+        x2, y2 = self.view.to_screen(x2, y2)
+        return self.renderer.line(x1, y1, x2, y2, color, width, dash, tags)
+
+    def polyline(self, coords, color="black", width=1, dash=None, tags=()):
+        return self.renderer.polyline(self.view.screen_coords(coords), color, width, dash, tags)
+
+    def rectangle(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        x1, y1, x2, y2 = self.view.screen_coords((x1, y1, x2, y2))
+        return self.renderer.rectangle(x1, y1, x2, y2, outline, fill, width, dash, tags)
+
+    def oval(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        x1, y1, x2, y2 = self.view.screen_coords((x1, y1, x2, y2))
+        return self.renderer.oval(x1, y1, x2, y2, outline, fill, width, dash, tags)
+
+    def polygon(self, coords, outline="black", fill=None, width=1, dash=None, tags=()):
+        return self.renderer.polygon(self.view.screen_coords(coords), outline, fill, width, dash, tags)
+
+    def image(self, x, y, image, tags=()):
+        x, y = self.view.to_screen(x, y)
+        return self.renderer.image(x, y, image, tags)
+
+    def coords(self, item, coords):
+        self.renderer.coords(item, self.view.screen_coords(coords))
+
+    def move(self, item, dx, dy):
+        self.renderer.move(item, dx * self.view.scale, dy * self.view.scale)
+
+    def lower(self, item, below=None):
+        self.renderer.lower(item, below)
+
+    def delete(self, *items):
+        self.renderer.delete(*items)
+
+    def clear(self):
+        self.renderer.clear()
+
+
+class Item:
+    __slots__ = ('kind', 'coords', 'outline', 'fill', 'width', 'dash', 'tags', 'below', 'above', 'image')
+
+    def __init__(self, kind, coords, outline, fill, width, dash, tags, image=None):
+        self.kind = kind  # "polyline", "rectangle", "oval", "polygon" or "image"
+        self.coords = list(coords)
+        self.outline = outline  # the line color of a polyline
+        self.fill = fill
+        self.width = width
+        self.dash = dash
+        self.tags = tuple(tags)
+        self.below = self.above = None  # ids of the neighbours in the stacking order
+        self.image = image  # the Raster of an image item
+
+
+class RecordingRenderer(Renderer):
+    """Keeps the items in memory and counts the calls made.
+
+    The stacking order is a doubly linked list through the items, like Tk's display
+    list, so restacking and deleting don't cost more on a big drawing.
+    """
+
+    def __init__(self):
+        self.items = {}  # id -> Item
+        self.bottom = self.top = None
+        self.next_id = 1
+        self.calls = {}
+
+    def count(self, call):
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    def stacked(self):
+        """The items, bottom to top."""
+        item = self.bottom
+        while item is not None:
+            yield self.items[item]
+            item = self.items[item].above
+
+    def add(self, kind, coords, outline, fill, width, dash, tags, image=None):
+        self.count(kind)
+        item = self.next_id
+        self.next_id += 1
+        self.items[item] = Item(kind, coords, outline, fill, width, dash, tags, image)
+        self.link(item, self.top, None)
+        return item
+
+    def link(self, item, below, above):
+        """Put `item` between the items `below` and `above`, either of them None at an end."""
+        entry = self.items[item]
+        entry.below, entry.above = below, above
+        if below is None:
+            self.bottom = item
+        else:
+            self.items[below].above = item
+        if above is None:
+            self.top = item
+        else:
+            self.items[above].below = item
+
+    def unlink(self, item):
+        entry = self.items[item]
+        if entry.below is None:
+            self.bottom = entry.above
+        else:
+            self.items[entry.below].above = entry.above
+        if entry.above is None:
+            self.top = entry.below
+        else:
+            self.items[entry.above].below = entry.below
+
+    def polyline(self, coords, color="black", width=1, dash=None, tags=()):
+        return self.add("polyline", coords, color, None, width, dash, tags)
+
+    def rectangle(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        return self.add("rectangle", (x1, y1, x2, y2), outline, fill, width, dash, tags)
+
+    def oval(self, x1, y1, x2, y2, outline="black", fill=None, width=1, dash=None, tags=()):
+        return self.add("oval", (x1, y1, x2, y2), outline, fill, width, dash, tags)
+
+    def polygon(self, coords, outline="black", fill=None, width=1, dash=None, tags=()):
+        return self.add("polygon", coords, outline, fill, width, dash, tags)
+
+    def image(self, x, y, image, tags=()):
+        return self.add("image", (x, y), None, None, 0, None, tags, image)
+
+    def coords(self, item, coords):
+        self.count("coords")
+        self.items[item].coords = list(coords)
+
+    def move(self, item, dx, dy):
+        self.count("move")
+        coords = self.items[item].coords
+        coords[0::2] = [x + dx for x in coords[0::2]]
+        coords[1::2] = [y + dy for y in coords[1::2]]
+
+    def lower(self, item, below=None):
+        self.count("lower")
+        if below is None:
+            below = self.bottom
+        if item == below:
+            return
+        self.unlink(item)
+        self.link(item, self.items[below].below, below)
+
+    def delete(self, *items):
+        self.count("delete")
+        for item in items:
+            if item in self.items:
+                self.unlink(item)
+                del self.items[item]
+
+    def clear(self):
+        self.count("clear")
+        self.items.clear()
+        self.bottom = self.top = None
+
+
+# Tk color names the sketches use; others come out black
+COLORS = {
+    "black": (0, 0, 0), "white": (255, 255, 255), "red": (255, 0, 0), "green": (0, 128, 0),
+    "blue": (0, 0, 255), "yellow": (255, 255, 0), "orange": (255, 165, 0), "purple": (160, 32, 240),
+    "gray": (190, 190, 190), "grey": (190, 190, 190),
+}
+
+
+def parse_color(color):
+    """RGB of a Tk color: a name from COLORS, #rgb or #rrggbb."""
+    if color.startswith("#") and len(color) in (4, 7):
+        digits = 1 if len(color) == 4 else 2
+        return tuple(int(color[1 + i * digits:1 + (i + 1) * digits], 16) * (17 if digits == 1 else 1)
+                     for i in range(3))
+    return COLORS.get(color.lower(), (0, 0, 0))
+
+
+class RasterRenderer(RecordingRenderer):
+    """Records items like RecordingRenderer and rasterizes them, bottom to top, on render().
+
+    Lines are one pixel wide per unit of width, without anti-aliasing; ovals are drawn
+    as polygons. Items are drawn at their coordinates, so pass `origin` to make the
+    pixel at (0, 0) show another point of the sketch.
+    """
+
+    def __init__(self, width, height, background="white", origin=(0, 0)):
+        super().__init__()
+        self.width, self.height = width, height
+        self.background = parse_color(background)
+        self.origin = origin
+        self.pixels = bytearray()
+
+    def render(self):
+        """Draw every item into self.pixels, rows of RGB bytes, and return them."""
+        self.pixels = bytearray(bytes(self.background) * (self.width * self.height))
+        ox, oy = self.origin
+        for item in self.stacked():
+            coords = [value - (ox if i % 2 == 0 else oy) for i, value in enumerate(item.coords)]
+            if item.kind == "image":
+                self.blit(item.image, round(coords[0]), round(coords[1]))
+                continue
+            if item.kind == "rectangle":
+                x1, y1, x2, y2 = coords
+                coords = [x1, y1, x2, y1, x2, y2, x1, y2]
+            elif item.kind == "oval":
+                coords = oval_points(*coords)
+            closed = item.kind != "polyline"
+            if closed and item.fill:
+                self.fill_polygon(coords, parse_color(item.fill))
+            if item.outline:
+                if closed:
+                    coords = coords + coords[:2]
+                self.stroke(coords, parse_color(item.outline), item.width, item.dash)
+        return self.pixels
+
+    def plot(self, x, y, color, size):
+        for py in range(y - size // 2, y - size // 2 + size):
+            if 0 <= py < self.height:
+                for px in range(x - size // 2, x - size // 2 + size):
+                    if 0 <= px < self.width:
+                        offset = (py * self.width + px) * 3
+                        self.pixels[offset:offset + 3] = color
+
+    def blit(self, image, x, y):
+        """Copy a Raster's pixels over the picture, with its top-left corner at (x, y)."""
+        left, right = max(0, x), min(self.width, x + image.width)
+        if left >= right:
+            return
+        for row in range(max(0, y), min(self.height, y + image.height)):
+            source = ((row - y) * image.width + left - x) * 3
+            target = (row * self.width + left) * 3
+            self.pixels[target:target + (right - left) * 3] = image.pixels[source:source + (right - left) * 3]
+
+    def stroke(self, coords, rgb, width, dash):
+        """Bresenham along each segment; a dash pattern carries on from one segment to the next."""
+        size = max(1, round(width))
+        color = bytes(rgb)
+        pattern = dash or (1,)
+        period = sum(pattern)
+        step = 0
+        for i in range(0, len(coords) - 2, 2):
+            x, y = round(coords[i]), round(coords[i + 1])
+            x2, y2 = round(coords[i + 2]), round(coords[i + 3])
+            dx, dy = abs(x2 - x), -abs(y2 - y)
+            sx, sy = (1 if x < x2 else -1), (1 if y < y2 else -1)
+            error = dx + dy
+            while True:
+                if dash is None or dash_on(pattern, step % period):
+                    self.plot(x, y, color, size)
+                step += 1
+                if x == x2 and y == y2:
+                    break
+                double = 2 * error
+                if double >= dy:
+                    error += dy
+                    x += sx
+                if double <= dx:
+                    error += dx
+                    y += sy
+
+    def fill_polygon(self, coords, rgb):
+        """Even-odd scanline fill."""
+        points = list(zip(coords[0::2], coords[1::2]))
+        ys = coords[1::2]
+        color = bytes(rgb)
+        for row in range(max(0, int(min(ys))), min(self.height, int(max(ys)) + 1)):
+            y = row + 0.5
+            crossings = sorted(x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+                               for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1])
+                               if (y1 <= y < y2) or (y2 <= y < y1))
+            for left, right in zip(crossings[0::2], crossings[1::2]):
+                start, end = max(0, round(left)), min(self.width, round(right))
+                if start < end:
+                    offset = row * self.width * 3
+                    self.pixels[offset + start * 3:offset + end * 3] = color * (end - start)
+
+    def png(self):
+        """The rendered pixels as PNG file contents."""
+        rows = b"".join(b"\x00" + bytes(self.pixels[row * self.width * 3:(row + 1) * self.width * 3])
+                        for row in range(self.height))
+
+        def chunk(kind, data):
+            return (struct.pack(">I", len(data)) + kind + data
+                    + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+        header = struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)  # 8-bit RGB
+        return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+                + chunk(b"IDAT", zlib.compress(rows, 6)) + chunk(b"IEND", b""))
+
+    def save_png(self, path):
+        self.render()
+        with open(path, "wb") as file:
+            file.write(self.png())
+
+
+class SvgRenderer(RecordingRenderer):
+    """Records items like RecordingRenderer and writes them out as SVG, bottom to top.
+
+    Items stay in the coordinates they were drawn at; `view_box` (x, y, width, height)
+    says which part of them fills the width x height picture. Line widths are in
+    pixels of the picture, as on screen.
+    """
+
+    def __init__(self, width, height, view_box, background="white"):
+        super().__init__()
+        self.width, self.height = width, height
+        self.view_box = view_box
+        self.background = background
+        self.tolerance = 0.5 * view_box[2] / width  # half a pixel, in drawing units
+
+    def svg(self):
+        x, y, width, height = self.view_box
+        lines = ['<svg xmlns="http://www.w3.org/2000/svg" width="%s" height="%s" viewBox="%s %s %s %s">'
+                 % tuple(number(value) for value in (self.width, self.height, x, y, width, height))]
+        if self.background:
+            lines.append('<rect x="%s" y="%s" width="%s" height="%s" fill="%s"/>'
+                         % (number(x), number(y), number(width), number(height), svg_color(self.background)))
+        for item in self.stacked():
+            if item.kind != "image":
+                lines.append(svg_element(item))
+        lines.append("</svg>")
+        return "\n".join(lines) + "\n"
+
+    def save_svg(self, path):
+        with open(path, "w") as file:
+            file.write(self.svg())
+
+
+def svg_element(item):
+    attributes = 'fill="%s" stroke="%s" stroke-width="%s" vector-effect="non-scaling-stroke"' % (
+        svg_color(item.fill) if item.fill else "none", svg_color(item.outline) if item.outline else "none",
+        number(item.width))
+    if item.dash:
+        attributes += ' stroke-dasharray="%s"' % ",".join(number(length) for length in item.dash)
+    coords = item.coords
+    if item.kind == "rectangle":
+        x1, y1, x2, y2 = coords
+        return '<rect x="%s" y="%s" width="%s" height="%s" %s/>' % (
+            number(min(x1, x2)), number(min(y1, y2)), number(abs(x2 - x1)), number(abs(y2 - y1)), attributes)
+    if item.kind == "oval":
+        x1, y1, x2, y2 = coords
+        return '<ellipse cx="%s" cy="%s" rx="%s" ry="%s" %s/>' % (
+            number((x1 + x2) / 2), number((y1 + y2) / 2), number(abs(x2 - x1) / 2), number(abs(y2 - y1) / 2), attributes)
+    points = " ".join(f"{number(x)},{number(y)}" for x, y in zip(coords[0::2], coords[1::2]))
+    return '<%s points="%s" %s/>' % ("polygon" if item.kind == "polygon" else "polyline", points, attributes)
+
+
+def svg_color(color):
+    return "#%02x%02x%02x" % parse_color(color)
+
+
+def number(value):
+    """A coordinate for SVG: up to 3 decimals, no trailing zeros."""
+    text = f"{value:.3f}".rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+def dash_on(pattern, position):
+    """Whether `position` pixels into a dash pattern falls on a dash rather than a gap."""
+    for index, length in enumerate(pattern):
+        if position < length:
+            return index % 2 == 0
+        position -= length
+    return False
+
+
+def oval_points(x1, y1, x2, y2):
+    cx, cy, rx, ry = (x1 + x2) / 2, (y1 + y2) / 2, abs(x2 - x1) / 2, abs(y2 - y1) / 2
+    count = max(16, int(rx + ry))  # about one vertex per 3 pixels of perimeter
+    coords = []
+    for i in range(count):
+        angle = 2 * math.pi * i / count
+        coords.append(cx + rx * math.cos(angle))
+        coords.append(cy + ry * math.sin(angle))
+    return coords
+
+
+def export_area(shapes, margin, size):
+    """The document box to export, margin included, and the scale that fits it in size
+    pixels (at most 1, and 1 without a size). The margin is in pixels of the picture."""
+    box = bounding_box(shapes) or (margin, margin, margin, margin)
+    scale = 1.0
+    if size is not None:
+        scale = min(1.0, max(size - 1 - 2 * margin, 1) / max(box[2] - box[0], box[3] - box[1], 1))
+    grow = margin / scale
+    return (box[0] - grow, box[1] - grow, box[2] + grow, box[3] + grow), scale
+
+
+def export_png(shapes, path, margin=10, background="white", size=None):
+    """Render shapes to a PNG just big enough to hold them, no display needed.
+    With a size, e.g. for thumbnails, the picture is scaled down to fit size x size pixels;
+    without one, to fit MAX_EXPORT_SIZE, as the whole picture is held in memory."""
+    (left, top, right, bottom), scale = export_area(shapes, margin, size if size is not None else MAX_EXPORT_SIZE)
+    raster = RasterRenderer(int((right - left) * scale) + 1, int((bottom - top) * scale) + 1, background)
+    view = Viewport(raster.width, raster.height)
+    view.x, view.y, view.scale = left, top, scale
+    renderer = ViewRenderer(raster, view)
+    for shape in shapes:
+        shape.draw(renderer)
+    raster.save_png(path)
+    return raster
+
+
+def export_svg(shapes, path, margin=10, background="white", size=None):
+    """Write shapes as an SVG picture just big enough to hold them, or scaled down to fit size x size."""
+    (left, top, right, bottom), scale = export_area(shapes, margin, size)
+    renderer = SvgRenderer((right - left) * scale, (bottom - top) * scale, (left, top, right - left, bottom - top),
+                           background)
+    for shape in shapes:
+        shape.draw(renderer)
+    renderer.save_svg(path)
+    return renderer
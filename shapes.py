@@ -0,0 +1,604 @@
+"""The shapes of a sketch. Nothing here needs a display: shapes draw through a Renderer (see render.py)."""
+import copy
+from array import array
+from itertools import chain
+
+from geometry import (SegmentGrid, inside_polygon, near_polyline, polyline_in_box, segment_distance, segment_in_box,
+                      simplify, translate)
+
+# Screen pixels from a thin shape that still count as on it; contains_point gets the size of a pixel
+HIT_MARGIN = 10  # Farthest from its bounding box that contains_point can report a hit (freehand strokes)
+EDGE_MARGIN = 5  # Lines and polygon edges
+# Tolerances, in document units, of the simplified copies drawn when zoomed out (see IrRegularShape.detail)
+# Finished strokes are already simplified to about a unit, so the first level is coarser than that
+DETAIL_LEVELS = (2, 4, 8, 16, 32, 64)
+SEGMENT_GRID_MIN = 64  # Strokes with more segments than this get a SegmentGrid for hit tests
+SLOT_NAMES = {}  # Shape class -> the attributes an instance has, for Shape.__copy__
+
+
+def bounding_box(shapes):
+    """Return the (x1, y1, x2, y2) box around all of `shapes`, or None if none has geometry."""
+    boxes = [box for box in (shape.bbox() for shape in shapes) if box is not None]
+    if not boxes:
+        return None
+    return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+
+def near(box, x, y, margin=HIT_MARGIN):
+    """Whether (x, y) is close enough to `box` for contains_point to possibly be true."""
+    return (box is not None and box[0] - margin <= x <= box[2] + margin
+            and box[1] - margin <= y <= box[3] + margin)
+
+
+def overlaps(box, other):
+    """Whether two boxes share a point; a None box (no geometry) overlaps nothing."""
+    return (box is not None and other is not None and box[0] <= other[2] and box[2] >= other[0]
+            and box[1] <= other[3] and box[3] >= other[1])
+
+
+class Shape:
+    # _bbox caches bbox(); None means it has to be computed again. Anything that
+    # changes the geometry either keeps it up to date (move, add_point) or calls
+    # invalidate.
+    __slots__ = ('color', 'canvas_id', '_bbox', 'history_key')
+
+    def __init__(self, color):
+        self.color = color
+        self.canvas_id = None
+        self._bbox = None
+        self.history_key = None  # names the shape in undo steps stored packed (see history.py)
+
+    def draw(self, renderer, tags=()):
+        pass
+
+    def refresh(self, renderer, tags=()):
+        """Update the existing item in place after the geometry changed."""
+        pass
+
+    def item_ids(self):
+        """Renderer items created by the last draw."""
+        return [self.canvas_id] if self.canvas_id is not None else []
+
+    def contains_point(self, x, y, pixel=1):
+        """Whether (x, y) is on the shape; `pixel`, a screen pixel in document units, scales the margins."""
+        return False
+
+    def intersects(self, box):
+        """Whether the shape touches the box (x1, y1, x2, y2), for selecting what a marquee crosses.
+
+        Only asked of shapes whose bounding box overlaps the box, which is all a shape
+        without an exact test can tell.
+        """
+        return True
+
+    def snap_points(self):
+        """Flat x0, y0, x1, y1, ... of the points drawing and dragging snap to."""
+        return ()
+
+    def bbox(self):
+        """Return (x1, y1, x2, y2) around the shape, or None if it has no geometry yet."""
+        box = self._bbox
+        if box is None:
+            box = self._bbox = self.compute_bbox()
+        return box
+
+    def compute_bbox(self):
+        return None
+
+    def invalidate(self):
+        """Forget the cached bounding box after the geometry changed behind the shape's back."""
+        self._bbox = None
+
+    def shift_bbox(self, dx, dy):
+        box = self._bbox
+        if box is not None:
+            self._bbox = (box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy)
+
+    def move(self, dx, dy):
+        pass
+
+    def settle(self):
+        """Apply moves that were only noted so far (see IrRegularShape.move) to the stored geometry."""
+        pass
+
+    def __copy__(self):
+        # copy.copy's generic path goes through __reduce_ex__ and costs three times as much,
+        # which shows when a save snapshots a whole document
+        cls = type(self)
+        names = SLOT_NAMES.get(cls)
+        if names is None:
+            names = SLOT_NAMES[cls] = tuple(name for base in cls.__mro__ for name in vars(base).get('__slots__', ()))
+        twin = cls.__new__(cls)
+        for name in names:
+            setattr(twin, name, getattr(self, name))
+        return twin
+
+    def clone(self):
+        """A copy for the clipboard or a paste, not drawn yet.
+
+        Point buffers are shared with the original until one of the two edits its
+        points (see IrRegularShape), so copying a long stroke costs no more than a short one.
+        """
+        twin = copy.copy(self)
+        twin.canvas_id = twin.history_key = None
+        return twin
+
+    def to_dict(self):
+        return {
+            'type': self.__class__.__name__,
+            'color': self.color
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        shape_class = SHAPE_CLASSES[data['type']]
+        return shape_class.from_dict(data)
+
+
+class IrRegularShape(Shape):
+    # _levels caches simplified copies of the points by tolerance, built as zooming
+    # out asks for them, and _segments a SegmentGrid of long strokes, built by the
+    # first hit test; any change to the points but a move drops them.
+    # _dx, _dy is a move not yet applied to the points: dragging a long stroke only
+    # adds to it, and reading coords applies it (settle), after the drag.
+    # _shared marks points (and levels) that clones point to as well. They are never
+    # changed in place: the first edit, or the first settle after a move, gives the
+    # shape points of its own (own), so that only happens once.
+    __slots__ = ('_coords', '_levels', '_segments', '_dx', '_dy', '_shared')
+
+    def __init__(self, color):
+        super().__init__(color)
+        self._coords = array('d')  # Flat x0, y0, x1, y1, ... so long strokes stay compact
+        self._levels = self._segments = None
+        self._dx = self._dy = 0
+        self._shared = False
+
+    @property
+    def coords(self):
+        """The points with any pending move applied. Read only: edits go through add_point or the setter."""
+        if self._dx or self._dy:
+            self.settle()
+        return self._coords
+
+    @coords.setter
+    def coords(self, coords):
+        self._coords = coords
+        self._dx = self._dy = 0
+        self._bbox = self._levels = self._segments = None
+        self._shared = False
+
+    def settle(self):
+        dx, dy = self._dx, self._dy
+        if not (dx or dy):
+            return
+        if self._shared:
+            self.own()  # copies the points, then comes back here to move them
+        else:
+            self._dx = self._dy = 0
+            translate(self._coords, dx, dy)
+            for simplified in (self._levels or {}).values():  # cheaper than simplifying again
+                translate(simplified, dx, dy)
+            if self._segments is not None:
+                self._segments.shift(dx, dy)
+
+    def own(self):
+        """Stop sharing the points with clones, ahead of an edit. Returns them, with any move applied."""
+        if self._shared:
+            self._coords = array('d', self._coords)
+            self._levels = self._segments = None
+            self._shared = False
+        self.settle()
+        return self._coords
+
+    def clone(self):
+        self.bbox()  # worked out once, for both
+        twin = super().clone()
+        self._shared = twin._shared = True
+        return twin
+
+    def detail(self, tolerance):
+        """The points to draw when nothing smaller than `tolerance` (document units) shows on screen.
+
+        That is the coarsest of DETAIL_LEVELS within the tolerance, or all the points
+        when even the finest is too coarse.
+        """
+        self.settle()
+        coords = self._coords
+        if tolerance < DETAIL_LEVELS[0] or len(coords) <= 8:
+            return self.coords
+        level = max(level for level in DETAIL_LEVELS if level <= tolerance)
+        levels = self._levels
+        if levels is None:
+            levels = self._levels = {}
+        simplified = levels.get(level)
+        if simplified is None:  # built from the stored points, so clones can use it too
+            simplified = levels[level] = simplify(coords, level)
+        return simplified
+
+    @property
+    def points(self):
+        """The points as (x, y) tuples. Builds a new list, so hot paths read self.coords instead."""
+        return list(zip(self.coords[0::2], self.coords[1::2]))
+
+    @points.setter
+    def points(self, points):
+        self.coords = array('d', chain.from_iterable(points))
+
+    def add_point(self, x, y):
+        coords = self.own()
+        coords.append(x)
+        coords.append(y)
+        self._levels = self._segments = None
+        box = self._bbox
+        if box is not None:  # grow the box rather than scan the points again
+            self._bbox = (min(box[0], x), min(box[1], y), max(box[2], x), max(box[3], y))
+
+    def point_count(self):
+        return len(self._coords) // 2
+
+    def near_path(self, x, y, distance):
+        """Whether (x, y) is within `distance` of the line through the points."""
+        coords = self._coords
+        if not coords:
+            return False
+        segments = self._segments
+        if segments is None and len(coords) > 2 * SEGMENT_GRID_MIN + 2:
+            segments = self._segments = SegmentGrid(coords)
+        # measured against the stored points, which clones may share
+        return near_polyline(coords, x - self._dx, y - self._dy, distance, segments)
+
+    def move(self, dx, dy):
+        self._dx += dx
+        self._dy += dy
+        self.shift_bbox(dx, dy)
+
+    def unmoved(self, box):
+        """A box in the coordinates of the stored points, which a pending move hasn't shifted yet."""
+        dx, dy = self._dx, self._dy
+        return (box[0] - dx, box[1] - dy, box[2] - dx, box[3] - dy)
+
+    def snap_points(self):
+        coords = self.coords  # the ends of a stroke
+        return coords[:2] + coords[-2:] if len(coords) > 2 else coords
+
+    def flatten_points(self):
+        """Flatten the list of points for drawing."""
+        return self.coords.tolist()
+
+    def compute_bbox(self):
+        coords = self._coords
+        if not coords:
+            return None
+        xs, ys = coords[0::2], coords[1::2]
+        dx, dy = self._dx, self._dy
+        return (min(xs) + dx, min(ys) + dy, max(xs) + dx, max(ys) + dy)
+
+    def refresh(self, renderer, tags=()):
+        if self.canvas_id is None:
+            self.draw(renderer, tags)
+        else:
+            coords = self.coords
+            if len(coords) > 2:
+                renderer.coords(self.canvas_id, coords.tolist())
+
+    def to_dict(self):
+        data = super().to_dict()
+        coords = self.coords
+        # whole numbers go back out as ints, so files look the same as before
+        data['points'] = [[int(x) if x.is_integer() else x, int(y) if y.is_integer() else y]
+                          for x, y in zip(coords[0::2], coords[1::2])]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        shape = cls(data['color'])
+        shape.points = data['points']
+        return shape
+
+
+class RegularShape(Shape):
+    __slots__ = ('_start_point', '_end_point')
+
+    def __init__(self, start_point, end_point, color):
+        super().__init__(color)
+        self._start_point = start_point
+        self._end_point = end_point
+
+    @property
+    def start_point(self):
+        return self._start_point
+
+    @start_point.setter
+    def start_point(self, point):
+        self._start_point = point
+        self._bbox = None
+
+    @property
+    def end_point(self):
+        return self._end_point
+
+    @end_point.setter
+    def end_point(self, point):
+        self._end_point = point
+        self._bbox = None
+
+    def move(self, dx, dy):
+        self._start_point = (self._start_point[0] + dx, self._start_point[1] + dy)
+        self._end_point = (self._end_point[0] + dx, self._end_point[1] + dy)
+        self.shift_bbox(dx, dy)
+
+    def compute_bbox(self):
+        (x1, y1), (x2, y2) = self._start_point, self._end_point
+        return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+    def refresh(self, renderer, tags=()):
+        if self.canvas_id is None:
+            self.draw(renderer, tags)
+        else:
+            renderer.coords(self.canvas_id, [*self.start_point, *self.end_point])
+
+    def to_dict(self):
+        data = super().to_dict()
+        data['start_point'] = self.start_point
+        data['end_point'] = self.end_point
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['start_point'], data['end_point'], data['color'])
+
+
+class Polygon(IrRegularShape):    
+    __slots__ = ('preview_id',)
+
+    def __init__(self, color):
+        super().__init__(color)
+        self.preview_id = None  # rubber-band segment shown while drawing
+
+    def draw(self, renderer, tags=()):
+        if self.point_count() > 1:
+            self.clear_preview(renderer)
+            #polygons are just a few lines, so we can draw it directly
+            coords = self.detail(renderer.tolerance).tolist()
+            self.canvas_id = renderer.polyline(coords, color="black", width=2, tags=("polygon", *tags))
+
+    def refresh(self, renderer, tags=()):
+        self.clear_preview(renderer)
+        super().refresh(renderer, tags)
+
+    def preview(self, renderer, x, y):
+        if self.coords:
+            # only the segment from the last vertex moves, so reuse one item for it
+            last_x, last_y = self.coords[-2], self.coords[-1]
+            if self.preview_id is None:
+                self.preview_id = renderer.line(last_x, last_y, x, y, color="gray", dash=(4, 2), tags=("preview",))
+            else:
+                renderer.coords(self.preview_id, [last_x, last_y, x, y])
+
+    def snap_points(self):
+        return self.coords  # every vertex
+
+    def intersects(self, box):
+        box = self.unmoved(box)
+        return (polyline_in_box(self._coords, box, closed=True)
+                or inside_polygon(self._coords, box[0], box[1]))  # the box is inside the polygon
+
+    def clear_preview(self, renderer):
+        if self.preview_id is not None:
+            renderer.delete(self.preview_id)
+            self.preview_id = None
+
+    def contains_point(self, x, y, pixel=1):
+        """Check if the point (x, y) is inside or on the boundary of the polygon."""
+        if not self._coords:
+            return False
+        if self.near_path(x, y, EDGE_MARGIN * pixel):
+            return True  # Point is on an edge
+        return inside_polygon(self._coords, x - self._dx, y - self._dy)
+
+
+class Freehand(IrRegularShape):
+    __slots__ = ()
+
+    def draw(self, renderer, tags=()):
+        if self.point_count() > 1:
+            self.canvas_id = renderer.polyline(self.detail(renderer.tolerance).tolist(), color=self.color, tags=tags)
+
+    def contains_point(self, x, y, pixel=1):
+        return self.near_path(x, y, HIT_MARGIN * pixel)
+
+    def intersects(self, box):
+        return polyline_in_box(self._coords, self.unmoved(box))
+
+    def capture(self, x, y, spacing):
+        """Add a mouse sample unless it is closer than `spacing` to the last kept point. Returns whether it was kept."""
+        coords = self.coords
+        if coords and (x - coords[-2]) ** 2 + (y - coords[-1]) ** 2 < spacing * spacing:
+            return False
+        self.add_point(x, y)
+        return True
+
+    def simplify(self, tolerance):
+        """Drop points that stay within `tolerance` of the remaining line."""
+        self.coords = simplify(self.coords, tolerance)
+
+
+class Line(RegularShape):
+    __slots__ = ()
+
+    def draw(self, renderer, tags=()):
+        self.canvas_id = renderer.line(self.start_point[0], self.start_point[1], self.end_point[0],
+                                       self.end_point[1], color=self.color, tags=tags)
+
+    def contains_point(self, x, y, pixel=1):
+        # to the segment, not within its bounding box: that has no height for a level line
+        return segment_distance(x, y, *self.start_point, *self.end_point) < EDGE_MARGIN * pixel
+
+    def intersects(self, box):
+        return segment_in_box(*self.start_point, *self.end_point, box)
+
+    def snap_points(self):
+        return (*self.start_point, *self.end_point)
+
+
+class Rectangle(RegularShape):
+    __slots__ = ()
+
+    def draw(self, renderer, tags=()):
+        self.canvas_id = renderer.rectangle(self.start_point[0], self.start_point[1],
+                                            self.end_point[0], self.end_point[1], outline=self.color, tags=tags)
+
+    def contains_point(self, x, y, pixel=1):
+        (x1, y1), (x2, y2) = self.start_point , self.end_point
+        return min(x1, x2) <= x <= max(x1, x2) and min(y1, y2) <= y <= max(y1, y2)
+
+    def snap_points(self):
+        (x1, y1), (x2, y2) = self.start_point, self.end_point
+        return (x1, y1, x2, y1, x2, y2, x1, y2)
+
+
+class Ellipse(RegularShape):
+    __slots__ = ()
+
+    def draw(self, renderer, tags=()):
+        self.canvas_id = renderer.oval(self.start_point[0], self.start_point[1],
+                                       self.end_point[0], self.end_point[1], outline=self.color, tags=tags)
+
+    def contains_point(self, x, y, pixel=1):
+        rx = abs(self.end_point[0] - self.start_point[0]) / 2
+        ry = abs(self.end_point[1] - self.start_point[1]) / 2
+        cx = self.start_point[0] + rx
+        cy = self.start_point[1] + ry
+        if rx > 0 and ry > 0:
+            return ((x - cx) ** 2) / (rx ** 2) + ((y - cy) ** 2) / (ry ** 2) <= 1
+        return False
+
+    def intersects(self, box):
+        rx = abs(self.end_point[0] - self.start_point[0]) / 2
+        ry = abs(self.end_point[1] - self.start_point[1]) / 2
+        if not (rx > 0 and ry > 0):
+            return True  # flat: no more than its box
+        cx = min(self.start_point[0], self.end_point[0]) + rx
+        cy = min(self.start_point[1], self.end_point[1]) + ry
+        # the point of the box closest to the center, in units of the radii
+        nx = (min(max(cx, box[0]), box[2]) - cx) / rx
+        ny = (min(max(cy, box[1]), box[3]) - cy) / ry
+        return nx * nx + ny * ny <= 1
+
+    def snap_points(self):
+        (x1, y1), (x2, y2) = self.start_point, self.end_point
+        return ((x1 + x2) / 2, (y1 + y2) / 2)  # the center
+
+
+class Square(Rectangle):
+    __slots__ = ()
+
+    def normalize(self):
+        side_length = min(abs(self.end_point[0] - self.start_point[0]), abs(self.end_point[1] - self.start_point[1]))
+        self.end_point = (self.start_point[0] + side_length, self.start_point[1] + side_length)
+
+    def draw(self, renderer, tags=()):
+        self.normalize()
+        super().draw(renderer, tags)
+
+    def refresh(self, renderer, tags=()):
+        self.normalize()
+        super().refresh(renderer, tags)
+
+
+class Circle(Ellipse):
+    __slots__ = ()
+
+    def normalize(self):
+        # rounded first: at fractional (zoomed) coordinates the size of a normalized circle
+        # can come back a hair under a whole number, and flooring that would shrink it
+        radius = round(min(abs(self.end_point[0] - self.start_point[0]), abs(self.end_point[1] - self.start_point[1]))) // 2
+        self.end_point = (self.start_point[0] + 2 * radius, self.start_point[1] + 2 * radius)
+
+    def draw(self, renderer, tags=()):
+        self.normalize()
+        super().draw(renderer, tags)
+
+    def refresh(self, renderer, tags=()):
+        self.normalize()
+        super().refresh(renderer, tags)
+
+class Group(Shape):
+    """Shapes moved and selected as one.
+
+    The group's cached box is the union of its members' boxes, so nested groups form
+    a bounding volume hierarchy: hit tests skip every member, or subgroup, whose box
+    is too far from the point. Members only change through the group while they are
+    in it, which keeps the box valid; code that edits a member directly has to call
+    invalidate on the group.
+
+    Moving a group only notes the move, like IrRegularShape.move; the members get it
+    when they are next looked at.
+    """
+    __slots__ = ('_shapes', '_dx', '_dy')
+
+    def __init__(self, shapes):
+        super().__init__(color=None)  # Groups don't have a single color
+        self._shapes = shapes  # List of shapes in the group
+        self._dx = self._dy = 0
+
+    @property
+    def shapes(self):
+        dx, dy = self._dx, self._dy
+        if dx or dy:
+            self._dx = self._dy = 0
+            for shape in self._shapes:
+                shape.move(dx, dy)
+        return self._shapes
+    
+    def draw(self, renderer, tags=()):
+        for shape in self.shapes:
+            shape.draw(renderer, tags)
+
+    def item_ids(self):
+        return [item for shape in self.shapes for item in shape.item_ids()]
+    
+    def contains_point(self, x, y, pixel=1):
+        margin = HIT_MARGIN * pixel
+        if not near(self.bbox(), x, y, margin):
+            return False
+        return any(near(shape.bbox(), x, y, margin) and shape.contains_point(x, y, pixel) for shape in self.shapes)
+
+    def intersects(self, box):
+        return any(overlaps(shape.bbox(), box) and shape.intersects(box) for shape in self.shapes)
+
+    def snap_points(self):
+        return [value for shape in self.shapes for value in shape.snap_points()]
+
+    def compute_bbox(self):
+        return bounding_box(self.shapes)
+
+    def move(self, dx, dy):
+        self._dx += dx
+        self._dy += dy
+        self.shift_bbox(dx, dy)
+
+    def settle(self):
+        for shape in self.shapes:
+            shape.settle()
+
+    def clone(self):
+        twin = Group([shape.clone() for shape in self.shapes])
+        twin._bbox = self.bbox()
+        return twin
+    
+    def to_dict(self):
+        data = super().to_dict()
+        data['shapes'] = [shape.to_dict() for shape in self.shapes]
+        return data
+    
+    @classmethod
+    def from_dict(cls, data):
+        shapes = [Shape.from_dict(shape_data) for shape_data in data['shapes']]
+        return cls(shapes)
+
+
+# Shape classes by the type name stored in files
+SHAPE_CLASSES = {shape_class.__name__: shape_class
+                 for shape_class in (Line, Rectangle, Ellipse, Square, Circle, Polygon, Freehand, Group)}
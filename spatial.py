@@ -0,0 +1,259 @@
+"""Spatial lookups for the drawing canvas."""
+
+
+class GridIndex:
+    """Uniform grid over shape bounding boxes.
+
+    Every shape is registered in each cell its box overlaps, so a query only looks at
+    the shapes near it. Shapes that would cover more than `max_cells` cells are kept in
+    a separate set that every query checks, which keeps one huge shape from flooding
+    the grid. The index also remembers the stacking order of the shapes, so results
+    come back topmost first, the same order as walking reversed(shapes).
+    """
+
+    def __init__(self, cell_size=64, max_cells=256):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        self.cells = {}  # (column, row) -> set of shapes
+        self.boxes = {}  # shape -> (x1, y1, x2, y2)
+        self.spans = {}  # shape -> (c1, r1, c2, r2), or None for oversized shapes
+        self.large = set()
+        self.order = {}  # shape -> stacking key, higher is drawn later (on top)
+        self.next_order = 0
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, shape):
+        return shape in self.boxes
+
+    def span(self, box):
+        size = self.cell_size
+        return (int(box[0] // size), int(box[1] // size), int(box[2] // size), int(box[3] // size))
+
+    def insert(self, shape, box, order=None):
+        """Add a shape on top of the stack, or at the given stacking key."""
+        if order is None:
+            order = self.next_order
+        self.next_order = max(self.next_order, order + 1)
+        self.order[shape] = order
+        self.place(shape, box)
+
+    def insert_between(self, shape, box, below, above):
+        """Add a shape stacked just under `above` and over `below` (None for the bottom)."""
+        high = self.order[above]
+        low = self.order[below] if below is not None else high - 1
+        order = (low + high) / 2
+        if not low < order < high:  # out of float precision, spread the keys out again
+            self.renumber()
+            high = self.order[above]
+            low = self.order[below] if below is not None else high - 1
+            order = (low + high) / 2
+        self.order[shape] = order
+        self.place(shape, box)
+
+    def renumber(self):
+        for key, stacked in enumerate(sorted(self.order, key=self.order.__getitem__)):
+            self.order[stacked] = key
+        self.next_order = len(self.order)
+
+    def place(self, shape, box):
+        self.boxes[shape] = box
+        if box is None:  # nothing to hit yet, e.g. a freehand stroke without points
+            self.spans[shape] = None
+            return
+        c1, r1, c2, r2 = span = self.span(box)
+        if (c2 - c1 + 1) * (r2 - r1 + 1) > self.max_cells:
+            self.spans[shape] = None
+            self.large.add(shape)
+            return
+        self.spans[shape] = span
+        cells = self.cells
+        for column in range(c1, c2 + 1):
+            for row in range(r1, r2 + 1):
+                cell = cells.get((column, row))
+                if cell is None:
+                    cells[(column, row)] = {shape}
+                else:
+                    cell.add(shape)
+
+    def unplace(self, shape):
+        span = self.spans.pop(shape)
+        del self.boxes[shape]
+        if span is None:
+            self.large.discard(shape)
+            return
+        c1, r1, c2, r2 = span
+        cells = self.cells
+        for column in range(c1, c2 + 1):
+            for row in range(r1, r2 + 1):
+                cell = cells[(column, row)]
+                cell.discard(shape)
+                if not cell:
+                    del cells[(column, row)]
+
+    def remove(self, shape):
+        if shape in self.boxes:
+            self.unplace(shape)
+            del self.order[shape]
+
+    def update(self, shape, box):
+        """Re-register a shape after its geometry changed, keeping its stacking key."""
+        if shape not in self.boxes:
+            self.insert(shape, box)
+            return
+        if self.boxes[shape] == box:
+            return
+        if box is not None and self.spans[shape] is not None and self.span(box) == self.spans[shape]:
+            self.boxes[shape] = box  # still in the same cells
+            return
+        self.unplace(shape)
+        self.place(shape, box)
+
+    def move(self, shape, dx, dy):
+        box = self.boxes.get(shape)
+        if box is not None:
+            self.update(shape, (box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy))
+
+    def clear(self):
+        self.cells.clear()
+        self.boxes.clear()
+        self.spans.clear()
+        self.large.clear()
+        self.order.clear()
+        self.next_order = 0
+
+    def rebuild(self, shapes):
+        """Index `shapes` from scratch, bottom to top."""
+        self.clear()
+        for shape in shapes:
+            self.insert(shape, shape.bbox())
+
+    def query(self, x1, y1, x2, y2):
+        """Return the shapes whose bounding box intersects the rectangle, in no particular order."""
+        c1, r1, c2, r2 = self.span((x1, y1, x2, y2))
+        found = set()
+        cells = self.cells
+        if (c2 - c1 + 1) * (r2 - r1 + 1) > len(cells):
+            # the rectangle covers more cells than exist, walk the occupied ones instead
+            for (column, row), cell in cells.items():
+                if c1 <= column <= c2 and r1 <= row <= r2:
+                    found |= cell
+        else:
+            for column in range(c1, c2 + 1):
+                for row in range(r1, r2 + 1):
+                    cell = cells.get((column, row))
+                    if cell:
+                        found |= cell
+        found |= self.large
+        boxes = self.boxes
+        return [shape for shape in found
+                if boxes[shape] is not None
+                and boxes[shape][0] <= x2 and boxes[shape][2] >= x1
+                and boxes[shape][1] <= y2 and boxes[shape][3] >= y1]
+
+    def hits(self, x, y, margin=0):
+        """Return the shapes whose box is within `margin` of (x, y), topmost first."""
+        candidates = self.query(x - margin, y - margin, x + margin, y + margin)
+        candidates.sort(key=self.order.__getitem__, reverse=True)
+        return candidates
+
+
+class PointIndex:
+    """Uniform grid over the snap points of shapes (see Shape.snap_points).
+
+    Each cell maps the shapes with points in it to those points, flat x, y pairs, so
+    removing a shape only visits the cells it was in. Changes are noted rather than
+    indexed: a changed shape is re-indexed by the first query that could find it, so
+    dragging shapes, which queries with the dragged ones excluded, costs a set add
+    per shape and frame, and they are indexed once, after the drag.
+    """
+
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> {shape: [x, y, x, y, ...]}
+        self.where = {}  # shape -> keys of the cells holding its points
+        self.changed = set()  # shapes whose points have to be indexed again
+
+    def update(self, shape):
+        """Note that a shape was added, moved or reshaped."""
+        self.changed.add(shape)
+
+    def remove(self, shape):
+        self.changed.discard(shape)
+        if shape in self.where:
+            self.unplace(shape)
+
+    def clear(self):
+        self.cells.clear()
+        self.where.clear()
+        self.changed.clear()
+
+    def rebuild(self, shapes):
+        self.clear()
+        self.changed.update(shapes)
+
+    def place(self, shape):
+        size = self.cell_size
+        cells = self.cells
+        points = shape.snap_points()
+        found = {}  # cell key -> the shape's points in it
+        for x, y in zip(points[0::2], points[1::2]):
+            key = (int(x // size), int(y // size))
+            cell = found.get(key)
+            if cell is None:
+                found[key] = [x, y]
+            else:
+                cell += (x, y)
+        for key, cell in found.items():
+            shapes = cells.get(key)
+            if shapes is None:
+                cells[key] = {shape: cell}
+            else:
+                shapes[shape] = cell
+        self.where[shape] = list(found)
+
+    def unplace(self, shape):
+        cells = self.cells
+        for key in self.where.pop(shape):
+            cell = cells[key]
+            del cell[shape]
+            if not cell:
+                del cells[key]
+
+    def flush(self, exclude=()):
+        """Index the changed shapes, but for those in exclude."""
+        pending = self.changed - set(exclude) if exclude else self.changed
+        if not pending:
+            return
+        for shape in pending:
+            if shape in self.where:
+                self.unplace(shape)
+            self.place(shape)
+        self.changed -= pending
+
+    def nearest(self, x, y, radius, exclude=()):
+        """The point within `radius` of (x, y) closest to it, as (x, y), or None.
+
+        Points of shapes in exclude (a set) don't count.
+        """
+        self.flush(exclude)
+        size = self.cell_size
+        best = None
+        limit = radius * radius
+        cells = self.cells
+        columns = range(int((x - radius) // size), int((x + radius) // size) + 1)
+        for row in range(int((y - radius) // size), int((y + radius) // size) + 1):
+            for column in columns:
+                cell = cells.get((column, row))
+                if cell is None:
+                    continue
+                for shape, points in cell.items():
+                    if shape in exclude:
+                        continue
+                    for i in range(0, len(points), 2):
+                        distance = (points[i] - x) ** 2 + (points[i + 1] - y) ** 2
+                        if distance <= limit:
+                            limit = distance
+                            best = (points[i], points[i + 1])
+        return best
@@ -0,0 +1,167 @@
+"""Raster tiles of the shapes that aren't being edited, so Tk has fewer items to draw.
+
+Tk redraws every canvas item in a damaged area, so dragging a few shapes over a
+busy drawing costs as much as everything under them. With a TileLayer, the app
+shows the shapes it isn't editing as images, one per tile of `size` screen pixels,
+and keeps canvas items only for the shapes being edited (the selection and the
+shape being drawn), on top of the tiles.
+
+Tiles sit on a grid of screen pixels at the current zoom, anchored at the document
+origin, so panning reuses them and zooming starts over. A tile has a version, bumped
+whenever a shape under it changes; it is up to date when its image was rendered at
+its current version. Shapes are drawn into a tile's RasterRenderer on the caller's
+thread, which only records items; rasterizing them, the slow part, can run on a
+worker thread, and results that an invalidation overtook are shown until the next
+render is in.
+"""
+import math
+import queue
+import threading
+from collections import deque
+
+from render import Raster, RasterRenderer, ViewRenderer
+from viewport import Viewport
+
+
+class Tile:
+    __slots__ = ('image', 'version', 'rendered', 'queued', 'item', 'used')
+
+    def __init__(self):
+        self.image = None  # Raster of the last render
+        self.version = 0
+        self.rendered = self.queued = -1  # versions the image shows, and the last one sent to render
+        self.item = None  # canvas item showing the image
+        self.used = 0  # when the tile was last on screen, in TileLayer.clock ticks
+
+
+class TileLayer:
+    def __init__(self, size=256, limit=256, threaded=True):
+        self.size = size  # tile side, in screen pixels
+        self.limit = limit  # tiles kept, on screen or not
+        self.threaded = threaded
+        self.scale = None
+        self.tiles = {}  # (column, row) -> Tile
+        self.excluded = set()  # shapes the tiles leave out: those drawn as canvas items on top
+        self.epoch = 0  # renders from before the last zoom are dropped
+        self.clock = 0
+        self.jobs = None  # queue of the worker thread, started when first needed
+        self.done = deque()  # (epoch, key, version, Raster) of finished renders
+        self.in_flight = 0
+
+    def reset(self, scale):
+        """Start from a cleared canvas: no tile is shown, and at another zoom none is kept."""
+        if scale != self.scale:
+            self.scale = scale
+            self.tiles.clear()
+            self.epoch += 1
+        for tile in self.tiles.values():
+            tile.item = None
+
+    def clear(self):
+        """Forget every tile, e.g. when the document is replaced."""
+        self.tiles.clear()
+        self.epoch += 1
+
+    def keys(self, box):
+        """Keys of the tiles overlapping a document box."""
+        unit = self.size / self.scale
+        columns = range(math.floor(box[0] / unit), math.floor(box[2] / unit) + 1)
+        for row in range(math.floor(box[1] / unit), math.floor(box[3] / unit) + 1):
+            for column in columns:
+                yield column, row
+
+    def box(self, key):
+        unit = self.size / self.scale
+        return key[0] * unit, key[1] * unit, (key[0] + 1) * unit, (key[1] + 1) * unit
+
+    def tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = Tile()
+        tile.used = self.clock
+        return tile
+
+    def invalidate(self, box):
+        """Mark the tiles over a document box out of date. Tiles not made yet will render what's there."""
+        for key in self.keys(box):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                tile.version += 1
+
+    def shown(self, key):
+        """Whether the tile is on the canvas and up to date."""
+        tile = self.tiles.get(key)
+        return tile is not None and tile.item is not None and tile.rendered == tile.version
+
+    def covers(self, box, visible):
+        """Whether up to date tiles show everything of `box` that's within `visible`."""
+        box = (max(box[0], visible[0]), max(box[1], visible[1]), min(box[2], visible[2]), min(box[3], visible[3]))
+        return box[0] > box[2] or box[1] > box[3] or all(self.shown(key) for key in self.keys(box))
+
+    def stale(self, visible):
+        """Keys of the tiles on screen that need rendering and aren't being rendered already."""
+        self.clock += 1
+        for key in self.keys(visible):
+            tile = self.tile(key)
+            if tile.rendered != tile.version and tile.queued != tile.version:
+                yield key
+
+    def render(self, key, shapes):
+        """Render shapes, bottom to top, into the tile `key`: now, or on the worker thread."""
+        tile = self.tile(key)
+        tile.queued = tile.version
+        raster = RasterRenderer(self.size, self.size)
+        view = Viewport(self.size, self.size)
+        view.x, view.y, _, _ = self.box(key)
+        view.scale = self.scale
+        renderer = ViewRenderer(raster, view)
+        # this also points the shapes' canvas_id at the raster's items; that's harmless, as
+        # the app reads item ids right after drawing and refreshes only excluded shapes
+        for shape in shapes:
+            shape.draw(renderer)
+        job = (self.epoch, key, tile.version, raster)
+        if not self.threaded:
+            self.finish(job)
+            return
+        if self.jobs is None:
+            self.jobs = queue.SimpleQueue()
+            threading.Thread(target=self.work, args=(self.jobs,), daemon=True).start()
+        self.in_flight += 1
+        self.jobs.put(job)
+
+    def finish(self, job):
+        epoch, key, version, raster = job
+        self.done.append((epoch, key, version, Raster(self.size, self.size, raster.render())))
+
+    def work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            self.finish(job)
+
+    def collect(self):
+        """Take in the finished renders; returns the keys of the tiles with a new image."""
+        updated = []
+        while self.done:
+            epoch, key, version, image = self.done.popleft()
+            if self.threaded:
+                self.in_flight -= 1
+            tile = self.tiles.get(key)
+            if epoch != self.epoch or tile is None or version <= tile.rendered:
+                continue
+            tile.image, tile.rendered = image, version
+            updated.append(key)
+        return updated
+
+    def evict(self):
+        """Drop the tiles least recently on screen past the limit; returns them, to delete their items."""
+        if len(self.tiles) <= self.limit:
+            return []
+        keys = sorted(self.tiles, key=lambda key: self.tiles[key].used)[:len(self.tiles) - self.limit]
+        return [self.tiles.pop(key) for key in keys]
+
+    def close(self):
+        if self.jobs is not None:
+            self.jobs.put(None)
+            self.jobs = None
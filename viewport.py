@@ -0,0 +1,62 @@
+"""The part of the document the canvas shows: pan and zoom.
+
+Shapes keep document coordinates. The viewport maps them to screen pixels and
+back: screen = (document - origin) * scale, where origin is the document point
+at the canvas's top-left corner.
+"""
+
+
+class Viewport:
+    MIN_SCALE = 0.02
+    MAX_SCALE = 50.0
+
+    def __init__(self, width=800, height=600):
+        self.width, self.height = width, height  # canvas size in pixels
+        self.x = self.y = 0.0  # document point at the top-left corner
+        self.scale = 1.0  # screen pixels per document unit
+
+    def to_document(self, sx, sy):
+        return self.x + sx / self.scale, self.y + sy / self.scale
+
+    def to_screen(self, x, y):
+        return (x - self.x) * self.scale, (y - self.y) * self.scale
+
+    def screen_coords(self, coords):
+        """Map a flat x0, y0, x1, y1, ... sequence to screen pixels, as a new list."""
+        scale, left, top = self.scale, self.x, self.y
+        mapped = [0.0] * len(coords)
+        mapped[0::2] = [(x - left) * scale for x in coords[0::2]]
+        mapped[1::2] = [(y - top) * scale for y in coords[1::2]]
+        return mapped
+
+    def visible(self, margin=0):
+        """The document box on screen, grown by `margin` pixels on every side."""
+        x1, y1 = self.to_document(-margin, -margin)
+        x2, y2 = self.to_document(self.width + margin, self.height + margin)
+        return (x1, y1, x2, y2)
+
+    def shows(self, box, margin=0):
+        """Whether a document box overlaps the screen. None (no geometry yet) counts as shown."""
+        if box is None:
+            return True
+        x1, y1, x2, y2 = self.visible(margin)
+        return box[0] <= x2 and box[2] >= x1 and box[1] <= y2 and box[3] >= y1
+
+    def resize(self, width, height):
+        self.width, self.height = width, height
+
+    def pan(self, dx, dy):
+        """Scroll the view by (dx, dy) screen pixels; the drawing follows the mouse."""
+        self.x -= dx / self.scale
+        self.y -= dy / self.scale
+
+    def zoom(self, factor, sx, sy):
+        """Scale by `factor`, keeping the document point under screen (sx, sy) in place."""
+        scale = min(max(self.scale * factor, self.MIN_SCALE), self.MAX_SCALE)
+        x, y = self.to_document(sx, sy)
+        self.scale = scale
+        self.x, self.y = x - sx / scale, y - sy / scale
+
+    def reset(self):
+        self.x = self.y = 0.0
+        self.scale = 1.0